@@ -0,0 +1,130 @@
+# ===============================================================
+# benchmarks/codec_bench.py
+# 스트리밍 코덱 마이크로벤치마크: 토큰 1개당 SSE 파싱 + NDJSON 인코딩 CPU 시간 비교
+# CMD: python benchmarks/codec_bench.py [--tokens 20000] [--output codec_report.json]
+# → legacy: 이전 방식 (aiter_lines → strip → json.loads → dict → datetime 변환 → json.dumps → str)
+# → fast: 브릿지의 현재 코덱 (aiter_sse_data → json_loads → CreatedAtCache → NdjsonChunkEncoder)
+# ===============================================================
+
+# --- 라이브러리 임포트 ---
+import httpx  # 실제 httpx 응답 객체로 스트림 재현
+import argparse  # 명령행 옵션
+import asyncio  # 비동기 처리
+import json  # JSON 처리
+import os  # 경로
+import sys  # 모듈 경로
+import time  # CPU 시간 측정
+from datetime import datetime, timezone  # legacy created_at 변환
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vllm_ollama_bridge"))
+import vllm_ollama_bridge_server as bridge  # noqa: E402
+
+
+def sse_payload(tokens):
+    # vLLM이 보내는 형식의 SSE 스트림 (토큰마다 한 이벤트, 네트워크 조각 크기는 1 KiB로 임의 분할)
+    created = int(time.time())
+    events = []
+    for i in range(tokens):
+        chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created + i // 50, "model": "bench-model",
+                 "choices": [{"index": 0, "delta": {"content": f" 토큰{i}" if i % 7 == 0 else f" token{i}"}, "logprobs": None, "finish_reason": None}]}
+        events.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+    events.append("data: [DONE]\n\n")
+    raw = "".join(events).encode("utf-8")
+    return [raw[i:i + 1024] for i in range(0, len(raw), 1024)]
+
+
+def make_response(pieces):
+    async def stream():
+        for piece in pieces:
+            yield piece
+    return httpx.Response(200, content=stream())
+
+
+async def legacy_path(response, model):
+    out = 0
+    async for line in response.aiter_lines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("data: "):
+            line = line[len("data: "):]
+        if line == "[DONE]":
+            continue
+        chunk = json.loads(line)
+        choice = chunk["choices"][0]
+        content = (choice.get("delta") or {}).get("content") or ""
+        created_at = datetime.fromtimestamp(chunk["created"], tz=timezone.utc).isoformat(timespec="microseconds") + "Z"
+        data = {"model": model, "created_at": created_at, "message": {"role": "assistant", "content": content}, "done": False}
+        out += len(f"{json.dumps(data, ensure_ascii=False)}\n".encode("utf-8"))
+    return out
+
+
+async def fast_path(response, model):
+    out = 0
+    created_at_cache = bridge.CreatedAtCache()
+    encoder = bridge.NdjsonChunkEncoder(model)
+    async for line, _ in bridge.aiter_sse_data(response):
+        if not line or line == b"[DONE]":
+            continue
+        chunk = bridge.json_loads(line)
+        choice = chunk["choices"][0]
+        content = (choice.get("delta") or {}).get("content") or ""
+        out += len(encoder.chunk(created_at_cache.get(chunk.get("created")), content))
+    return out
+
+
+def measure(path, pieces, tokens, repeat):
+    best = None
+    for _ in range(repeat):
+        response = make_response(pieces)
+        start = time.process_time()
+        asyncio.run(path(response, "bench-model"))
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / tokens * 1_000_000  # µs / token
+
+
+async def same_output(pieces):
+    # 두 경로의 NDJSON 출력이 바이트 단위로 같은지 확인
+    legacy, fast = [], []
+    async for line in make_response(pieces).aiter_lines():
+        line = line.strip()
+        if line.startswith("data: ") and line != "data: [DONE]":
+            chunk = json.loads(line[6:])
+            created_at = datetime.fromtimestamp(chunk["created"], tz=timezone.utc).isoformat(timespec="microseconds") + "Z"
+            legacy.append(f"{json.dumps({'model': 'bench-model', 'created_at': created_at, 'message': {'role': 'assistant', 'content': chunk['choices'][0]['delta']['content']}, 'done': False}, ensure_ascii=False)}\n".encode("utf-8"))
+    encoder, cache = bridge.NdjsonChunkEncoder("bench-model"), bridge.CreatedAtCache()
+    async for line, _ in bridge.aiter_sse_data(make_response(pieces)):
+        if line and line != b"[DONE]":
+            chunk = bridge.json_loads(line)
+            fast.append(encoder.chunk(cache.get(chunk["created"]), chunk["choices"][0]["delta"]["content"]))
+    return legacy == fast
+
+
+def main():
+    parser = argparse.ArgumentParser(description="스트리밍 코덱 마이크로벤치마크")
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="결과 JSON 저장 경로")
+    args = parser.parse_args()
+
+    pieces = sse_payload(args.tokens)
+    legacy_us = measure(legacy_path, pieces, args.tokens, args.repeat)
+    fast_us = measure(fast_path, pieces, args.tokens, args.repeat)
+    report = {
+        "tokens": args.tokens,
+        "json_backend": "orjson" if bridge.orjson is not None else "json",
+        "identical_output": asyncio.run(same_output(pieces)),
+        "legacy_us_per_token": round(legacy_us, 3),
+        "fast_us_per_token": round(fast_us, 3),
+        "speedup": round(legacy_us / fast_us, 2),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# ===============================================================
+# benchmarks/fake_vllm.py
+# GPU 없이 브릿지 성능을 측정하기 위한 OpenAI 호환 가짜 vLLM 서버
+# CMD: python benchmarks/fake_vllm.py --port 18000 --ttft-ms 150 --tokens-per-second 60
+# ===============================================================
+
+# --- 라이브러리 임포트 ---
+from fastapi import FastAPI, Request  # 웹 서버 구성 및 요청 객체
+from fastapi.responses import JSONResponse, StreamingResponse  # 다양한 HTTP 응답 형식
+import uvicorn  # ASGI 서버
+import argparse  # 명령행 옵션
+import asyncio  # 비동기 처리
+import json  # JSON 처리
+import random  # 지연 시간 흔들림(jitter)
+import time  # 시간 측정용
+import zlib  # 텍스트별 고정 임베딩 값
+
+
+
+
+
+# ===============================================================
+# 지연 시간 프로필
+# → 첫 토큰까지: ttft_ms + 프롬프트 1000자당 prefill_ms_per_1k_chars (+ jitter)
+# → 이후 토큰은 tokens_per_second 속도로 일정하게 전송 (+ jitter)
+# → 응답 길이: 요청의 max_tokens와 --tokens 중 작은 값
+# ===============================================================
+class LatencyProfile:
+    def __init__(self, ttft_ms, tokens_per_second, tokens, jitter_ms, prefill_ms_per_1k_chars):
+        self.ttft = ttft_ms / 1000
+        self.interval = 1 / tokens_per_second if tokens_per_second > 0 else 0.0
+        self.tokens = tokens
+        self.jitter = jitter_ms / 1000
+        self.prefill_per_char = prefill_ms_per_1k_chars / 1000 / 1000
+
+    def first_token_delay(self, prompt_chars):
+        return self.ttft + prompt_chars * self.prefill_per_char + random.uniform(0, self.jitter)
+
+    def token_delay(self):
+        return self.interval + random.uniform(0, self.jitter)
+
+    def completion_tokens(self, body):
+        return min(body.get("max_tokens") or self.tokens, self.tokens)
+
+
+def create_app(models, profile):
+    app = FastAPI()
+    stats = {"chat": 0, "streams": 0, "active": 0, "aborted": 0, "tokens": 0, "embeddings": 0, "embedding_inputs": 0}
+
+    @app.get("/health")
+    async def health():
+        return {}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [
+            {"id": model, "object": "model", "created": 1700000000, "owned_by": "vllm", "max_model_len": 32768}
+            for model in models
+        ]}
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body.get("input") or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        stats["embeddings"] += 1
+        stats["embedding_inputs"] += len(inputs)
+        dimensions = body.get("dimensions") or 8
+        await asyncio.sleep(profile.ttft)
+        # 텍스트마다 항상 같은 벡터 (캐시 / 중복 제거 결과 확인용)
+        data = [{"object": "embedding", "index": i, "embedding": [((zlib.crc32(text.encode("utf-8")) >> k) % 1000) / 1000 for k in range(dimensions)]} for i, text in enumerate(inputs)]
+        prompt_tokens = sum(max(1, len(text) // 4) for text in inputs)
+        return {"object": "list", "model": body.get("model"), "data": data, "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["chat"] += 1
+        model = body.get("model", models[0])
+        prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+        prompt_tokens = max(1, prompt_chars // 4)
+        count = profile.completion_tokens(body)
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(profile.first_token_delay(prompt_chars) + count * profile.interval)
+            stats["tokens"] += count
+            return JSONResponse({
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(f" tok{i}" for i in range(count))}, "finish_reason": "length" if count < profile.tokens else "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": count, "total_tokens": prompt_tokens + count},
+            })
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        def sse(choices, usage=None):
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model, "choices": choices}
+            if usage is not None:
+                chunk["usage"] = usage
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        async def generate():
+            stats["streams"] += 1
+            stats["active"] += 1
+            loop = asyncio.get_running_loop()
+            # 토큰 전송 시각을 절대 일정으로 잡아 처리 지연이 누적되지 않도록 함
+            next_at = loop.time() + profile.first_token_delay(prompt_chars)
+            sent = 0
+            try:
+                yield sse([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+                for i in range(count):
+                    await asyncio.sleep(max(0.0, next_at - loop.time()))
+                    yield sse([{"index": 0, "delta": {"content": f" tok{i}"}, "finish_reason": None}])
+                    sent += 1
+                    next_at += profile.token_delay()
+                yield sse([{"index": 0, "delta": {}, "finish_reason": "length" if count < profile.tokens else "stop"}])
+                if include_usage:
+                    yield sse([], {"prompt_tokens": prompt_tokens, "completion_tokens": count, "total_tokens": prompt_tokens + count})
+                yield "data: [DONE]\n\n"
+            except asyncio.CancelledError:
+                stats["aborted"] += 1
+                raise
+            finally:
+                stats["active"] -= 1
+                stats["tokens"] += sent
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 호환 가짜 vLLM 서버 (벤치마크용)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--models", default="fake-model", help="쉼표로 구분한 모델 ID 목록")
+    parser.add_argument("--ttft-ms", type=float, default=150.0, help="첫 토큰까지의 기본 지연 (ms)")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0, help="스트림당 토큰 생성 속도 (0 = 지연 없음)")
+    parser.add_argument("--tokens", type=int, default=128, help="응답 최대 토큰 수")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="지연마다 더해지는 무작위 시간 상한 (ms)")
+    parser.add_argument("--prefill-ms-per-1k-chars", type=float, default=5.0, help="프롬프트 1000자당 추가 prefill 지연 (ms)")
+    args = parser.parse_args()
+
+    profile = LatencyProfile(args.ttft_ms, args.tokens_per_second, args.tokens, args.jitter_ms, args.prefill_ms_per_1k_chars)
+    app = create_app([m.strip() for m in args.models.split(",") if m.strip()], profile)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# ===============================================================
+# benchmarks/loadgen.py
+# JSONL 트레이스를 재생하여 브릿지(/api/chat, /api/tags)에 부하를 거는 도구
+# CMD: python benchmarks/loadgen.py --url http://127.0.0.1:11434 --trace benchmarks/traces/chat_mix.jsonl --concurrency 16 --requests 200
+# ===============================================================
+
+# --- 라이브러리 임포트 ---
+import httpx  # 비동기 HTTP 클라이언트
+import argparse  # 명령행 옵션
+import asyncio  # 비동기 처리
+import itertools  # 트레이스 순환 재생
+import json  # JSON 처리
+import sys  # 결과 출력
+import time  # 시간 측정용
+
+
+
+
+
+# ===============================================================
+# 트레이스 읽기
+# → 한 줄에 요청 하나: {"endpoint": "/api/chat", "body": {...}} 또는 Ollama /api/chat 본문 그대로
+# → GET 요청은 body 없이 {"endpoint": "/api/tags"}
+# ===============================================================
+def load_trace(path):
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            item = json.loads(line)
+            if "endpoint" not in item:
+                item = {"endpoint": "/api/chat", "body": item}
+            entries.append(item)
+    if not entries:
+        raise ValueError(f"트레이스가 비어 있음: {path}")
+    return entries
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def chunk_content(line):
+    # Ollama NDJSON과 OpenAI SSE 모두에서 (텍스트, 최종 청크 여부, 최종 청크 데이터) 추출
+    if line.startswith("data: "):
+        line = line[len("data: "):]
+    if line == "[DONE]":
+        return "", True, None
+    data = json.loads(line)
+    if "choices" in data:
+        choices = data["choices"]
+        content = (choices[0].get("delta") or {}).get("content") or "" if choices else ""
+        return content, False, data
+    return (data.get("message") or {}).get("content") or "", bool(data.get("done")), data
+
+
+
+
+
+# ===============================================================
+# 요청 1건 실행 및 측정
+# → ttft: 첫 텍스트 청크 수신까지의 시간 (비스트리밍은 전체 응답 시간)
+# → gaps: 스트리밍 텍스트 청크 사이 간격
+# ===============================================================
+async def run_request(client, entry, stream_override=None):
+    endpoint = entry["endpoint"]
+    body = dict(entry.get("body") or {})
+    if stream_override is not None and body:
+        body["stream"] = stream_override
+    result = {"endpoint": endpoint, "stream": bool(body.get("stream")), "status": None, "ok": False,
+              "ttft": None, "total": None, "chunks": 0, "gaps": [], "eval_count": 0, "error": None}
+    start = time.perf_counter()
+    try:
+        if not body:
+            response = await client.get(endpoint)
+            result["status"] = response.status_code
+            result["ttft"] = result["total"] = time.perf_counter() - start
+            result["ok"] = response.status_code == 200
+            return result
+
+        if not body.get("stream"):
+            response = await client.post(endpoint, json=body)
+            result["status"] = response.status_code
+            result["ttft"] = result["total"] = time.perf_counter() - start
+            data = response.json()
+            result["eval_count"] = data.get("eval_count") or (data.get("usage") or {}).get("completion_tokens") or 0
+            result["ok"] = response.status_code == 200
+            return result
+
+        last_chunk_at = None
+        async with client.stream("POST", endpoint, json=body) as response:
+            result["status"] = response.status_code
+            async for line in response.aiter_lines():
+                line = line.strip()
+                if not line:
+                    continue
+                now = time.perf_counter()
+                content, done, data = chunk_content(line)
+                if content:
+                    result["chunks"] += 1
+                    if last_chunk_at is None:
+                        result["ttft"] = now - start
+                    else:
+                        result["gaps"].append(now - last_chunk_at)
+                    last_chunk_at = now
+                if data and (data.get("usage") or data.get("eval_count")):
+                    result["eval_count"] = data.get("eval_count") or data["usage"].get("completion_tokens") or 0
+                if done:
+                    result["ok"] = response.status_code == 200
+        result["total"] = time.perf_counter() - start
+        if not result["eval_count"]:
+            result["eval_count"] = result["chunks"]
+    except (httpx.HTTPError, ValueError) as exc:
+        result["error"] = f"{type(exc).__name__}: {exc}"
+        result["total"] = time.perf_counter() - start
+    return result
+
+
+
+
+
+# ===============================================================
+# 동시 실행 부하
+# → concurrency개의 작업자가 트레이스를 순서대로 나눠 재생
+# → requests 개수 또는 duration(초) 중 먼저 도달하는 조건에서 종료
+# ===============================================================
+async def run_load(base_url, trace, concurrency, requests=None, duration=None, stream=None, timeout=300.0):
+    entries = itertools.cycle(trace)
+    issued = 0
+    results = []
+    deadline = time.perf_counter() + duration if duration else None
+    if requests is None and deadline is None:
+        requests = len(trace)
+
+    def next_entry():
+        nonlocal issued
+        if requests is not None and issued >= requests:
+            return None
+        if deadline is not None and time.perf_counter() >= deadline:
+            return None
+        issued += 1
+        return next(entries)
+
+    async def worker(client):
+        while (entry := next_entry()) is not None:
+            results.append(await run_request(client, entry, stream))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r["ok"]]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    totals = [r["total"] for r in ok]
+    gaps = [gap for r in ok for gap in r["gaps"]]
+    tokens = sum(r["eval_count"] for r in ok)
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            key = r["error"].split(":")[0] if r["error"] else f"http_{r['status']}"
+            errors[key] = errors.get(key, 0) + 1
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(ok) / elapsed, 2) if elapsed > 0 else None,
+        "tokens": tokens,
+        "tokens_per_s": round(tokens / elapsed, 1) if elapsed > 0 else None,
+        "ttft_ms": {"p50": ms(percentile(ttfts, 50)), "p90": ms(percentile(ttfts, 90)), "p99": ms(percentile(ttfts, 99))},
+        "total_ms": {"p50": ms(percentile(totals, 50)), "p99": ms(percentile(totals, 99))},
+        "chunk_gap_ms": {"p50": ms(percentile(gaps, 50)), "p99": ms(percentile(gaps, 99)), "max": ms(max(gaps, default=None))},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONL 트레이스 재생 부하 생성기")
+    parser.add_argument("--url", default="http://127.0.0.1:11434", help="브릿지 주소")
+    parser.add_argument("--trace", required=True, help="JSONL 트레이스 파일")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=None, help="총 요청 수 (기본: 트레이스 1회)")
+    parser.add_argument("--duration", type=float, default=None, help="부하 유지 시간 (초)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--stream", dest="stream", action="store_true", default=None, help="모든 채팅 요청을 스트리밍으로")
+    mode.add_argument("--no-stream", dest="stream", action="store_false", help="모든 채팅 요청을 비스트리밍으로")
+    parser.add_argument("--output", help="결과 JSON 저장 경로 (기본: 표준 출력)")
+    args = parser.parse_args()
+
+    results, elapsed = asyncio.run(run_load(args.url, load_trace(args.trace), args.concurrency, args.requests, args.duration, args.stream))
+    report = {"url": args.url, "trace": args.trace, "concurrency": args.concurrency, **summarize(results, elapsed)}
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+# ===============================================================
+# benchmarks/run_bench.py
+# 가짜 vLLM + 브릿지를 로컬에서 띄워 브릿지 자체 비용을 측정하고 JSON 리포트로 저장
+# CMD: python benchmarks/run_bench.py --output bench_report.json [--baseline old_report.json]
+# → GPU 불필요 (CPU만 사용), 브릿지 프로세스의 CPU/메모리는 /proc에서 읽으므로 Linux 전용
+# ===============================================================
+
+# --- 라이브러리 임포트 ---
+import httpx  # 비동기 HTTP 클라이언트
+import argparse  # 명령행 옵션
+import asyncio  # 비동기 처리
+import json  # JSON 처리
+import os  # 경로 / 환경변수
+import platform  # 실행 환경 기록
+import subprocess  # 가짜 vLLM / 브릿지 프로세스 실행
+import sys  # 인터프리터 경로
+import time  # 시간 측정용
+from datetime import datetime, timezone  # 리포트 시각
+
+from loadgen import load_trace, ms, percentile, run_load, summarize  # 같은 디렉토리의 부하 생성기
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BRIDGE_DIR = os.path.join(REPO_DIR, "vllm_ollama_bridge")
+
+# --- 회귀 비교 대상 지표: (리포트 내 경로, 값이 클수록 나쁜지 여부) ---
+REGRESSION_METRICS = [
+    (("bridge_added_ttft_ms", "p50"), True),
+    (("bridge_added_ttft_ms", "p99"), True),
+    (("chunk_overhead_ms", "p50"), True),
+    (("chunk_overhead_ms", "p99"), True),
+    (("cpu_us_per_token",), True),
+    (("memory_kb_per_stream",), True),
+    (("max_sustained_streams",), False),
+    (("tags", "requests_per_s"), False),
+]
+
+
+
+
+
+# ===============================================================
+# 프로세스 실행 / 자원 측정
+# ===============================================================
+def start_process(args, env=None, cwd=None):
+    return subprocess.Popen(args, env={**os.environ, **(env or {})}, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(process, url, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.perf_counter() < deadline:
+            # 포트 충돌 등으로 프로세스가 바로 종료되면 다른 서버를 측정하지 않도록 중단
+            if process.poll() is not None:
+                raise RuntimeError(f"프로세스가 종료됨 (exit {process.returncode}): {url}")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"서버가 준비되지 않음: {url}")
+
+
+def process_cpu_seconds(pid):
+    # /proc/<pid>/stat의 utime + stime (clock tick 단위)
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def process_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class RssSampler:
+    # 부하 구간 동안 브릿지 RSS 최대값 기록
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = process_rss_kb(pid)
+        self.task = None
+
+    async def run(self):
+        while True:
+            rss = process_rss_kb(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            await asyncio.sleep(self.interval)
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    async def __aexit__(self, *exc):
+        self.task.cancel()
+
+
+async def scrape_histogram(base_url, name):
+    # /metrics에서 히스토그램 버킷 누적값을 모든 라벨에 대해 합산: {le: count}
+    async with httpx.AsyncClient(base_url=base_url, timeout=10.0) as client:
+        text = (await client.get("/metrics")).text
+    buckets = {}
+    for line in text.splitlines():
+        if not line.startswith(f"{name}_bucket{{"):
+            continue
+        labels, value = line.rsplit(" ", 1)
+        le = labels.split('le="', 1)[1].split('"', 1)[0]
+        bound = float("inf") if le == "+Inf" else float(le)
+        buckets[bound] = buckets.get(bound, 0) + float(value)
+    return buckets
+
+
+def histogram_quantile(before, after, q):
+    # 두 시점 사이의 증가분으로 분위수 추정 (버킷 내부는 선형 보간, Prometheus histogram_quantile과 같은 방식)
+    bounds = sorted(after)
+    counts = [after[b] - before.get(b, 0) for b in bounds]
+    if not counts or counts[-1] <= 0:
+        return None
+    rank = q / 100 * counts[-1]
+    lower_bound, lower_count = 0.0, 0.0
+    for bound, count in zip(bounds, counts):
+        if count >= rank:
+            if bound == float("inf"):
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return None
+
+
+
+
+
+# ===============================================================
+# 측정 시나리오
+# ===============================================================
+async def measure_direct_ttft(fake_url, trace, concurrency, requests):
+    # 브릿지를 거치지 않고 가짜 vLLM에 직접 요청한 TTFT (브릿지 추가 지연 계산의 기준)
+    direct = [{"endpoint": "/v1/chat/completions", "body": {**e["body"], "stream": True}} for e in trace if e.get("body")]
+    results, _ = await run_load(fake_url, direct, concurrency, requests)
+    return [r["ttft"] for r in results if r["ok"] and r["ttft"] is not None]
+
+
+async def measure_streams(bridge_url, pid, trace, concurrency, requests):
+    # 스트리밍 부하 + 청크별 브릿지 오버헤드 + 토큰당 CPU 시간
+    chat = [e for e in trace if e.get("body")]
+    before = await scrape_histogram(bridge_url, "bridge_overhead_seconds")
+    cpu_before = process_cpu_seconds(pid)
+    results, elapsed = await run_load(bridge_url, chat, concurrency, requests, stream=True)
+    cpu_after = process_cpu_seconds(pid)
+    after = await scrape_histogram(bridge_url, "bridge_overhead_seconds")
+    summary = summarize(results, elapsed)
+    overhead = {f"p{q}": ms(histogram_quantile(before, after, q)) for q in (50, 99)}
+    cpu_us_per_token = None
+    if cpu_before is not None and cpu_after is not None and summary["tokens"]:
+        cpu_us_per_token = round((cpu_after - cpu_before) / summary["tokens"] * 1_000_000, 2)
+    return results, summary, overhead, cpu_us_per_token
+
+
+async def measure_max_streams(bridge_url, pid, trace, levels, token_interval_ms, slack_ms):
+    # 동시 스트림 수를 단계적으로 늘리며 끊김 없이 유지되는 최대 단계 탐색
+    # → 통과 조건: 오류 없음 + 청크 간격 p99가 (토큰 간격 + slack) 이내
+    chat = [e for e in trace if e.get("body")]
+    idle_rss = process_rss_kb(pid)
+    steps = []
+    best = 0
+    memory_per_stream = None
+    for level in levels:
+        async with RssSampler(pid) as sampler:
+            results, elapsed = await run_load(bridge_url, chat, level, level, stream=True)
+        summary = summarize(results, elapsed)
+        gap_p99 = summary["chunk_gap_ms"]["p99"]
+        passed = summary["ok"] == level and gap_p99 is not None and gap_p99 <= token_interval_ms + slack_ms
+        steps.append({"streams": level, "passed": passed, "chunk_gap_p99_ms": gap_p99, "ttft_p99_ms": summary["ttft_ms"]["p99"], "peak_rss_kb": sampler.peak})
+        if not passed:
+            break
+        best = level
+        if idle_rss is not None and sampler.peak is not None:
+            memory_per_stream = round(max(0, sampler.peak - idle_rss) / level, 1)
+    return best, memory_per_stream, steps
+
+
+async def run_benchmarks(args):
+    trace = load_trace(args.trace)
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    bridge_url = f"http://127.0.0.1:{args.bridge_port}"
+    token_interval_ms = 1000 / args.tokens_per_second if args.tokens_per_second > 0 else 0.0
+
+    fake = start_process([
+        sys.executable, os.path.join(BENCH_DIR, "fake_vllm.py"), "--port", str(args.fake_port),
+        "--models", args.model, "--ttft-ms", str(args.ttft_ms), "--tokens-per-second", str(args.tokens_per_second),
+        "--tokens", str(args.tokens), "--jitter-ms", "0",
+    ])
+    bridge_env = {
+        "BRIDGE_UPSTREAMS": fake_url,
+        "BRIDGE_MAX_CONCURRENT": "0",  # 브릿지 대기열이 측정을 가리지 않도록 동시 실행 제한 해제
+        "BRIDGE_RESPONSE_CACHE_MAX_BYTES": "0",  # 캐시/중복 공유 없이 매 요청을 실제로 중계
+        "BRIDGE_INFLIGHT_DEDUP": "off",
+    }
+    for item in args.bridge_env:
+        key, _, value = item.partition("=")
+        bridge_env[key] = value
+    bridge = start_process(
+        [sys.executable, "-m", "uvicorn", "vllm_ollama_bridge_server:app", "--port", str(args.bridge_port), "--log-level", "warning", "--no-access-log"],
+        env=bridge_env, cwd=BRIDGE_DIR,
+    )
+    try:
+        await wait_ready(fake, f"{fake_url}/health")
+        await wait_ready(bridge, f"{bridge_url}/")
+        # 워밍업: 카탈로그 / 커넥션 풀 / 코드 경로 준비 (직접 호출 기준선도 같은 조건으로)
+        await run_load(bridge_url, trace, args.concurrency, args.concurrency, stream=True)
+        await measure_direct_ttft(fake_url, trace, args.concurrency, args.concurrency)
+
+        direct_ttfts = await measure_direct_ttft(fake_url, trace, args.concurrency, args.requests)
+        stream_results, streaming, overhead, cpu_us_per_token = await measure_streams(bridge_url, bridge.pid, trace, args.concurrency, args.requests)
+        bridge_ttfts = [r["ttft"] for r in stream_results if r["ok"] and r["ttft"] is not None]
+        added_ttft = {}
+        for q in (50, 99):
+            bridge_q, direct_q = percentile(bridge_ttfts, q), percentile(direct_ttfts, q)
+            added_ttft[f"p{q}"] = ms(bridge_q - direct_q) if bridge_q is not None and direct_q is not None else None
+
+        once_results, once_elapsed = await run_load(bridge_url, [e for e in trace if e.get("body")], args.concurrency, args.requests, stream=False)
+        tags_results, tags_elapsed = await run_load(bridge_url, [{"endpoint": "/api/tags"}], args.concurrency, args.requests * 4)
+
+        levels = [n for n in (8, 16, 32, 64, 128, 256, 512, 1024, 2048) if n <= args.max_streams]
+        max_streams, memory_per_stream, steps = await measure_max_streams(bridge_url, bridge.pid, trace, levels, token_interval_ms, args.gap_slack_ms)
+    finally:
+        bridge.terminate()
+        fake.terminate()
+        bridge.wait(10)
+        fake.wait(10)
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {
+            "trace": os.path.relpath(args.trace, REPO_DIR), "concurrency": args.concurrency, "requests": args.requests,
+            "ttft_ms": args.ttft_ms, "tokens_per_second": args.tokens_per_second, "tokens": args.tokens,
+            "bridge_env": bridge_env,
+        },
+        "bridge_added_ttft_ms": added_ttft,
+        "chunk_overhead_ms": overhead,
+        "cpu_us_per_token": cpu_us_per_token,
+        "max_sustained_streams": max_streams,
+        "memory_kb_per_stream": memory_per_stream,
+        "streaming": streaming,
+        "non_streaming": summarize(once_results, once_elapsed),
+        "tags": summarize(tags_results, tags_elapsed),
+        "stream_ramp": steps,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+
+
+# ===============================================================
+# 이전 리포트와 비교 (회귀 감지)
+# → tolerance 비율 이상 나빠진 지표가 있으면 종료 코드 1
+# ===============================================================
+def compare_reports(baseline, current, tolerance):
+    regressions = []
+    for path, higher_is_worse in REGRESSION_METRICS:
+        old, new = baseline, current
+        for key in path:
+            old = old.get(key) if isinstance(old, dict) else None
+            new = new.get(key) if isinstance(new, dict) else None
+        if old is None or new is None or old == 0:
+            continue
+        change = (new - old) / abs(old)
+        if (change > tolerance) if higher_is_worse else (change < -tolerance):
+            regressions.append({"metric": ".".join(path), "baseline": old, "current": new, "change": round(change, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="브릿지 벤치마크 (가짜 vLLM 사용, GPU 불필요)")
+    parser.add_argument("--trace", default=os.path.join(BENCH_DIR, "traces", "chat_mix.jsonl"))
+    parser.add_argument("--model", default="fake-model", help="가짜 vLLM이 제공할 모델 ID (트레이스의 model과 일치해야 함)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--ttft-ms", type=float, default=100.0)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--max-streams", type=int, default=512, help="동시 스트림 탐색 상한")
+    parser.add_argument("--gap-slack-ms", type=float, default=50.0, help="청크 간격 p99 허용 여유 (ms)")
+    parser.add_argument("--fake-port", type=int, default=18000)
+    parser.add_argument("--bridge-port", type=int, default=18434)
+    parser.add_argument("--bridge-env", action="append", default=[], help="브릿지 환경변수 추가 (KEY=VALUE, 여러 번 지정 가능)")
+    parser.add_argument("--output", default="bench_report.json")
+    parser.add_argument("--baseline", help="비교할 이전 리포트 JSON")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="회귀로 판단할 악화 비율")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmarks(args))
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["regressions"] = compare_reports(json.load(f), report, args.tolerance)
+        exit_code = 1 if report["regressions"] else 0
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    print(json.dumps({k: report[k] for k in ("bridge_added_ttft_ms", "chunk_overhead_ms", "cpu_us_per_token", "max_sustained_streams", "memory_kb_per_stream")}, indent=2))
+    if exit_code:
+        print(f"regressions: {json.dumps(report['regressions'], ensure_ascii=False)}", file=sys.stderr)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# ===============================================================
+# benchmarks/workers_bench.py
+# 멀티 워커 모드 비교: 같은 부하를 워커 1개와 N개 브릿지에 걸어 처리량 / 지연 / CPU 비용 비교
+# CMD: python benchmarks/workers_bench.py [--workers 1,auto] [--output workers_report.json]
+# → 브릿지는 런처(python vllm_ollama_bridge_server.py)로 실행하므로 공유 상태 서버까지 포함해 측정
+# → 가짜 vLLM이 병목이 되지 않도록 여러 개를 띄워 BRIDGE_UPSTREAMS로 분산
+# → 워커 프로세스 CPU 시간은 /proc에서 읽으므로 Linux 전용
+# ===============================================================
+
+# --- 라이브러리 임포트 ---
+import argparse  # 명령행 옵션
+import asyncio  # 비동기 처리
+import json  # JSON 처리
+import os  # 경로 / 환경변수
+import platform  # 실행 환경 기록
+import sys  # 인터프리터 경로
+from datetime import datetime, timezone  # 리포트 시각
+
+from loadgen import load_trace, run_load, summarize  # 같은 디렉토리의 부하 생성기
+from run_bench import BENCH_DIR, BRIDGE_DIR, REPO_DIR, git_revision, process_cpu_seconds, start_process, wait_ready  # 프로세스 실행 / 측정 헬퍼
+
+
+def process_tree_pids(root):
+    # 런처와 그 하위 프로세스(uvicorn 워커) pid 목록
+    parents = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                parents[int(name)] = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    pids = [root]
+    for pid in pids:
+        pids.extend(child for child, parent in parents.items() if parent == pid)
+    return pids
+
+
+def tree_cpu_seconds(root):
+    return sum(cpu for cpu in (process_cpu_seconds(pid) for pid in process_tree_pids(root)) if cpu is not None)
+
+
+async def measure_workers(args, workers, upstreams, trace):
+    bridge_url = f"http://127.0.0.1:{args.bridge_port}"
+    chat = [e for e in trace if e.get("body")]
+    bridge_env = {
+        "BRIDGE_UPSTREAMS": ",".join(upstreams),
+        "BRIDGE_HOST": "127.0.0.1",
+        "BRIDGE_PORT": str(args.bridge_port),
+        "BRIDGE_WORKERS": str(workers),
+        "BRIDGE_MAX_CONCURRENT": "0",  # 브릿지 대기열이 측정을 가리지 않도록 동시 실행 제한 해제
+        "BRIDGE_RESPONSE_CACHE_MAX_BYTES": "0",  # 캐시/중복 공유 없이 매 요청을 실제로 중계
+        "BRIDGE_INFLIGHT_DEDUP": "off",
+        "BRIDGE_LOG_LEVEL": "WARNING",
+    }
+    bridge = start_process([sys.executable, "vllm_ollama_bridge_server.py"], env=bridge_env, cwd=BRIDGE_DIR)
+    try:
+        await wait_ready(bridge, f"{bridge_url}/")
+        # 워밍업: 모든 워커가 요청을 받을 만큼 충분히
+        await run_load(bridge_url, chat, args.concurrency, args.concurrency * 2, stream=True)
+
+        cpu_before = tree_cpu_seconds(bridge.pid)
+        results, elapsed = await run_load(bridge_url, chat, args.concurrency, args.requests, stream=True)
+        cpu_after = tree_cpu_seconds(bridge.pid)
+        streaming = summarize(results, elapsed)
+
+        tags_results, tags_elapsed = await run_load(bridge_url, [{"endpoint": "/api/tags"}], args.concurrency, args.requests * 4)
+    finally:
+        # 런처가 SIGTERM을 받으면 워커도 함께 종료
+        bridge.terminate()
+        bridge.wait(10)
+
+    return {
+        "workers": workers,
+        "streaming": streaming,
+        "cpu_us_per_token": round((cpu_after - cpu_before) / streaming["tokens"] * 1_000_000, 2) if streaming["tokens"] else None,
+        "tags": summarize(tags_results, tags_elapsed),
+    }
+
+
+async def run_benchmarks(args):
+    trace = load_trace(args.trace)
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    counts = [cpus if item.strip() == "auto" else int(item) for item in args.workers.split(",") if item.strip()]
+    upstreams = [f"http://127.0.0.1:{args.fake_port + i}" for i in range(args.fake_instances or max(counts))]
+
+    fakes = [start_process([
+        sys.executable, os.path.join(BENCH_DIR, "fake_vllm.py"), "--port", url.rsplit(":", 1)[1],
+        "--models", args.model, "--ttft-ms", str(args.ttft_ms), "--tokens-per-second", str(args.tokens_per_second),
+        "--tokens", str(args.tokens), "--jitter-ms", "0",
+    ]) for url in upstreams]
+    runs = []
+    try:
+        for fake, url in zip(fakes, upstreams):
+            await wait_ready(fake, f"{url}/health")
+        for workers in counts:
+            runs.append(await measure_workers(args, workers, upstreams, trace))
+    finally:
+        for fake in fakes:
+            fake.terminate()
+            fake.wait(10)
+
+    base = runs[0]["streaming"]["tokens_per_s"]
+    for run in runs:
+        run["tokens_per_s_speedup"] = round(run["streaming"]["tokens_per_s"] / base, 2) if base else None
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": cpus},
+        "config": {
+            "trace": os.path.relpath(args.trace, REPO_DIR), "concurrency": args.concurrency, "requests": args.requests,
+            "ttft_ms": args.ttft_ms, "tokens_per_second": args.tokens_per_second, "tokens": args.tokens,
+            "fake_instances": len(upstreams),
+        },
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="브릿지 워커 수 비교 벤치마크 (가짜 vLLM 사용, GPU 불필요)")
+    parser.add_argument("--trace", default=os.path.join(BENCH_DIR, "traces", "chat_mix.jsonl"))
+    parser.add_argument("--model", default="fake-model", help="가짜 vLLM이 제공할 모델 ID (트레이스의 model과 일치해야 함)")
+    parser.add_argument("--workers", default="1,auto", help="비교할 워커 수 목록 (auto = 사용 가능한 CPU 수), 첫 값이 속도 비교 기준")
+    parser.add_argument("--concurrency", type=int, default=128)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--ttft-ms", type=float, default=20.0)
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="가짜 vLLM 토큰 속도 (0 = 지연 없음, 브릿지 CPU가 병목이 되도록)")
+    parser.add_argument("--tokens", type=int, default=128)
+    parser.add_argument("--fake-instances", type=int, default=0, help="가짜 vLLM 프로세스 수 (0 = 가장 큰 워커 수)")
+    parser.add_argument("--fake-port", type=int, default=18100, help="첫 가짜 vLLM 포트 (이후 1씩 증가)")
+    parser.add_argument("--bridge-port", type=int, default=18534)
+    parser.add_argument("--output", default="workers_report.json")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmarks(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    print(json.dumps([{
+        "workers": run["workers"],
+        "tokens_per_s": run["streaming"]["tokens_per_s"],
+        "tokens_per_s_speedup": run["tokens_per_s_speedup"],
+        "ttft_p99_ms": run["streaming"]["ttft_ms"]["p99"],
+        "cpu_us_per_token": run["cpu_us_per_token"],
+        "tags_requests_per_s": run["tags"]["requests_per_s"],
+    } for run in report["runs"]], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# ===============================================================
+# tests/test_hedge.py
+# hedge 요청이 끝난 뒤 진 쪽 업스트림 커넥션이 풀에 반납되는지 확인
+# CMD: python -m unittest discover tests   (또는 python -m pytest tests)
+# → 느린 노드(첫 토큰 지연)와 빠른 노드를 로컬 소켓 서버로 띄우고 hedged_events를 끝까지 소비
+# ===============================================================
+
+# --- 라이브러리 임포트 ---
+import asyncio  # 비동기 처리
+import json  # JSON 처리
+import os  # 경로
+import sys  # 모듈 경로
+import unittest  # 테스트 실행
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vllm_ollama_bridge"))
+import vllm_ollama_bridge_server as bridge  # noqa: E402
+
+
+class FakeUpstream:
+    # 응답 헤더는 바로 보내고 첫 토큰만 first_token_delay초 늦게 보내는 최소한의 SSE 서버
+    def __init__(self, first_token_delay):
+        self.first_token_delay = first_token_delay
+        self.disconnected = asyncio.Event()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return "http://127.0.0.1:%d" % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":", 1)[1])
+            await reader.readexactly(length)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+            await writer.drain()
+            # 클라이언트가 커넥션을 닫으면 read가 EOF를 돌려주므로 지연 중에도 끊김을 감지
+            try:
+                await asyncio.wait_for(reader.read(1), self.first_token_delay)
+                self.disconnected.set()
+                return
+            except TimeoutError:
+                pass
+            chunks = [
+                {"created": 0, "choices": [{"index": 0, "delta": {"content": "hi"}, "finish_reason": None}]},
+                {"created": 0, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": {"prompt_tokens": 1, "completion_tokens": 1}},
+            ]
+            for data in [json.dumps(c).encode() for c in chunks] + [b"[DONE]"]:
+                event = b"data: " + data + b"\n\n"
+                writer.write(b"%x\r\n%s\r\n" % (len(event), event))
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            # keep-alive: 클라이언트가 커넥션을 닫을 때까지 유지
+            await reader.read()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class HedgeReleaseTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.slow = FakeUpstream(first_token_delay=30)
+        self.fast = FakeUpstream(first_token_delay=0)
+        slow_url = await self.slow.start()
+        fast_url = await self.fast.start()
+        self.saved = (bridge.upstream_registry, bridge.upstream_client)
+        bridge.upstream_registry = bridge.UpstreamRegistry([slow_url, fast_url])
+        bridge.upstream_client = None  # 테스트 이벤트 루프에서 새로 생성
+
+    async def asyncTearDown(self):
+        await bridge.get_upstream_client().aclose()
+        bridge.upstream_registry, bridge.upstream_client = self.saved
+        await self.slow.stop()
+        await self.fast.stop()
+
+    async def test_loser_connection_released(self):
+        slow_node, fast_node = bridge.upstream_registry.nodes
+        payload = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+        won_before = bridge.hedge_policy.stats["won"]
+
+        events = [event async for event in bridge.hedged_events(slow_node, payload, [], 0.05)]
+
+        self.assertEqual(events[0][:1] + events[0][2:], ("start", fast_node.base_url))
+        self.assertEqual([e[0] for e in events[1:]], ["delta", "done"])
+        self.assertEqual(bridge.hedge_policy.stats["won"], won_before + 1)
+        # 진 쪽 요청은 취소와 동시에 커넥션까지 닫혀 있어야 함 (풀에 사용 중으로 남으면 이후 요청이 막힘)
+        self.assertEqual(bridge.upstream_pool_stats()["active"], 0)
+        await asyncio.wait_for(self.slow.disconnected.wait(), 5)
+        self.assertEqual(slow_node.outstanding, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
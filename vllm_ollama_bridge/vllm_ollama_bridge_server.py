@@ -1,31 +1,885 @@
 # ===============================================================
 # vllm_ollama_bridge_server.py
 # CMD: uvicorn vllm_ollama_bridge.vllm_ollama_bridge_server:app --reload --port 11434
+# CMD (멀티 워커): python vllm_ollama_bridge_server.py
 # ===============================================================
 
 # --- 라이브러리 임포트 ---
 from fastapi import FastAPI, Request, Response  # 웹 서버 구성 및 요청 객체
 from fastapi.responses import JSONResponse, StreamingResponse  # 다양한 HTTP 응답 형식
-from pydantic import BaseModel  # 요청/응답 데이터 구조 정의용
+from pydantic import BaseModel, ConfigDict, StrictBool, ValidationError, field_validator  # 요청/응답 데이터 구조 정의용 (JSON 파싱 + 검증을 한 번에)
+from typing import NotRequired, TypedDict  # 메시지는 dict 그대로 유지 (vLLM 요청에 복사 없이 전달)
 import httpx  # 비동기 HTTP 클라이언트
+import uvicorn  # ASGI 서버 (멀티 워커 런처)
 import time  # 시간 측정용
 import json  # JSON 처리
 import asyncio  # 비동기 처리
+import os  # 환경변수 기반 설정
+import importlib.util  # 선택적 의존성(h2 등) 설치 여부 확인
+import logging  # 구조화 로깅
+import logging.handlers  # 큐 기반 비동기 로그 핸들러
+import queue  # 로그 레코드 전달용 큐
+import contextvars  # 요청별 ID / 로그 필드 전달
+import threading  # 공유 상태 서버 스레드
+import socket  # 공유 상태 서버 unix socket
+import tempfile  # 공유 상태 socket 기본 경로
+import random  # 토큰 로그 샘플링
+import uuid  # 요청 ID 생성
+import hashlib  # 요청 payload 해시 (캐시 키)
+import concurrent.futures  # 토큰화 전용 스레드 풀
+from collections import OrderedDict  # LRU 캐시
+import atexit  # 종료 시 로그 큐 비우기
+import math  # Retry-After 계산
+import bisect  # 히스토그램 버킷 검색
+import array  # 임베딩 캐시의 벡터 저장 (float 리스트보다 작음)
+import zlib  # gzip 요청 본문 해제 / 응답 압축
+from collections import deque  # 최근 대기 시간 기록
+from contextlib import asynccontextmanager, aclosing  # 앱 lifespan 훅 / 비동기 제너레이터 정리
 from datetime import datetime, timezone  # 시간 및 타임존 처리
 
-# --- FastAPI 애플리케이션 인스턴스 생성 ---
-app = FastAPI()
+
+
+
+
+# ===============================================================
+# 환경변수 읽기 헬퍼 (값이 없거나 잘못되면 기본값 사용)
+# ===============================================================
+def env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# ===============================================================
+# "model=value,model=value" 형식의 모델별 설정값 파싱
+# ===============================================================
+def parse_model_map(value, cast):
+    result = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        model, raw = item.rsplit("=", 1)
+        try:
+            result[model.strip()] = cast(raw.strip())
+        except (TypeError, ValueError):
+            continue
+    return result
+
+
+# ===============================================================
+# 멀티 워커 모드에서 전체 한도를 워커 수로 나눠 각 워커에 배분 (0 이하 = 무제한은 그대로)
+# ===============================================================
+def split_worker_limit(limit):
+    return math.ceil(limit / WORKER_COUNT) if limit > 0 else limit
+
+
+
+
+
+# ===============================================================
+# 로깅 설정
+# → 로그는 큐에 넣기만 하고 실제 출력은 별도 스레드(QueueListener)가 담당하여
+#   스트리밍 중 stdout 쓰기가 이벤트 루프를 막지 않도록 함
+# → production 프로필: 요청당 요약 1줄 / debug 프로필: 요청 본문 + 토큰 로그
+# ===============================================================
+LOG_PROFILE = os.environ.get("BRIDGE_LOG_PROFILE", "production").strip().lower()  # production | debug
+LOG_LEVEL = os.environ.get("BRIDGE_LOG_LEVEL", "DEBUG" if LOG_PROFILE == "debug" else "INFO").upper()
+LOG_FORMAT = os.environ.get("BRIDGE_LOG_FORMAT", "text").strip().lower()  # text | json
+LOG_TOKEN_SAMPLE_RATE = env_float("BRIDGE_LOG_TOKEN_SAMPLE_RATE", 1.0 if LOG_PROFILE == "debug" else 0.0)  # 토큰 로그 샘플링 비율 (0 = 끔)
+LOG_BODY_BYTES = env_int("BRIDGE_LOG_BODY_BYTES", 2048 if LOG_PROFILE == "debug" else 0)  # 요청 본문 로그 최대 바이트 (0 = 끔)
+
+# --- 요청 단위 로그 컨텍스트 (미들웨어에서 설정, 핸들러는 dict에 필드만 추가) ---
+request_id_var = contextvars.ContextVar("request_id", default="-")
+request_log_fields_var = contextvars.ContextVar("request_log_fields", default=None)
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        timestamp = datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds")
+        if LOG_FORMAT == "json":
+            entry = {"ts": timestamp, "level": record.levelname, "request_id": record.request_id, "msg": record.getMessage(), **fields}
+            if record.exc_info:
+                entry["exc"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = f"{timestamp} {record.levelname} [{record.request_id}] {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+def setup_logging():
+    logger = logging.getLogger("vllm_ollama_bridge")
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())  # contextvar는 요청 스레드에서 읽어야 하므로 큐 투입 전에 적용
+    logger.handlers = [queue_handler]
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(StructuredFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
+    return logger
+
+
+log = setup_logging()
+LOG_TOKENS = LOG_TOKEN_SAMPLE_RATE > 0 and log.isEnabledFor(logging.DEBUG)  # 토큰 단위 로그 사용 여부 (핫패스 분기용)
+
+
+def should_log_token():
+    return LOG_TOKENS and (LOG_TOKEN_SAMPLE_RATE >= 1.0 or random.random() < LOG_TOKEN_SAMPLE_RATE)
+
+
+def add_request_log_fields(**fields):
+    # 요청 요약 로그에 포함될 필드 추가 (요청 컨텍스트 밖이면 무시)
+    log_fields = request_log_fields_var.get()
+    if log_fields is not None:
+        log_fields.update(fields)
+
+
+# ===============================================================
+# Prometheus 메트릭 (텍스트 노출 형식, 외부 의존성 없음)
+# → 라벨 값 튜플별로 값을 보관하고 /metrics 요청 시 텍스트로 변환
+# → 멀티 워커 모드: 워커별 값을 공유 상태 서버로 보내고, /metrics는 모든 워커의 값을 합산해 출력
+#   (counter / gauge는 합계, histogram은 버킷별 합계)
+# ===============================================================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+INTER_TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0)
+OVERHEAD_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 30, 40, 60, 80, 100, 150, 200, 300, 500)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{n}="{escape_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        METRICS.append(self)
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in (self.values if values is None else values).items():
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) - amount
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            # [버킷별 개수..., 합계, 개수]
+            series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, series in (self.values if values is None else values).items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, f'le="{bound}"')} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, 'le="+Inf"')} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {series[-1]}")
+        return lines
+
+
+METRICS = []
+metric_http_requests = Counter("bridge_http_requests_total", "HTTP requests handled by the bridge", ("path", "status"))
+metric_ttft = Histogram("bridge_time_to_first_token_seconds", "Bridge request start to first chunk sent to the client", ("model", "upstream"))
+metric_upstream_ttft = Histogram("bridge_upstream_time_to_first_token_seconds", "Upstream request sent to first token received", ("model", "upstream"))
+metric_inter_token = Histogram("bridge_inter_token_latency_seconds", "Gap between consecutive upstream tokens", ("model", "upstream"), INTER_TOKEN_BUCKETS)
+metric_overhead = Histogram("bridge_overhead_seconds", "Upstream byte received to client chunk handed to the server", ("model", "upstream"), OVERHEAD_BUCKETS)
+metric_upstream_latency = Histogram("bridge_upstream_latency_seconds", "Upstream request sent to generation done", ("model", "upstream"))
+metric_tokens_per_second = Histogram("bridge_tokens_per_second", "Generation throughput after the first token", ("model", "upstream"), TOKENS_PER_SECOND_BUCKETS)
+metric_errors = Counter("bridge_errors_total", "Errors by type", ("type",))
+metric_coalesced_frames_saved = Counter("bridge_coalesced_frames_saved_total", "Streamed deltas merged into an earlier NDJSON frame instead of sent on their own", ("model",))
+metric_active_streams = Gauge("bridge_active_streams", "Streaming responses currently being sent", ("model",))
+metric_queue_depth = Gauge("bridge_admission_queue_depth", "Requests waiting for an admission slot")
+metric_active_generations = Gauge("bridge_active_generations", "Generations currently running against vLLM")
+metric_prefix_warm_set = Gauge("bridge_prefix_warm_set_size", "Hot prompt prefixes eligible for cache warming")
+metric_prefix_warm_requests = Counter("bridge_prefix_warm_requests_total", "max_tokens=1 warm-up requests sent to vLLM", ("model", "result"))
+metric_prefill_saved = Counter("bridge_prefix_prefill_saved_seconds_total", "Estimated prefill time saved for the first request after a warm-up", ("model",))
+metric_compression_saved = Counter("bridge_compression_bytes_saved_total", "Bytes saved by HTTP compression", ("kind", "encoding"))
+metric_compression_cpu = Counter("bridge_compression_cpu_seconds_total", "CPU time spent compressing and decompressing HTTP bodies", ("kind", "encoding"))
+metric_upstream_timeouts = Counter("bridge_upstream_timeouts_total", "Streaming upstream requests aborted by a timeout budget", ("phase",))
+metric_upstream_retries = Counter("bridge_upstream_retries_total", "Upstream retries before the first token", ("result",))
+metric_hedges = Counter("bridge_hedged_requests_total", "Duplicate upstream requests fired after a slow first token", ("result",))
+
+
+def classify_error(exc):
+    if isinstance(exc, httpx.TimeoutException):
+        return "upstream_timeout"
+    if isinstance(exc, httpx.ConnectError):
+        return "upstream_connect"
+    if isinstance(exc, httpx.RequestError):
+        return "upstream_request"
+    if isinstance(exc, httpx.HTTPStatusError):
+        return f"upstream_http_{exc.response.status_code // 100}xx"
+    return "bridge_internal"
+
+
+def sample_metric_gauges():
+    # 수집 시점 값은 출력 / 전송 직전에 갱신
+    metric_queue_depth.set(len(admission.waiters))
+    metric_active_generations.set(admission.active)
+    metric_prefix_warm_set.set(prefix_tracker.warm_set_size())
+
+
+def export_metrics():
+    # JSON으로 보낼 수 있도록 {이름: [[라벨 값 목록, 값], ...]} 형태로 변환
+    return {metric.name: [[list(labels), value] for labels, value in metric.values.items()] for metric in METRICS}
+
+
+def merge_metric_exports(exports):
+    merged = {}
+    for export in exports:
+        for name, series in export.items():
+            values = merged.setdefault(name, {})
+            for labels, value in series:
+                key = tuple(labels)
+                current = values.get(key)
+                if current is None:
+                    values[key] = value
+                elif isinstance(value, list):
+                    values[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    values[key] = current + value
+    return merged
+
+
+def render_metrics(merged=None):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render(None if merged is None else merged.get(metric.name, {})))
+    return "\n".join(lines) + "\n"
+
 
 # --- vLLM 서버의 API URL 정의 ---
-VLLM_MODELS_URL = "http://vllm_server:8000/v1/models"  # 모델 목록 조회
-VLLM_API_URL = "http://vllm_server:8000/v1/chat/completions"  # 채팅 API
+VLLM_UPSTREAMS = [u.strip().rstrip("/") for u in os.environ.get("BRIDGE_UPSTREAMS", "http://vllm_server:8000").split(",") if u.strip()]  # vLLM 복제본 목록
+VLLM_MODELS_PATH = "/v1/models"  # 모델 목록 조회
+VLLM_API_PATH = "/v1/chat/completions"  # 채팅 API
+VLLM_EMBEDDINGS_PATH = "/v1/embeddings"  # 임베딩 API
+
+# --- 업스트림 헬스체크 / 라우팅 설정 ---
+UPSTREAM_HEALTH_INTERVAL = env_float("BRIDGE_UPSTREAM_HEALTH_INTERVAL", 10.0)  # 헬스체크 주기 (초)
+UPSTREAM_HEALTH_TIMEOUT = env_float("BRIDGE_UPSTREAM_HEALTH_TIMEOUT", 3.0)  # 헬스체크 타임아웃 (초)
+UPSTREAM_EJECT_AFTER_FAILURES = env_int("BRIDGE_UPSTREAM_EJECT_AFTER_FAILURES", 2)  # 연속 실패 시 라우팅에서 제외
+UPSTREAM_ROUTING = os.environ.get("BRIDGE_UPSTREAM_ROUTING", "least_outstanding").strip().lower()  # least_outstanding | prefix_hash
+UPSTREAM_PREFIX_MAX_IMBALANCE = env_int("BRIDGE_UPSTREAM_PREFIX_MAX_IMBALANCE", 8)  # prefix_hash 대상이 최소 부하보다 이만큼 더 바쁘면 least_outstanding으로 전환
+
+# --- vLLM 업스트림 커넥션 풀 설정 ---
+# IDE 자동완성처럼 짧은 요청이 잦으므로 keep-alive 커넥션을 재사용
+UPSTREAM_MAX_CONNECTIONS = env_int("BRIDGE_UPSTREAM_MAX_CONNECTIONS", 100)  # 동시 커넥션 상한
+UPSTREAM_MAX_KEEPALIVE = env_int("BRIDGE_UPSTREAM_MAX_KEEPALIVE", 20)  # 유휴 상태로 유지할 커넥션 수
+UPSTREAM_KEEPALIVE_EXPIRY = env_float("BRIDGE_UPSTREAM_KEEPALIVE_EXPIRY", 30.0)  # 유휴 커넥션 만료 (초)
+UPSTREAM_HTTP2 = env_bool("BRIDGE_UPSTREAM_HTTP2", False)  # HTTP/2 사용 여부 (h2 패키지 필요)
+UPSTREAM_CONNECT_TIMEOUT = env_float("BRIDGE_UPSTREAM_CONNECT_TIMEOUT", 5.0)  # 연결 타임아웃 (초)
+UPSTREAM_READ_TIMEOUT = env_float("BRIDGE_UPSTREAM_READ_TIMEOUT", 0.0)  # 읽기 타임아웃 (초, 0 = 무제한)
+UPSTREAM_POOL_TIMEOUT = env_float("BRIDGE_UPSTREAM_POOL_TIMEOUT", 0.0)  # 풀에서 커넥션 대기 타임아웃 (초, 0 = 무제한)
+
+# --- 스트리밍 채팅 타임아웃 / 재시도 / hedge 설정 ---
+# 멈춘 vLLM 요청이 IDE를 무한정 붙잡지 않도록 단계별 시간 예산을 두고, 첫 토큰 전 실패만 재시도
+UPSTREAM_FIRST_TOKEN_TIMEOUT = env_float("BRIDGE_UPSTREAM_FIRST_TOKEN_TIMEOUT", 120.0)  # 요청 전송 → 첫 토큰 (초, 0 = 무제한, 긴 prefill / vLLM 대기열 포함)
+UPSTREAM_CHUNK_TIMEOUT = env_float("BRIDGE_UPSTREAM_CHUNK_TIMEOUT", 60.0)  # 첫 토큰 이후 청크 사이 최대 간격 (초, 0 = 무제한)
+UPSTREAM_RETRIES = env_int("BRIDGE_UPSTREAM_RETRIES", 2)  # 첫 토큰 전 실패 시 추가 시도 횟수 (다른 노드 fail-over 포함)
+UPSTREAM_RETRY_BACKOFF_MS = env_float("BRIDGE_UPSTREAM_RETRY_BACKOFF_MS", 100.0)  # 같은 노드 재시도 전 대기 기준값 (지수 증가 + full jitter)
+UPSTREAM_RETRY_BACKOFF_MAX_MS = env_float("BRIDGE_UPSTREAM_RETRY_BACKOFF_MAX_MS", 2000.0)  # 재시도 대기 상한
+RETRY_BUDGET_RATIO = env_float("BRIDGE_RETRY_BUDGET_RATIO", 0.2)  # 최근 10초 요청 수 대비 허용하는 재시도 + hedge 비율 (0.2 = 최대 20% 추가 부하)
+RETRY_BUDGET_MIN_PER_SECOND = env_float("BRIDGE_RETRY_BUDGET_MIN_PER_SECOND", 1.0)  # 요청이 적을 때도 허용하는 초당 최소 재시도 수
+HEDGE_PERCENTILE = env_float("BRIDGE_HEDGE_PERCENTILE", 0.0)  # 첫 토큰이 모델별 최근 TTFT의 이 백분위를 넘으면 복제 요청 (0 = 끔, 예: 95)
+HEDGE_MIN_DELAY_MS = env_float("BRIDGE_HEDGE_MIN_DELAY_MS", 200.0)  # hedge 대기 시간 하한 (짧은 TTFT에서 과도한 복제 방지)
+HEDGE_MIN_SAMPLES = env_int("BRIDGE_HEDGE_MIN_SAMPLES", 20)  # 백분위를 계산하기 전 필요한 최소 TTFT 표본 수
+HEDGE_WINDOW = env_int("BRIDGE_HEDGE_WINDOW", 256)  # 모델별로 보관하는 최근 TTFT 표본 수
+HEDGE_WINDOW_SECONDS = env_float("BRIDGE_HEDGE_WINDOW_SECONDS", 60.0)  # 이보다 오래된 TTFT 표본은 기준 계산에서 제외
+
+# --- 앱 전역에서 공유하는 vLLM 업스트림 클라이언트 (lifespan에서 생성/종료) ---
+upstream_client = None
+
 
-# --- 모델 로딩 시간의 기본 추정치 (나노초) ---
-# 20GB 모델을 5GB/s 속도로 로딩한다고 가정 → 약 4초
-ESTIMATED_MODEL_LOAD_DURATION_NS = 4_000_000_000
 
-# --- 모델별 실제 로딩 시간 기록용 딕셔너리 ---
-model_load_durations = {}
+
+
+# ===============================================================
+# 공유 업스트림 클라이언트 생성
+# → 요청마다 AsyncClient를 만들지 않고, 하나의 커넥션 풀을 모든 vLLM 호출이 함께 사용
+# ===============================================================
+def create_upstream_client():
+    http2 = UPSTREAM_HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        log.warning("BRIDGE_UPSTREAM_HTTP2 설정됨, 그러나 h2 패키지가 없어 HTTP/1.1로 동작")
+        http2 = False
+    limits = httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=UPSTREAM_CONNECT_TIMEOUT,
+        read=UPSTREAM_READ_TIMEOUT or None,
+        write=UPSTREAM_CONNECT_TIMEOUT,
+        pool=UPSTREAM_POOL_TIMEOUT or None,
+    )
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+
+def get_upstream_client():
+    global upstream_client
+    # lifespan을 거치지 않는 실행 환경(테스트 클라이언트 등)을 위한 지연 생성
+    if upstream_client is None:
+        upstream_client = create_upstream_client()
+    return upstream_client
+
+
+# ===============================================================
+# 업스트림 커넥션 풀 사용 현황 (풀 크기 산정용)
+# → httpx 내부의 httpcore 풀 상태를 읽으며, 구조가 다르면 빈 값 반환
+# ===============================================================
+def upstream_pool_stats():
+    stats = {
+        "max_connections": UPSTREAM_MAX_CONNECTIONS,
+        "max_keepalive": UPSTREAM_MAX_KEEPALIVE,
+        "http2": False,
+        "open": 0,
+        "idle": 0,
+        "active": 0,
+        "waiting": 0,
+    }
+    pool = getattr(getattr(upstream_client, "_transport", None), "_pool", None)
+    if pool is None:
+        return stats
+    try:
+        connections = list(pool.connections)
+        requests = list(getattr(pool, "_requests", []))
+        stats["http2"] = bool(getattr(pool, "_http2", False))
+        stats["open"] = sum(1 for c in connections if not c.is_closed())
+        stats["idle"] = sum(1 for c in connections if c.is_idle())
+        stats["active"] = stats["open"] - stats["idle"]
+        stats["waiting"] = sum(1 for r in requests if r.is_queued())
+    except Exception as exc:
+        log.warning("커넥션 풀 통계 수집 실패", extra={"fields": {"error": exc}})
+    return stats
+
+
+# ===============================================================
+# vLLM 업스트림 레지스트리
+# → 복제본별 헬스체크(/v1/models)로 상태와 서비스 중인 모델 목록을 학습
+# → 채팅 요청은 해당 모델을 가진 정상 노드 중 처리 중 요청이 가장 적은 노드로 라우팅
+#   (prefix_hash 모드에서는 대화 앞부분 해시로 노드를 고정하여 vLLM prefix cache 적중 유지)
+# → 연속 실패 노드는 자동 제외, 헬스체크 성공 시 복귀
+# ===============================================================
+class Upstream:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.healthy = True  # 첫 헬스체크 전에는 정상으로 간주
+        self.models = set()
+        self.raw_models = []
+        self.outstanding = 0  # 처리 중인 요청 수
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.stats = {"requests": 0, "failures": 0, "ejections": 0, "recoveries": 0}
+
+    def url(self, path):
+        return self.base_url + path
+
+    def snapshot(self):
+        return {
+            "url": self.base_url,
+            "healthy": self.healthy,
+            "models": sorted(self.models),
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            **self.stats,
+        }
+
+
+class UpstreamRegistry:
+    def __init__(self, base_urls):
+        self.nodes = [Upstream(url) for url in base_urls]
+
+    def candidates(self, model, exclude=()):
+        nodes = [n for n in self.nodes if n not in exclude]
+        # 모델 매핑을 아직 모르는 경우(첫 헬스체크 전 등)에는 모든 노드가 후보
+        if any(model in n.models for n in self.nodes):
+            nodes = [n for n in nodes if model in n.models]
+        # 정상 노드가 없으면 마지막 수단으로 제외된 노드에도 시도
+        return [n for n in nodes if n.healthy] or nodes
+
+    def pick(self, model, affinity_key=None, exclude=()):
+        nodes = self.candidates(model, exclude)
+        if not nodes:
+            return None
+        least = min(nodes, key=lambda n: n.outstanding)
+        if affinity_key is None or UPSTREAM_ROUTING != "prefix_hash" or len(nodes) == 1:
+            return least
+        # rendezvous hashing: 노드 추가/제외 시에도 나머지 prefix의 배치가 유지됨
+        preferred = max(nodes, key=lambda n: hashlib.blake2b(f"{affinity_key}|{n.base_url}".encode(), digest_size=8).digest())
+        if preferred.outstanding - least.outstanding > UPSTREAM_PREFIX_MAX_IMBALANCE:
+            return least
+        return preferred
+
+    def record_success(self, node):
+        node.consecutive_failures = 0
+
+    def record_failure(self, node, exc):
+        node.stats["failures"] += 1
+        node.consecutive_failures += 1
+        node.last_error = str(exc)[:200]
+        if node.healthy and node.consecutive_failures >= UPSTREAM_EJECT_AFTER_FAILURES:
+            node.healthy = False
+            node.stats["ejections"] += 1
+            log.warning("업스트림 라우팅 제외 (연속 실패)", extra={"fields": {"upstream": node.base_url, "error": node.last_error}})
+
+    async def check(self, node):
+        try:
+            resp = await get_upstream_client().get(node.url(VLLM_MODELS_PATH), timeout=UPSTREAM_HEALTH_TIMEOUT)
+            resp.raise_for_status()
+            models = resp.json().get("data", [])
+        except Exception as exc:
+            self.record_failure(node, exc)
+            raise
+        node.raw_models = models
+        node.models = {m.get("id") for m in models}
+        node.consecutive_failures = 0
+        if not node.healthy:
+            node.healthy = True
+            node.stats["recoveries"] += 1
+            log.info("업스트림 복귀", extra={"fields": {"upstream": node.base_url}})
+            # 재시작된 vLLM은 prefix 캐시가 비어 있으므로 자주 쓰이는 prefix를 다시 채움
+            prefix_warmer.schedule("upstream_recovered", node=node)
+        return models
+
+    async def refresh(self):
+        # 모든 노드를 동시에 확인하고 모델 목록을 id 기준으로 병합; 전부 실패하면 마지막 오류를 전달
+        results = await asyncio.gather(*(self.check(n) for n in self.nodes), return_exceptions=True)
+        merged = {}
+        errors = []
+        for result in results:
+            if isinstance(result, BaseException):
+                errors.append(result)
+                continue
+            for model in result:
+                merged.setdefault(model.get("id"), model)
+        if errors and len(errors) == len(results):
+            raise errors[-1]
+        return list(merged.values())
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(UPSTREAM_HEALTH_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as exc:
+                log.warning("모든 업스트림 헬스체크 실패", extra={"fields": {"error": exc}})
+
+    def snapshot(self):
+        return {"routing": UPSTREAM_ROUTING, "nodes": [n.snapshot() for n in self.nodes]}
+
+
+upstream_registry = UpstreamRegistry(VLLM_UPSTREAMS)
+
+
+def is_failover_error(exc):
+    # 연결 실패 / 서버 오류 / 모델 없음(404)은 다른 노드에서 재시도할 가치가 있음
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500 or exc.response.status_code == 404
+    return isinstance(exc, httpx.RequestError)
+
+
+def conversation_affinity_key(messages):
+    # 마지막 메시지를 제외한 대화 앞부분 (첫 턴이면 전체)
+    prefix = messages[:-1] if len(messages) > 1 else messages
+    encoded = json.dumps(prefix, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+
+
+
+# ===============================================================
+# 앱 lifespan: 시작 시 공유 클라이언트 생성 및 예열, 종료 시 커넥션 정리
+# ===============================================================
+@asynccontextmanager
+async def lifespan(app):
+    global upstream_client
+    upstream_client = create_upstream_client()
+    if SHARED_STATE_SOCKET and not shared_state.enabled():
+        log.warning("BRIDGE_STATE_SOCKET 설정됨, 그러나 워커가 1개라 공유 상태 서버 없이 워커별 상태로 동작", extra={"fields": {"socket": SHARED_STATE_SOCKET}})
+    await prewarm_upstreams()
+    health_task = asyncio.create_task(upstream_registry.health_loop())
+    metrics_task = asyncio.create_task(shared_state.push_metrics_loop()) if shared_state.enabled() else None
+    try:
+        yield
+    finally:
+        health_task.cancel()
+        if metrics_task is not None:
+            metrics_task.cancel()
+        shared_state.close()
+        token_counter.shutdown()
+        await upstream_client.aclose()
+        upstream_client = None
+
+
+# --- FastAPI 애플리케이션 인스턴스 생성 ---
+app = FastAPI(lifespan=lifespan)
+
+# --- 멀티 워커 실행 설정 (python vllm_ollama_bridge_server.py 로 실행할 때) ---
+# 워커들은 런처 프로세스의 공유 상태 서버(unix socket)를 통해 응답 캐시 / 모델 카탈로그 / 메트릭을 공유
+BRIDGE_HOST = os.environ.get("BRIDGE_HOST", "0.0.0.0")  # 바인드 주소
+BRIDGE_PORT = env_int("BRIDGE_PORT", 11434)  # 바인드 포트
+WORKERS = os.environ.get("BRIDGE_WORKERS", "auto").strip().lower()  # 워커 프로세스 수 (auto = 사용 가능한 CPU 수)
+WORKERS_MAX = env_int("BRIDGE_WORKERS_MAX", 8)  # auto일 때 최대 워커 수
+WORKER_COUNT = max(1, env_int("BRIDGE_WORKER_COUNT", 1))  # 런처가 워커에 알려주는 실제 워커 수 (동시 실행 한도 배분용)
+SHARED_STATE_SOCKET = os.environ.get("BRIDGE_STATE_SOCKET", "")  # 공유 상태 서버 socket 경로 (런처가 설정, 비어 있으면 워커별 상태)
+SHARED_STATE_TIMEOUT = env_float("BRIDGE_STATE_TIMEOUT", 0.5)  # 공유 상태 요청 타임아웃 (초, 초과 시 워커 로컬 상태 사용)
+METRICS_PUSH_INTERVAL = env_float("BRIDGE_METRICS_PUSH_INTERVAL", 1.0)  # 워커 메트릭을 공유 상태 서버로 보내는 주기 (초)
+PREWARM_CONNECTIONS = env_int("BRIDGE_PREWARM_CONNECTIONS", 4)  # 시작 시 업스트림마다 미리 열어 둘 keep-alive 커넥션 수 (0 = 끔)
+PREWARM_TIMEOUT = env_float("BRIDGE_PREWARM_TIMEOUT", 10.0)  # 시작 시 예열 최대 대기 시간 (초)
+
+# --- NDJSON 스트리밍 청크 병합(coalescing) 설정 ---
+# SSH 터널 너머로 토큰마다 작은 프레임을 보내는 대신, 짧은 시간창 동안의 delta를 하나의 청크로 병합
+# 첫 토큰은 TTFT 유지를 위해 항상 즉시 전송
+COALESCE_WINDOW_MS = env_float("BRIDGE_COALESCE_WINDOW_MS", 0.0)  # 병합 시간창 (ms, 0 = 끔)
+COALESCE_MAX_BYTES = env_int("BRIDGE_COALESCE_MAX_BYTES", 512)  # 버퍼가 이 크기에 도달하면 즉시 전송 (bytes)
+COALESCE_MODEL_WINDOWS = parse_model_map(os.environ.get("BRIDGE_COALESCE_MODELS", ""), float)  # 모델별 시간창, 예: "qwen=20,llama=0"
+COALESCE_HEADER = "x-bridge-coalesce-ms"  # 클라이언트별 시간창 지정 헤더
+
+# --- /api/chat 응답 캐시 및 동일 요청 공유 설정 ---
+RESPONSE_CACHE_MAX_BYTES = env_int("BRIDGE_RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)  # 캐시 바이트 예산 (0 = 끔)
+RESPONSE_CACHE_TTL = env_float("BRIDGE_RESPONSE_CACHE_TTL", 300.0)  # 캐시 항목 유효 시간 (초)
+INFLIGHT_DEDUP = os.environ.get("BRIDGE_INFLIGHT_DEDUP", "deterministic").strip().lower()  # deterministic | all | off
+
+# --- 클라이언트 연결 종료 / 생성 시간 제한 설정 ---
+MAX_GENERATION_SECONDS = env_float("BRIDGE_MAX_GENERATION_SECONDS", 0.0)  # 요청당 최대 생성 시간 (초, 0 = 무제한)
+ABORT_EXPECTED_TOKENS = env_int("BRIDGE_ABORT_EXPECTED_TOKENS", 256)  # 절약 토큰 추정용 초기 평균 생성 길이
+
+# --- 동시 실행 제한 및 우선순위 대기열 설정 ---
+# vLLM 큐가 무한정 길어지지 않도록 브릿지에서 먼저 요청을 조절
+# 멀티 워커 모드에서는 아래 한도를 워커 수로 나눠 각 워커에 적용
+ADMISSION_MAX_CONCURRENT = split_worker_limit(env_int("BRIDGE_MAX_CONCURRENT", 64))  # 전체 동시 생성 수 (0 = 무제한)
+ADMISSION_MAX_CONCURRENT_PER_MODEL = split_worker_limit(env_int("BRIDGE_MAX_CONCURRENT_PER_MODEL", 0))  # 모델별 기본 동시 생성 수 (0 = 무제한)
+ADMISSION_MODEL_LIMITS = {model: split_worker_limit(limit) for model, limit in parse_model_map(os.environ.get("BRIDGE_MODEL_CONCURRENCY", ""), int).items()}  # 모델별 동시 생성 수, 예: "qwen=8"
+ADMISSION_QUEUE_MAX = split_worker_limit(env_int("BRIDGE_QUEUE_MAX", 256))  # 대기열 최대 길이 (초과 시 429)
+ADMISSION_QUEUE_TIMEOUT = env_float("BRIDGE_QUEUE_TIMEOUT", 30.0)  # 대기열 최대 대기 시간 (초과 시 503)
+PRIORITY_CLASSES = ("interactive", "batch", "background")  # 앞쪽일수록 먼저 처리
+PRIORITY_HEADER = "x-bridge-priority"  # 클라이언트가 우선순위를 지정하는 헤더
+PRIORITY_MODEL_CLASSES = parse_model_map(os.environ.get("BRIDGE_MODEL_PRIORITY", ""), str)  # 모델별 우선순위, 예: "big-model=batch"
+PRIORITY_LONG_PROMPT_CHARS = env_int("BRIDGE_LONG_PROMPT_CHARS", 32000)  # 이 길이 이상의 프롬프트는 batch로 분류 (0 = 끔)
+CLIENT_ID_HEADER = "x-client-id"  # 공정 분배 기준이 되는 클라이언트 식별 헤더 (없으면 접속 IP)
+
+# --- 모델 카탈로그(/api/tags) 캐시 설정 ---
+CATALOG_TTL = env_float("BRIDGE_CATALOG_TTL", 5.0)  # 캐시를 신선하다고 보는 시간 (초)
+CATALOG_SWR_WINDOW = env_float("BRIDGE_CATALOG_SWR_WINDOW", 60.0)  # TTL 만료 후 stale 응답 + 백그라운드 갱신 허용 구간 (초)
+CATALOG_SERVE_STALE_MAX_AGE = env_float("BRIDGE_CATALOG_SERVE_STALE_MAX_AGE", 600.0)  # vLLM 장애 시 stale 응답 허용 최대 나이 (초, 0 = 사용 안 함)
+
+# --- 자주 쓰이는 prompt prefix 추적 / vLLM prefix 캐시 예열 설정 ---
+PREFIX_WARM_TOP = env_int("BRIDGE_PREFIX_WARM_TOP", 8)  # 모델별로 예열할 상위 prefix 수 (0 = 추적/예열 끔)
+PREFIX_TRACK_SIZE = env_int("BRIDGE_PREFIX_TRACK_SIZE", 64)  # 메시지까지 보관하는 상위 prefix 후보 수
+PREFIX_DEPTH = env_int("BRIDGE_PREFIX_DEPTH", 2)  # prefix로 볼 앞쪽 메시지 최대 개수
+PREFIX_MIN_CHARS = env_int("BRIDGE_PREFIX_MIN_CHARS", 2000)  # 이보다 짧은 prefix는 예열 효과가 작아 추적하지 않음
+PREFIX_MIN_COUNT = env_int("BRIDGE_PREFIX_MIN_COUNT", 3)  # 예열 대상이 되기 위한 최소 관측 횟수
+PREFIX_SKETCH_WIDTH = 4096  # count-min sketch 행당 카운터 수
+
+# --- 임베딩(/api/embed, /api/embeddings) 설정 ---
+# 동시에 들어온 같은 모델의 임베딩 입력을 짧은 시간창 동안 모아 vLLM에 한 번에 요청
+EMBED_BATCH_WINDOW_MS = env_float("BRIDGE_EMBED_BATCH_WINDOW_MS", 5.0)  # 배치 수집 시간창 (ms)
+EMBED_BATCH_MAX_INPUTS = env_int("BRIDGE_EMBED_BATCH_MAX_INPUTS", 64)  # 배치당 최대 입력 수 (도달 시 즉시 전송)
+EMBED_CACHE_MAX_BYTES = env_int("BRIDGE_EMBED_CACHE_MAX_BYTES", 64 * 1024 * 1024)  # 임베딩 캐시 바이트 예산 (0 = 끔)
+EMBED_TRUNCATE_TOKENS = env_int("BRIDGE_EMBED_TRUNCATE_TOKENS", 0)  # truncate=true 요청 시 vLLM truncate_prompt_tokens 값 (0 = 보내지 않음)
+
+# --- 요청 본문 제한 ---
+# IDE 요청은 소스 파일 전체를 담는 경우가 많으므로 넉넉하게, 그러나 무제한으로 메모리를 쓰지 않도록 제한
+MAX_BODY_BYTES = env_int("BRIDGE_MAX_BODY_BYTES", 32 * 1024 * 1024)  # 요청 본문 최대 크기 (초과 시 413, 0 = 무제한)
+MAX_MESSAGES = env_int("BRIDGE_MAX_MESSAGES", 1024)  # /api/chat 요청당 최대 메시지 수 (초과 시 413, 0 = 무제한)
+
+# --- HTTP 압축 설정 ---
+# SSH 터널(가정용 / VPN 업링크) 너머로 오가는 JSON / NDJSON / 코드 컨텍스트를 압축
+# 응답 인코딩은 클라이언트의 Accept-Encoding으로 결정 (zstd는 zstandard 패키지가 있을 때만)
+REQUEST_DECOMPRESSION = env_bool("BRIDGE_REQUEST_DECOMPRESSION", True)  # Content-Encoding: gzip / zstd 요청 본문 해제 (끄면 415)
+COMPRESSION = env_bool("BRIDGE_COMPRESSION", True)  # 비스트리밍 응답 및 /api/tags 압축
+COMPRESSION_MIN_BYTES = env_int("BRIDGE_COMPRESSION_MIN_BYTES", 1024)  # 이보다 작은 응답은 압축하지 않음 (bytes)
+STREAM_COMPRESSION = env_bool("BRIDGE_STREAM_COMPRESSION", True)  # stream=true 응답을 청크(병합 그룹)마다 flush하며 압축 (헤더 전송 시점에 길이를 모르므로 크기 기준 없음)
+GZIP_LEVEL = 6  # 비스트리밍 응답 gzip 레벨
+STREAM_GZIP_LEVEL = 1  # 스트리밍은 청크마다 압축하므로 CPU가 적게 드는 레벨 사용
+ZSTD_LEVEL = 3  # zstd 레벨 (스트리밍 / 비스트리밍 공통)
+STREAM_WINDOW_BITS = 12  # 스트림마다 압축 상태를 가지므로 창을 4 KiB로 줄여 동시 스트림이 많아도 메모리를 적게 사용
+
+# --- 스트리밍 코덱 설정 ---
+FAST_JSON = env_bool("BRIDGE_FAST_JSON", True)  # orjson이 설치되어 있으면 SSE 파싱 / 청크 인코딩에 사용
+
+# --- 토큰 수 계산 설정 ---
+# prompt_eval_count / eval_count는 vLLM이 보내주는 usage 값을 우선 사용
+# usage가 없을 때만 로컬 토크나이저(tokenizers 패키지 필요)로 계산하고, 그것도 없으면 문자 수로 추정
+UPSTREAM_USAGE = env_bool("BRIDGE_UPSTREAM_USAGE", True)  # vLLM에 stream_options.include_usage 요청 여부
+TOKENIZER_MODELS = parse_model_map(os.environ.get("BRIDGE_TOKENIZERS", ""), str)  # 모델별 토크나이저 (HF repo id 또는 tokenizer.json 경로), 예: "qwen=Qwen/Qwen2.5-7B-Instruct"
+TOKENIZER_CACHE_ENTRIES = env_int("BRIDGE_TOKENIZER_CACHE_ENTRIES", 4096)  # 메시지별 토큰 수 LRU 캐시 크기 (0 = 끔)
+TOKENIZER_THREADS = env_int("BRIDGE_TOKENIZER_THREADS", 2)  # 토큰화 전용 스레드 수
+
+
+
+
+
+# ===============================================================
+# 워커 간 공유 상태 (응답 캐시 / 모델 카탈로그 / 메트릭)
+# → 멀티 워커 런처가 자기 프로세스의 스레드에서 unix socket 서버를 실행
+# → 각 워커는 커넥션 하나를 유지하며 요청 (프레임: 4바이트 길이 + JSON)
+# → 공유 상태 서버가 응답하지 않으면 워커 로컬 상태로 처리하고 요청 자체는 실패시키지 않음
+# ===============================================================
+def encode_frame(message):
+    body = json_dumps_bytes(message)
+    return len(body).to_bytes(4, "big") + body
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(4)
+    return json_loads(await reader.readexactly(int.from_bytes(header, "big")))
+
+
+class SharedStateServer:
+    def __init__(self, path):
+        self.path = path
+        self.cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+        self.catalog = None  # 마지막으로 공유된 카탈로그 {"fetched_at", "models", "body", "seen_models"}
+        self.metrics = {}  # pid -> (마지막 보고 시각, 메트릭 export)
+        self.stats = {"connections": 0, "requests": 0, "errors": 0}
+
+    def start(self):
+        # socket은 여기서 바로 bind하여 경로 오류가 런처 시작 시점에 드러나도록 함
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        atexit.register(self.cleanup)
+        threading.Thread(target=asyncio.run, args=(self.serve(sock),), name="bridge-shared-state", daemon=True).start()
+
+    def cleanup(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def serve(self, sock):
+        server = await asyncio.start_unix_server(self.handle, sock=sock)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        self.stats["connections"] += 1
+        try:
+            while True:
+                try:
+                    message = await read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    return
+                self.stats["requests"] += 1
+                try:
+                    reply = {"ok": True, "result": self.dispatch(message)}
+                except Exception as exc:
+                    self.stats["errors"] += 1
+                    reply = {"ok": False, "error": f"{type(exc).__name__}: {exc}"}
+                writer.write(encode_frame(reply))
+                await writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            writer.close()
+
+    def dispatch(self, message):
+        op = message["op"]
+        if op == "cache_get":
+            return self.cache.get(message["key"])
+        if op == "cache_put":
+            self.cache.put(message["key"], [tuple(e) for e in message["events"]])
+            return None
+        if op == "catalog_get":
+            return self.catalog
+        if op == "catalog_put":
+            # 여러 워커가 동시에 갱신해도 가장 최근 카탈로그만 유지
+            if self.catalog is None or message["catalog"]["fetched_at"] > self.catalog["fetched_at"]:
+                self.catalog = message["catalog"]
+            return None
+        if op == "metrics_push":
+            self.metrics[message["pid"]] = (time.monotonic(), message["metrics"])
+            return None
+        if op == "metrics_get":
+            # 한동안 보고가 없는 워커(종료 / 재시작)는 합계에서 제외
+            cutoff = time.monotonic() - max(30.0, METRICS_PUSH_INTERVAL * 10)
+            self.metrics = {pid: item for pid, item in self.metrics.items() if item[0] >= cutoff}
+            return [export for _, export in self.metrics.values()]
+        if op == "stats":
+            return {
+                "workers_reporting": len(self.metrics),
+                "catalog_cached": self.catalog is not None,
+                "response_cache": self.cache.snapshot(),
+                **self.stats,
+            }
+        raise ValueError(f"알 수 없는 요청: {op}")
+
+
+class SharedStateError(Exception):
+    pass
+
+
+class SharedStateClient:
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.lock = None  # 이벤트 루프 안에서 처음 사용할 때 생성
+        self.stats = {"requests": 0, "errors": 0, "connects": 0}
+
+    def enabled(self):
+        return bool(self.path)
+
+    async def call(self, op, **fields):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        self.stats["requests"] += 1
+        try:
+            async with self.lock:
+                async with asyncio.timeout(self.timeout):
+                    if self.writer is None:
+                        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+                        self.stats["connects"] += 1
+                    self.writer.write(encode_frame({"op": op, **fields}))
+                    await self.writer.drain()
+                    reply = await read_frame(self.reader)
+        except (OSError, EOFError, TimeoutError, ValueError) as exc:
+            # asyncio.IncompleteReadError는 EOFError의 하위 클래스
+            self.stats["errors"] += 1
+            self.close()
+            raise SharedStateError(f"{op}: {type(exc).__name__}: {exc}") from exc
+        except asyncio.CancelledError:
+            # 응답을 읽다 취소되면 다음 요청이 이전 응답을 읽지 않도록 커넥션을 버림
+            self.close()
+            raise
+        if not reply["ok"]:
+            self.stats["errors"] += 1
+            raise SharedStateError(f"{op}: {reply['error']}")
+        return reply["result"]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def push_metrics_loop(self):
+        while True:
+            await asyncio.sleep(METRICS_PUSH_INTERVAL)
+            sample_metric_gauges()
+            try:
+                await self.call("metrics_push", pid=os.getpid(), metrics=export_metrics())
+            except SharedStateError as exc:
+                log.warning("공유 상태 서버로 메트릭 전송 실패", extra={"fields": {"error": exc}})
+
+    async def snapshot(self):
+        if not self.enabled():
+            return {"enabled": False}
+        try:
+            server = await self.call("stats")
+        except SharedStateError as exc:
+            server = {"error": str(exc)}
+        return {"enabled": True, "socket": self.path, **self.stats, "server": server}
+
+
+# 워커가 1개면 공유 상태 서버를 띄우지 않으므로 socket이 설정되어 있어도 사용하지 않음 (없는 socket을 매번 시도하지 않도록)
+shared_state = SharedStateClient(SHARED_STATE_SOCKET if WORKER_COUNT > 1 else "", SHARED_STATE_TIMEOUT)
+
+
+
+
+
+# ===============================================================
+# 시작 시 예열: 트래픽을 받기 전에 모델 카탈로그와 업스트림 커넥션 풀을 채움
+# → 업스트림이 아직 준비되지 않았어도 PREWARM_TIMEOUT 후에는 그대로 시작
+# ===============================================================
+async def prewarm_upstreams():
+    start = time.perf_counter()
+    try:
+        async with asyncio.timeout(PREWARM_TIMEOUT or None):
+            await model_catalog.refresh()
+            # 다른 워커가 공유한 카탈로그를 받은 경우 이 워커의 라우팅 정보는 직접 조회
+            if not any(node.models for node in upstream_registry.nodes):
+                await upstream_registry.refresh()
+            connections = min(PREWARM_CONNECTIONS, UPSTREAM_MAX_KEEPALIVE)
+            if connections > 0:
+                # 동시에 요청해야 커넥션이 여러 개 열리고, 응답 후에는 keep-alive 풀에 남음
+                await asyncio.gather(*(
+                    get_upstream_client().get(node.url(VLLM_MODELS_PATH), timeout=UPSTREAM_HEALTH_TIMEOUT)
+                    for node in upstream_registry.nodes for _ in range(connections)
+                ), return_exceptions=True)
+    except Exception as exc:
+        log.warning("업스트림 예열 실패, 그대로 시작", extra={"fields": {"error": exc, "elapsed_ms": round((time.perf_counter() - start) * 1000, 1)}})
+        return
+    log.info("업스트림 예열 완료", extra={"fields": {"elapsed_ms": round((time.perf_counter() - start) * 1000, 1), "models": len(model_catalog.models), "open_connections": upstream_pool_stats()["open"]}})
 
 
 
@@ -43,24 +897,319 @@ async def index():
 
 
 # ===============================================================
-# 요청/응답을 모두 로깅하는 HTTP 미들웨어
+# Prometheus 메트릭 API (/metrics)
 # ===============================================================
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    req_body = await request.body()
-    print(f"\n--- REQUEST {request.method} {request.url.path} ---")
-    if req_body:
+@app.get("/metrics")
+async def metrics():
+    sample_metric_gauges()
+    if shared_state.enabled():
+        # 이 워커의 최신 값을 먼저 보낸 뒤 모든 워커의 합계를 출력 (실패 시 이 워커 값만)
         try:
-            print(json.dumps(json.loads(req_body), indent=2, ensure_ascii=False))
-        except Exception:
-            print(req_body.decode(errors="replace"))
-    else:
-        print("(no body)")
+            await shared_state.call("metrics_push", pid=os.getpid(), metrics=export_metrics())
+            exports = await shared_state.call("metrics_get")
+            return Response(content=render_metrics(merge_metric_exports(exports)), media_type="text/plain; version=0.0.4")
+        except SharedStateError:
+            pass
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+
+
+
+# ===============================================================
+# 브릿지 내부 상태 조회 API (/bridge/stats)
+# → Ollama API가 아닌 운영용 엔드포인트
+# ===============================================================
+@app.get("/bridge/stats")
+async def bridge_stats():
+    # 멀티 워커 모드에서도 이 값들은 요청을 받은 워커 기준 (shared_state에 공유 상태 서버 통계 포함)
+    return {
+        "worker": {"pid": os.getpid(), "workers": WORKER_COUNT},
+        "shared_state": await shared_state.snapshot(),
+        "upstream_pool": upstream_pool_stats(),
+        "upstreams": upstream_registry.snapshot(),
+        "upstream_timeouts": upstream_timeouts_snapshot(),
+        "retry_budget": retry_budget.snapshot(),
+        "hedging": hedge_policy.snapshot(),
+        "model_catalog": model_catalog.snapshot(),
+        "stream_coalescing": coalesce_stats_snapshot(),
+        "response_cache": response_cache.snapshot(),
+        "admission": admission.snapshot(),
+        "aborts": generation_aborts.snapshot(),
+        "inflight_dedup": {"mode": INFLIGHT_DEDUP, "active": len(inflight_generations), **inflight_stats},
+        "token_accounting": token_counter.snapshot(),
+        "embeddings": embedding_batcher.snapshot(),
+        "prefix_warming": prefix_warmer.snapshot(),
+        "compression": compression_stats.snapshot(),
+    }
+
 
-    response = await call_next(request)
 
-    # 응답 본문은 스트리밍이므로 여기선 출력 안 함
-    print(f"--- RESPONSE status_code={response.status_code} media_type={response.media_type} ---")
+
+
+# ===============================================================
+# HTTP 압축
+# → 요청: Content-Encoding gzip / zstd 본문을 해제 (해제 후 크기도 BRIDGE_MAX_BODY_BYTES로 제한)
+# → 응답: Accept-Encoding 협상 (zstd 우선, 없으면 gzip)
+#   - 길이를 아는 응답(비스트리밍 /api/chat, /api/tags 등)은 BRIDGE_COMPRESSION_MIN_BYTES 이상일 때 통째로 압축
+#   - NDJSON 스트림은 청크(병합 그룹)마다 sync flush하여 압축이 토큰 전달을 지연시키지 않게 함
+# → 종류별 원본 / 압축 바이트와 압축에 쓴 CPU 시간(thread_time)을 기록
+# ===============================================================
+if importlib.util.find_spec("zstandard") is not None:
+    import zstandard  # 선택적 의존성
+
+    DECOMPRESS_ERRORS = (zlib.error, ValueError, zstandard.ZstdError)
+else:
+    zstandard = None
+    DECOMPRESS_ERRORS = (zlib.error, ValueError)
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+
+class CompressionStats:
+    def __init__(self):
+        # kind: request(요청 해제) / response(비스트리밍) / stream(스트리밍)
+        self.kinds = {kind: {"count": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0} for kind in ("request", "response", "stream")}
+
+    def record(self, kind, encoding, raw_bytes, encoded_bytes, cpu_seconds):
+        stats = self.kinds[kind]
+        stats["count"] += 1
+        stats["bytes_in"] += raw_bytes
+        stats["bytes_out"] += encoded_bytes
+        stats["cpu_seconds"] += cpu_seconds
+        metric_compression_saved.inc(kind, encoding, amount=raw_bytes - encoded_bytes)
+        metric_compression_cpu.inc(kind, encoding, amount=cpu_seconds)
+
+    def snapshot(self):
+        result = {"zstd_available": zstandard is not None}
+        for kind, stats in self.kinds.items():
+            count = stats["count"]
+            result[kind] = {
+                "count": count,
+                "raw_bytes": stats["bytes_in"],
+                "encoded_bytes": stats["bytes_out"],
+                "bytes_saved": stats["bytes_in"] - stats["bytes_out"],
+                "ratio": round(stats["bytes_out"] / stats["bytes_in"], 3) if stats["bytes_in"] else None,
+                "cpu_us_per_item": round(stats["cpu_seconds"] / count * 1_000_000, 1) if count else None,
+            }
+        return result
+
+
+compression_stats = CompressionStats()
+
+
+def body_too_large(size):
+    return RequestRejectedError(413, f"해제한 요청 본문이 너무 큼: {size}+ bytes (최대 {MAX_BODY_BYTES})")
+
+
+def body_truncated(encoding):
+    return RequestRejectedError(400, f"요청 본문 압축 해제 실패 ({encoding}): 압축 스트림이 중간에 끝남")
+
+
+def gunzip_body(body, limit):
+    # 여러 gzip 멤버가 이어 붙은 본문도 끝까지 해제 (gzip 도구와 동일), 멤버마다 CRC / 길이 trailer까지 확인
+    parts = []
+    size = 0
+    data = body
+    while data:
+        decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        while True:
+            # 압축 폭탄 방지: 남은 한도 + 1 바이트까지만 출력
+            chunk = decoder.decompress(data, limit + 1 - size if limit is not None else 0)
+            parts.append(chunk)
+            size += len(chunk)
+            if limit is not None and size > limit:
+                raise body_too_large(size)
+            if decoder.eof:
+                break
+            data = decoder.unconsumed_tail
+            if not data and not chunk:
+                raise body_truncated("gzip")
+        data = decoder.unused_data
+    return b"".join(parts)
+
+
+def unzstd_body(body, limit):
+    # 프레임 헤더에 원본 크기가 없는 경우(스트리밍 압축)가 흔하므로 출력 버퍼를 미리 잡지 않고 조금씩 해제
+    # → zstd 최대 압축률(블록 헤더 4바이트 → 128 KiB, 약 32768배)에서도 한 번에 남은 한도를 넘지 않도록 입력을 나눠 넣음
+    dctx = zstandard.ZstdDecompressor()
+    parts = []
+    size = 0
+    data = memoryview(body)
+    while data:
+        decoder = dctx.decompressobj()
+        pos = 0
+        while not decoder.eof:
+            if pos >= len(data):
+                raise body_truncated("zstd")
+            step = len(data) if limit is None else max(16, (limit + 1 - size) // 32768)
+            chunk = decoder.decompress(data[pos:pos + step])
+            pos += step
+            parts.append(chunk)
+            size += len(chunk)
+            if limit is not None and size > limit:
+                raise body_too_large(size)
+        # 마지막에 넣은 조각 중 프레임 뒤에 남은 부분(unused_data)부터 다음 프레임 시작
+        data = memoryview(decoder.unused_data + bytes(data[pos:])) if decoder.unused_data else data[pos:]
+    return b"".join(parts)
+
+
+def decode_request_body(body, encoding):
+    # Content-Encoding에 따라 해제; 지원하지 않는 인코딩은 415, 깨지거나 잘린 본문은 400, 해제 후 한도 초과는 413
+    if encoding in ("", "identity"):
+        return body
+    if not REQUEST_DECOMPRESSION or encoding not in ("gzip", "x-gzip", "zstd") or (encoding == "zstd" and zstandard is None):
+        raise RequestRejectedError(415, f"지원하지 않는 Content-Encoding: {encoding}")
+    cpu_start = time.thread_time()
+    limit = MAX_BODY_BYTES if MAX_BODY_BYTES > 0 else None
+    try:
+        decoded = unzstd_body(body, limit) if encoding == "zstd" else gunzip_body(body, limit)
+    except DECOMPRESS_ERRORS as exc:
+        raise RequestRejectedError(400, f"요청 본문 압축 해제 실패 ({encoding}): {exc}") from exc
+    compression_stats.record("request", "zstd" if encoding == "zstd" else "gzip", len(decoded), len(body), time.thread_time() - cpu_start)
+    add_request_log_fields(request_encoding=encoding, request_decoded_bytes=len(decoded))
+    return decoded
+
+
+def negotiate_encoding(accept_encoding):
+    # "gzip, deflate, zstd;q=0.5" 형식; q=0은 거부로 처리
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    for encoding in ("zstd", "gzip"):
+        if encoding == "zstd" and zstandard is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class BodyCompressor:
+    def __init__(self, encoding, streaming):
+        self.encoding = encoding
+        if encoding == "zstd":
+            if streaming:
+                params = zstandard.ZstdCompressionParameters.from_level(ZSTD_LEVEL, window_log=STREAM_WINDOW_BITS + 1, hash_log=STREAM_WINDOW_BITS, chain_log=STREAM_WINDOW_BITS)
+                compressor = zstandard.ZstdCompressor(compression_params=params)
+            else:
+                compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            self.compressor = compressor.compressobj()
+            self.flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        elif streaming:
+            self.compressor = zlib.compressobj(STREAM_GZIP_LEVEL, zlib.DEFLATED, STREAM_WINDOW_BITS | 16, 4)
+            self.flush_mode = zlib.Z_SYNC_FLUSH
+        else:
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            self.flush_mode = zlib.Z_SYNC_FLUSH
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def compress(self, data, flush):
+        cpu_start = time.thread_time()
+        out = self.compressor.compress(data)
+        if flush:
+            out += self.compressor.flush(self.flush_mode)
+        self.cpu_seconds += time.thread_time() - cpu_start
+        self.raw_bytes += len(data)
+        self.encoded_bytes += len(out)
+        return out
+
+    def finish(self):
+        cpu_start = time.thread_time()
+        out = self.compressor.flush()
+        self.cpu_seconds += time.thread_time() - cpu_start
+        self.encoded_bytes += len(out)
+        return out
+
+
+def compress_response(request, response):
+    # 압축 대상이면 헤더를 바꾸고 압축하는 body_iterator를 돌려줌 (대상이 아니면 원래 것 그대로)
+    body_iterator = response.body_iterator
+    if "content-encoding" in response.headers or response.status_code < 200 or response.status_code in (204, 304):
+        return body_iterator
+    content_type = response.headers.get("content-type", "")
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return body_iterator
+    length = response.headers.get("content-length")
+    streaming = length is None
+    if streaming and not (STREAM_COMPRESSION and content_type.startswith("application/x-ndjson")):
+        return body_iterator
+    if not streaming and not (COMPRESSION and int(length) >= COMPRESSION_MIN_BYTES):
+        return body_iterator
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+    if encoding is None:
+        return body_iterator
+
+    del response.headers["content-length"]
+    response.headers["content-encoding"] = encoding
+    response.headers.append("vary", "Accept-Encoding")
+    add_request_log_fields(encoding=encoding)
+    compressor = BodyCompressor(encoding, streaming)
+    kind = "stream" if streaming else "response"
+
+    async def compressed():
+        try:
+            async for chunk in body_iterator:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                out = compressor.compress(chunk, flush=streaming)
+                if out:
+                    yield out
+            yield compressor.finish()
+        finally:
+            compression_stats.record(kind, encoding, compressor.raw_bytes, compressor.encoded_bytes, compressor.cpu_seconds)
+
+    return compressed()
+
+
+
+
+
+# ===============================================================
+# 요청 로깅 HTTP 미들웨어
+# → 요청 ID 부여, (debug 시) 본문 일부 로깅, 응답 본문 전송이 끝나면 요약 1줄 로깅
+# → 응답 압축도 여기서 적용 (미들웨어를 하나 더 두면 청크마다 전달 단계가 늘어남)
+# ===============================================================
+@app.middleware("http")
+async def log_requests(request: Request, call_next):
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:12]
+    request_id_var.set(request_id)
+    log_fields = {"method": request.method, "path": request.url.path}
+    request_log_fields_var.set(log_fields)
+    start = time.perf_counter()
+
+    try:
+        response = await call_next(request)
+    except Exception:
+        log.exception("요청 처리 실패", extra={"fields": {**log_fields, "ms": round((time.perf_counter() - start) * 1000, 1)}})
+        raise
+    response.headers["X-Request-Id"] = request_id
+    log_fields["status"] = response.status_code
+
+    # 응답 본문(스트리밍 포함) 전송이 끝난 시점에 요약 로그 출력
+    body_iterator = compress_response(request, response)
+
+    async def body_with_summary():
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            log_fields["ms"] = round((time.perf_counter() - start) * 1000, 1)
+            log.info("요청", extra={"fields": log_fields})
+            # 원본 경로 대신 매칭된 라우트 템플릿으로 라벨링 (미매칭 경로는 other로 묶어 시계열 폭증 방지)
+            route = request.scope.get("route")
+            metric_http_requests.inc(getattr(route, "path", None) or "other", response.status_code)
+
+    response.body_iterator = body_with_summary()
     return response
 
 
@@ -69,37 +1218,111 @@ async def log_requests(request: Request, call_next):
 
 # ===============================================================
 # 요청 데이터 구조 정의 (Pydantic 모델)
+# → 본문 bytes를 model_validate_json으로 한 번에 파싱 + 검증 (중간 dict 생성 없음)
+# → 메시지는 TypedDict라 검증 후에도 일반 dict로 남아 vLLM 요청에 그대로 넣을 수 있음
+#   (images, tool_calls 등 추가 필드도 그대로 전달)
 # ===============================================================
-class OllamaMessage(BaseModel):
-    role: str  # 'user' 또는 'assistant'
-    content: str  # 메시지 본문
+class OllamaMessage(TypedDict):
+    __pydantic_config__ = ConfigDict(extra="allow")
+    role: str  # 'system', 'user', 'assistant' 또는 'tool'
+    content: NotRequired[str | None]  # 메시지 본문 (도구 호출만 담은 assistant 턴은 null)
 
 class OllamaChatRequest(BaseModel):
-    model: str  # 사용할 모델 ID
+    model: str = ""  # 사용할 모델 ID (누락 시 핸들러에서 Ollama 형식 오류 응답)
     messages: list[OllamaMessage]  # 채팅 메시지 리스트
-    stream: bool = False  # 스트리밍 여부
+    stream: StrictBool = False  # 스트리밍 여부 (null은 기본값, bool이 아닌 값은 400)
     options: dict = {}  # 온도 등 기타 옵션
 
+    @field_validator("model", mode="before")
+    @classmethod
+    def model_or_empty(cls, value):
+        # null / 문자열이 아닌 model은 검증 오류 대신 누락으로 취급하여 핸들러의 Ollama 형식 400 응답으로 보냄
+        return value if isinstance(value, str) else ""
+
+    @field_validator("stream", mode="before")
+    @classmethod
+    def stream_or_default(cls, value):
+        # 일부 Ollama 클라이언트는 stream: null을 보냄 → 기본값(비스트리밍)으로 처리
+        return False if value is None else value
+
 
 
 
 
 # ===============================================================
-# 현재 시간을 Ollama 형식으로 ISO 타임스탬프 반환
+# 요청 본문 수신
+# → Content-Length가 한도를 넘으면 본문을 읽지 않고 바로 413
+# → chunked 전송은 읽는 도중 한도를 넘는 순간 중단
+# → 본문 디버그 로그(BRIDGE_LOG_BODY_BYTES)는 한도 검사를 통과한 뒤 앞부분만 출력
+# → Content-Encoding이 있으면 한도 검사 후 해제 (HTTP 압축 참고)
 # ===============================================================
-def get_current_ollama_created_at_format():
-    current_time = datetime.now(timezone.utc)
-    return current_time.isoformat() + "Z"
+class RequestRejectedError(Exception):
+    def __init__(self, status_code, reason):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
+async def read_request_body(request):
+    declared = request.headers.get("content-length")
+    if MAX_BODY_BYTES > 0 and declared is not None and declared.isdigit() and int(declared) > MAX_BODY_BYTES:
+        raise RequestRejectedError(413, f"요청 본문이 너무 큼: {declared} bytes (최대 {MAX_BODY_BYTES})")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if MAX_BODY_BYTES > 0 and size > MAX_BODY_BYTES:
+            raise RequestRejectedError(413, f"요청 본문이 너무 큼: {size}+ bytes (최대 {MAX_BODY_BYTES})")
+        chunks.append(chunk)
+    add_request_log_fields(request_bytes=size)
+    body = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+    body = decode_request_body(body, request.headers.get("content-encoding", "").strip().lower())
+    if LOG_BODY_BYTES > 0 and log.isEnabledFor(logging.DEBUG):
+        preview = body[:LOG_BODY_BYTES].decode("utf-8", errors="replace")
+        truncated = f" ...(+{len(body) - LOG_BODY_BYTES} bytes)" if len(body) > LOG_BODY_BYTES else ""
+        log.debug(f"요청 본문: {preview}{truncated}", extra={"fields": {"bytes": len(body)}})
+    return body
+
+
+async def read_json_body(request):
+    body = await read_request_body(request)
+    try:
+        data = json_loads(body)
+    except ValueError as exc:
+        raise RequestRejectedError(400, f"JSON 파싱 실패: {exc}") from exc
+    if not isinstance(data, dict):
+        raise RequestRejectedError(400, f"잘못된 요청: 본문은 JSON 객체여야 함 ({type(data).__name__})")
+    return data
+
+
+async def read_chat_request(request):
+    body = await read_request_body(request)
+    try:
+        chat_request = OllamaChatRequest.model_validate_json(body)
+    except ValidationError as exc:
+        # 입력값은 소스 파일 전체일 수 있으므로 오류 메시지에 넣지 않음
+        details = "; ".join(f"{'.'.join(map(str, e['loc'])) or 'body'}: {e['msg']}" for e in exc.errors(include_input=False)[:3])
+        raise RequestRejectedError(400, f"잘못된 요청: {details}") from exc
+    if MAX_MESSAGES > 0 and len(chat_request.messages) > MAX_MESSAGES:
+        raise RequestRejectedError(413, f"메시지가 너무 많음: {len(chat_request.messages)}개 (최대 {MAX_MESSAGES})")
+    return chat_request
+
+
+def request_rejected_response(exc):
+    metric_errors.inc("request_too_large" if exc.status_code == 413 else "invalid_request")
+    add_request_log_fields(rejected=exc.reason)
+    return JSONResponse({"error": exc.reason}, status_code=exc.status_code)
 
 
 
 
 
 # ===============================================================
-# 모델 용량 기반으로 로딩 시간 추정 (현재는 고정값만 반환)
+# 현재 시간을 Ollama 형식으로 ISO 타임스탬프 반환
 # ===============================================================
-def estimate_load_duration(model_size_in_vllm_unit):
-    return ESTIMATED_MODEL_LOAD_DURATION_NS
+def get_current_ollama_created_at_format():
+    current_time = datetime.now(timezone.utc)
+    return current_time.isoformat() + "Z"
 
 
 
@@ -121,11 +1344,6 @@ def vllm_model_to_ollama_tag(model):
         digest = f"sha256:{model['permission'][0]['id']}"
     size = model.get("max_model_len", 7000000000)
 
-    # 모델 로딩 시간 추정값 저장
-    if model_id not in model_load_durations:
-        model_load_durations[model_id] = estimate_load_duration(size)
-        print(f"--- Model '{model_id}' load_duration estimated and stored: {model_load_durations[model_id]} ns ---")
-
     return {
         "name": model_id,
         "model": model_id,
@@ -139,37 +1357,1759 @@ def vllm_model_to_ollama_tag(model):
 
 
 
+# ===============================================================
+# 모델 카탈로그 캐시
+# → /api/tags 응답을 직렬화된 bytes로 보관 (TTL)
+# → 동시에 들어온 폴링 요청은 하나의 업스트림 조회를 공유 (single-flight)
+# → TTL 만료 직후에는 stale 응답을 주고 백그라운드에서 갱신 (stale-while-revalidate)
+# → vLLM이 잠시 응답하지 않으면 500 대신 마지막 카탈로그를 반환 (serve-stale)
+# → 멀티 워커 모드: 다른 워커가 TTL 안에 갱신한 카탈로그가 있으면 업스트림 조회 없이 그대로 사용
+# ===============================================================
+class ModelCatalog:
+    def __init__(self):
+        self.body = None  # 직렬화된 /api/tags 응답
+        self.models = []  # 마지막으로 받은 vLLM 모델 원본 목록
+        self.fetched_at = 0.0  # 마지막 갱신 시각 (monotonic)
+        # 이미 본 모델 id (처음 나타난 모델만 prefix 예열 대상; load_duration은 채팅 경로에서 직접 측정)
+        self.seen_models = set()
+        self.inflight = None  # 진행 중인 업스트림 조회 태스크 (single-flight)
+        self.stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "stale_on_error": 0,
+            "misses": 0,
+            "upstream_fetches": 0,
+            "upstream_errors": 0,
+            "shared_adopted": 0,
+        }
+
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+    async def get(self):
+        if self.body is not None:
+            age = self.age()
+            if age < CATALOG_TTL:
+                self.stats["hits"] += 1
+                return self.body
+            if age < CATALOG_TTL + CATALOG_SWR_WINDOW:
+                self.stats["stale_hits"] += 1
+                self.start_refresh()
+                return self.body
+
+        self.stats["misses"] += 1
+        try:
+            return await self.refresh()
+        except Exception:
+            if self.body is not None and self.age() < CATALOG_SERVE_STALE_MAX_AGE:
+                self.stats["stale_on_error"] += 1
+                return self.body
+            raise
+
+    def start_refresh(self):
+        # 이미 조회 중이면 같은 태스크를 공유
+        if self.inflight is None:
+            self.inflight = asyncio.create_task(self.fetch())
+            self.inflight.add_done_callback(self.on_fetch_done)
+        return self.inflight
+
+    async def refresh(self):
+        # shield로 감싸 한 요청의 취소가 다른 대기자에 영향 주지 않게 함
+        return await asyncio.shield(self.start_refresh())
+
+    def on_fetch_done(self, task):
+        self.inflight = None
+        # 백그라운드 갱신 실패는 아무도 await하지 않으므로 여기서 예외를 소비
+        if not task.cancelled() and task.exception() is not None:
+            log.warning("모델 카탈로그 갱신 실패", extra={"fields": {"error": task.exception()}})
+
+    async def fetch(self):
+        if await self.adopt_shared():
+            return self.body
+
+        self.stats["upstream_fetches"] += 1
+        try:
+            models = await upstream_registry.refresh()
+            ollama_models = [vllm_model_to_ollama_tag(m) for m in models]
+        except Exception:
+            self.stats["upstream_errors"] += 1
+            raise
+
+        # 처음 보는 모델은 막 로딩되어 prefix 캐시가 비어 있으므로 예열
+        for model, tag in zip(models, ollama_models):
+            if tag["model"] not in self.seen_models:
+                self.seen_models.add(tag["model"])
+                log.info("새 모델 발견", extra={"fields": {"model": tag["model"]}})
+                prefix_warmer.schedule("model_appeared", model=model.get("id"))
+
+        self.models = models
+        self.body = json.dumps({"models": ollama_models}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.fetched_at = time.monotonic()
+        await self.publish_shared()
+        return self.body
+
+    async def adopt_shared(self):
+        # time.monotonic은 같은 호스트의 프로세스끼리 같은 시계를 쓰므로 fetched_at을 그대로 비교
+        if not shared_state.enabled():
+            return False
+        try:
+            shared = await shared_state.call("catalog_get")
+        except SharedStateError:
+            return False
+        if shared is None or shared["fetched_at"] <= self.fetched_at or time.monotonic() - shared["fetched_at"] >= CATALOG_TTL:
+            return False
+        self.seen_models.update(shared["seen_models"])
+        self.models = shared["models"]
+        self.body = shared["body"].encode("utf-8")
+        self.fetched_at = shared["fetched_at"]
+        self.stats["shared_adopted"] += 1
+        return True
+
+    async def publish_shared(self):
+        if not shared_state.enabled():
+            return
+        catalog = {"fetched_at": self.fetched_at, "models": self.models, "body": self.body.decode("utf-8"), "seen_models": sorted(self.seen_models)}
+        try:
+            await shared_state.call("catalog_put", catalog=catalog)
+        except SharedStateError:
+            pass
+
+    def snapshot(self):
+        return {
+            "cached": self.body is not None,
+            "age_seconds": round(self.age(), 3) if self.body is not None else None,
+            "models": len(self.models),
+            "refreshing": self.inflight is not None,
+            **self.stats,
+        }
+
+
+model_catalog = ModelCatalog()
+
+
+
+
+
 # ===============================================================
 # 모델 목록 조회 API (/api/tags)
-# → Ollama가 요구하는 모델 리스트 반환
+# → Ollama가 요구하는 모델 리스트 반환 (카탈로그 캐시 경유, 모든 업스트림 병합)
 # ===============================================================
 @app.get("/api/tags")
 async def list_tags():
-    async with httpx.AsyncClient() as client:
+    try:
+        return Response(content=await model_catalog.get(), media_type="application/json")
+    except httpx.RequestError as exc:
+        log.error("VLLM 모델 목록 가져오기 실패", extra={"fields": {"error": exc}})
+        return Response(
+            content=json.dumps({"error": f"VLLM 모델 서버에 연결할 수 없음: {exc}"}, ensure_ascii=False, separators=(",", ":")),
+            status_code=500,
+            media_type="application/json"
+        )
+    except Exception as exc:
+        log.error("VLLM 모델 목록 처리 중 오류", extra={"fields": {"error": exc}})
+        return Response(
+            content=json.dumps({"error": f"VLLM 모델 목록 처리 중 오류 발생: {exc}"}, ensure_ascii=False, separators=(",", ":")),
+            status_code=500,
+            media_type="application/json"
+        )
+
+
+
+
+
+# ===============================================================
+# 스트리밍 청크 병합기
+# → add()로 delta를 쌓고, 첫 토큰 / 시간창 만료 / 바이트 상한 도달 시 flush() 대상이 됨
+# ===============================================================
+class ChunkCoalescer:
+    def __init__(self, window_ms, max_bytes):
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.size = 0
+        self.created_at = None
+        self.deadline = None
+        self.first_flushed = False
+        self.deltas = 0
+        self.frames = 0
+
+    def add(self, content, created_at):
+        self.parts.append(content)
+        self.size += len(content.encode("utf-8"))
+        self.created_at = created_at
+        self.deltas += 1
+        if not self.first_flushed or self.window <= 0 or self.size >= self.max_bytes:
+            return True
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now + self.window
+        return now >= self.deadline
+
+    def pending(self):
+        return bool(self.parts)
+
+    def timeout(self):
+        # 버퍼가 비어 있으면 다음 delta를 무기한 대기, 아니면 시간창 만료까지만 대기
+        if not self.parts or self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def flush(self):
+        content = "".join(self.parts)
+        self.parts = []
+        self.size = 0
+        self.deadline = None
+        self.first_flushed = True
+        self.frames += 1
+        return self.created_at, content
+
+
+# --- 병합 통계 (프레임 절감량 확인용) ---
+coalesce_stats = {"streams": 0, "coalesced_streams": 0, "deltas": 0, "frames": 0}
+
+
+def coalesce_stats_snapshot():
+    return {
+        **coalesce_stats,
+        "frames_saved": coalesce_stats["deltas"] - coalesce_stats["frames"],
+    }
+
+
+def resolve_coalesce_window(model, headers):
+    # 우선순위: 클라이언트 헤더 > 모델별 설정 > 전역 설정
+    header_value = headers.get(COALESCE_HEADER)
+    if header_value is not None:
         try:
-            resp = await client.get(VLLM_MODELS_URL)
-            resp.raise_for_status()
-            data = resp.json()
-            models = data.get("data", [])
-            ollama_models = [vllm_model_to_ollama_tag(m) for m in models]
-            return Response(
-                content=json.dumps({"models": ollama_models}, ensure_ascii=False, separators=(",", ":")),
-                media_type="application/json"
-            )
-        except httpx.RequestError as exc:
-            print(f"--- VLLM 모델 목록 가져오기 실패: {exc} ---")
-            return Response(
-                content=json.dumps({"error": f"VLLM 모델 서버에 연결할 수 없음: {exc}"}, ensure_ascii=False, separators=(",", ":")),
-                status_code=500,
-                media_type="application/json"
-            )
+            return max(0.0, float(header_value))
+        except ValueError:
+            pass
+    return COALESCE_MODEL_WINDOWS.get(model, COALESCE_WINDOW_MS)
+
+
+# ===============================================================
+# 비동기 이터레이터를 timeout 단위로 깨우며 순회
+# → timeout_fn()초 동안 새 항목이 없으면 None을 yield (병합 버퍼 시간창 flush용)
+# → stop 퓨처가 먼저 끝나면 (클라이언트 연결 종료 등) 순회를 중단
+# → 대기 중인 __anext__는 취소하지 않고 이어서 기다리므로 업스트림 스트림이 깨지지 않음
+# ===============================================================
+async def aiter_with_ticks(aiterator, timeout_fn, stop=None):
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(aiterator.__anext__())
+            waiting = {pending} if stop is None else {pending, stop}
+            done, _ = await asyncio.wait(waiting, timeout=timeout_fn(), return_when=asyncio.FIRST_COMPLETED)
+            if pending not in done:
+                if stop is not None and stop in done:
+                    return
+                yield None
+                continue
+            finished, pending = pending, None
+            try:
+                item = finished.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if pending is not None:
+            pending.cancel()
+        elif hasattr(aiterator, "aclose"):
+            asyncio.ensure_future(aiterator.aclose())
+
+
+# ===============================================================
+# 클라이언트 연결 종료 대기
+# → 요청 본문을 다 읽은 뒤의 receive()는 클라이언트가 연결을 끊을 때 http.disconnect를 반환
+# ===============================================================
+async def wait_for_disconnect(request):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+
+
+
+
+# ===============================================================
+# 스트리밍 코덱 (토큰마다 실행되는 고속 경로)
+# → JSON: orjson이 설치되어 있으면 사용, 없으면 표준 json
+# → SSE: 업스트림 바이트를 직접 줄 단위로 나눠 "data:" 페이로드만 bytes 그대로 한 번 파싱
+# → NDJSON: 요청마다 응답 청크의 고정 부분(bytes)을 미리 만들어 두고 이스케이프된 content만 끼워 넣음
+# → created_at: vLLM created(unix 초)가 바뀔 때만 문자열로 변환
+# ===============================================================
+if FAST_JSON and importlib.util.find_spec("orjson") is not None:
+    import orjson  # 선택적 의존성
+
+    json_loads = orjson.loads
+    json_string_bytes = orjson.dumps  # str -> JSON 문자열 리터럴 (bytes, UTF-8)
+    json_dumps_bytes = orjson.dumps  # 큰 응답 본문 (임베딩 벡터 등)
+else:
+    orjson = None
+    json_loads = json.loads
+
+    def json_string_bytes(value):
+        return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+    def json_dumps_bytes(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+async def aiter_sse_data(response, deadline=None):
+    # SSE 스트림에서 "data:" 줄의 페이로드만 (bytes, 수신 시각) 형태로 yield (빈 줄 / 주석 / event: 줄은 건너뜀)
+    # → 수신 시각은 네트워크에서 바이트를 읽은 직후 기록하여 줄 분리 / JSON 파싱도 브릿지 오버헤드에 포함
+    # deadline: 네트워크 읽기마다 적용할 마감 시각(loop.time 기준, None = 무제한)을 돌려주는 함수
+    #   → 줄마다가 아니라 읽기마다 타이머를 걸어, 한 번에 여러 청크를 읽는 고부하 상황에서 비용이 나뉨
+    pending = b""
+    chunks = response.aiter_bytes()
+    while True:
+        if deadline is None:
+            data = await anext(chunks, None)
+        else:
+            async with asyncio.timeout_at(deadline()):
+                data = await anext(chunks, None)
+        if data is None:
+            break
+        received_at = time.perf_counter()
+        if pending:
+            data = pending + data
+        start = 0
+        while (end := data.find(b"\n", start)) != -1:
+            if data.startswith(b"data:", start):
+                yield data[start + 5:end].strip(), received_at
+            start = end + 1
+        pending = data[start:]
+    if pending.startswith(b"data:"):
+        yield pending[5:].strip(), received_at
+
+
+class CreatedAtCache:
+    # 한 스트림의 청크는 대부분 같은 created 값을 가지므로 마지막 변환 결과만 보관
+    def __init__(self):
+        self.created = None
+        self.value = None
+
+    def get(self, created):
+        if created != self.created or created is None:
+            self.value = ollama_created_at(created)
+            self.created = created
+        return self.value
+
+
+class NdjsonChunkEncoder:
+    # 응답 청크 형식은 json.dumps(..., ensure_ascii=False) 결과와 동일하게 유지
+    def __init__(self, model):
+        self.prefix = b'{"model": ' + json_string_bytes(model) + b', "created_at": '
+        self.middle = b', "message": {"role": "assistant", "content": '
+        self.suffix = b'}, "done": false}\n'
+        self.created_at = None
+        self.created_at_bytes = None
+
+    def chunk(self, created_at, content):
+        if created_at is not self.created_at:
+            self.created_at = created_at
+            self.created_at_bytes = json_string_bytes(created_at)
+        return b"".join((self.prefix, self.created_at_bytes, self.middle, json_string_bytes(content), self.suffix))
+
+
+
+
+
+# ===============================================================
+# vLLM 응답 시각(unix 초)을 Ollama created_at 형식으로 변환
+# ===============================================================
+def ollama_created_at(created):
+    if created is not None:
+        try:
+            return datetime.fromtimestamp(created, tz=timezone.utc).isoformat(timespec='microseconds') + 'Z'
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return get_current_ollama_created_at_format()
+
+
+
+
+
+# ===============================================================
+# vLLM 스트리밍 호출 결과를 공통 이벤트 스트림으로 변환
+# → ("start", sent_at, upstream): 업스트림 요청 전송 (fail-over / 재시도 시 다시 발생)
+# → ("delta", content, created_at, received_at): 생성된 텍스트 조각
+# → ("done", finish_reason, usage, created_at, received_at): 생성 종료
+# → 클라이언트의 stream 여부와 관계없이 업스트림은 항상 스트리밍으로 호출하여
+#   TTFT / 토큰 간 지연 / 생성 시간을 실제로 측정
+# → 스트리밍/비스트리밍 응답, 캐시 재생, 중복 요청 공유가 모두 같은 이벤트 형식을 사용
+# → 시간 예산: 첫 토큰까지 BRIDGE_UPSTREAM_FIRST_TOKEN_TIMEOUT (응답 헤더 대기 포함),
+#   이후 토큰마다 BRIDGE_UPSTREAM_CHUNK_TIMEOUT으로 갱신; 초과 시 httpx.ReadTimeout으로 기존 fail-over 경로를 탐
+# ===============================================================
+upstream_timeout_stats = {"first_token": 0, "chunk": 0}
+
+
+def upstream_timeout_error(phase, node):
+    upstream_timeout_stats[phase] += 1
+    metric_upstream_timeouts.inc(phase)
+    budget = UPSTREAM_FIRST_TOKEN_TIMEOUT if phase == "first_token" else UPSTREAM_CHUNK_TIMEOUT
+    return httpx.ReadTimeout(f"vLLM {phase} timeout after {budget:g}s ({node.base_url})")
+
+
+def upstream_timeouts_snapshot():
+    return {"first_token_seconds": UPSTREAM_FIRST_TOKEN_TIMEOUT, "chunk_seconds": UPSTREAM_CHUNK_TIMEOUT, **upstream_timeout_stats}
+
+
+async def stream_upstream_events(node, openai_payload):
+    client = get_upstream_client()
+    model = openai_payload["model"]
+    loop = asyncio.get_running_loop()
+    sent_at = time.perf_counter()
+    deadline = loop.time() + UPSTREAM_FIRST_TOKEN_TIMEOUT if UPSTREAM_FIRST_TOKEN_TIMEOUT > 0 else None
+    request = client.build_request("POST", node.url(VLLM_API_PATH), json=openai_payload)
+    try:
+        async with asyncio.timeout_at(deadline):
+            vllm_resp = await client.send(request, stream=True)
+    except TimeoutError:
+        raise upstream_timeout_error("first_token", node) from None
+    try:
+        if vllm_resp.status_code >= 400:
+            await vllm_resp.aread()  # 오류 본문을 메시지에 담기 위해 먼저 읽음
+        vllm_resp.raise_for_status()
+        yield ("start", sent_at, node.base_url)
+
+        first_token_at = None
+        last_token_at = None
+        tokens = 0
+        pending_done = None  # usage 청크를 기다리는 종료 이벤트
+        stream_finished = False
+        created_at_cache = CreatedAtCache()
+        # 마감은 업스트림 읽기 대기에만 적용 (yield로 넘긴 뒤 소비자 처리 시간은 제외)
+        read_deadline = (lambda: deadline) if deadline is not None or UPSTREAM_CHUNK_TIMEOUT > 0 else None
+        try:
+            async for line, received_at in aiter_sse_data(vllm_resp, read_deadline):
+                if not line:
+                    continue
+                if should_log_token():
+                    log.debug(f"vLLM 원본 줄: {line.decode('utf-8', 'replace')}")
+                # 최종 청크 이후 남은 줄은 업스트림 커넥션을 풀에 반납할 수 있도록 끝까지 읽기만 함
+                if line == b"[DONE]" or stream_finished:
+                    continue
+
+                try:
+                    chunk = json_loads(line)
+                except Exception as e:
+                    log.warning(f"스트림 파싱 오류: {e} / 원본: {line[:200].decode('utf-8', 'replace')}")
+                    continue
+
+                if not chunk.get("choices"):
+                    # include_usage 요청 시 vLLM은 choices 없이 usage만 담은 청크를 마지막에 보냄
+                    if pending_done is not None and chunk.get("usage"):
+                        yield (*pending_done[:2], chunk["usage"], *pending_done[3:])
+                        pending_done = None
+                        stream_finished = True
+                    else:
+                        log.debug(f"처리하지 않은 vLLM 스트림 청크: {chunk}")
+                    continue
+
+                choice = chunk["choices"][0]
+                content = (choice.get("delta") or {}).get("content") or ""
+                finish_reason = choice.get("finish_reason")
+                created_at = created_at_cache.get(chunk.get("created"))
+                if content:
+                    tokens += 1
+                    if first_token_at is None:
+                        first_token_at = received_at
+                        metric_upstream_ttft.observe(received_at - sent_at, model, node.base_url)
+                        hedge_policy.observe(model, received_at - sent_at)
+                    else:
+                        metric_inter_token.observe(received_at - last_token_at, model, node.base_url)
+                    last_token_at = received_at
+                    deadline = loop.time() + UPSTREAM_CHUNK_TIMEOUT if UPSTREAM_CHUNK_TIMEOUT > 0 else None
+                    yield ("delta", content, created_at, received_at)
+                if finish_reason is not None:
+                    metric_upstream_latency.observe(received_at - sent_at, model, node.base_url)
+                    if tokens > 1 and last_token_at > first_token_at:
+                        metric_tokens_per_second.observe((tokens - 1) / (last_token_at - first_token_at), model, node.base_url)
+                    done = ("done", finish_reason, chunk.get("usage"), created_at, received_at)
+                    if done[2] or not UPSTREAM_USAGE:
+                        yield done
+                        stream_finished = True
+                    else:
+                        pending_done = done
+        except TimeoutError:
+            raise upstream_timeout_error("first_token" if first_token_at is None else "chunk", node) from None
+
+        # usage 청크 없이 스트림이 끝난 경우 (구버전 vLLM 등)
+        if pending_done is not None:
+            yield pending_done
+    finally:
+        await vllm_resp.aclose()
+
+
+def is_node_failure(exc):
+    # 연결 실패 / 타임아웃 / 5xx는 노드 상태 문제 (4xx는 요청 자체의 문제)
+    return isinstance(exc, httpx.RequestError) or exc.response.status_code >= 500
+
+
+async def node_events(node, openai_payload):
+    # 노드 1곳에 대한 시도: 처리 중 요청 수와 성공 / 실패를 레지스트리에 기록
+    node.outstanding += 1
+    node.stats["requests"] += 1
+    try:
+        async for event in stream_upstream_events(node, openai_payload):
+            yield event
+        upstream_registry.record_success(node)
+    except (httpx.RequestError, httpx.HTTPStatusError) as exc:
+        metric_errors.inc(classify_error(exc))
+        if is_node_failure(exc):
+            upstream_registry.record_failure(node, exc)
+        raise
+    finally:
+        node.outstanding -= 1
+
+
+# ===============================================================
+# 재시도 예산
+# → 재시도와 hedge 요청은 같은 예산을 사용: 최근 10초 동안의 추가 시도가
+#   (요청 수 x BRIDGE_RETRY_BUDGET_RATIO + 초당 최소 허용량 x 10)을 넘지 않게 제한
+# → vLLM이 과부하로 실패하기 시작해도 재시도가 부하를 몇 배로 키우지 않음
+# ===============================================================
+class RetryBudget:
+    WINDOW_SECONDS = 10
+
+    def __init__(self, ratio, min_per_second):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.slots = deque()  # [초, 요청 수, 추가 시도 수]
+        self.requests = 0  # 창 안의 합계
+        self.spent = 0
+        self.stats = {"deposits": 0, "withdrawals": 0, "exhausted": 0}
+
+    def current_slot(self):
+        now = int(time.monotonic())
+        while self.slots and self.slots[0][0] <= now - self.WINDOW_SECONDS:
+            _, requests, spent = self.slots.popleft()
+            self.requests -= requests
+            self.spent -= spent
+        if not self.slots or self.slots[-1][0] != now:
+            self.slots.append([now, 0, 0])
+        return self.slots[-1]
+
+    def allowance(self):
+        return self.requests * self.ratio + self.min_per_second * self.WINDOW_SECONDS
+
+    def deposit(self):
+        self.current_slot()[1] += 1
+        self.requests += 1
+        self.stats["deposits"] += 1
+
+    def withdraw(self):
+        slot = self.current_slot()
+        if self.spent + 1 > self.allowance():
+            self.stats["exhausted"] += 1
+            return False
+        slot[2] += 1
+        self.spent += 1
+        self.stats["withdrawals"] += 1
+        return True
+
+    def snapshot(self):
+        self.current_slot()
+        return {
+            "ratio": self.ratio,
+            "min_per_second": self.min_per_second,
+            "window_requests": self.requests,
+            "window_spent": self.spent,
+            "available": max(0, math.floor(self.allowance() - self.spent)),
+            **self.stats,
+        }
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND)
+
+
+def retry_backoff(retry):
+    # full jitter: 0 ~ min(상한, 기준값 x 2^(n-1)) 사이 무작위 (동시에 실패한 요청들이 한꺼번에 몰리지 않도록)
+    return random.uniform(0, min(UPSTREAM_RETRY_BACKOFF_MAX_MS, UPSTREAM_RETRY_BACKOFF_MS * 2 ** (retry - 1))) / 1000
+
+
+
+
+
+# ===============================================================
+# Hedged 요청 (BRIDGE_HEDGE_PERCENTILE > 0)
+# → 첫 토큰이 모델별 최근(BRIDGE_HEDGE_WINDOW_SECONDS 이내) 업스트림 TTFT의 백분위 기준을 넘도록 오지 않으면
+#   다른 노드(없으면 같은 노드의 다른 슬롯)로 같은 요청을 한 번 더 보냄
+# → 먼저 첫 토큰(또는 종료)을 받은 쪽을 사용하고 나머지는 취소하여 vLLM에서도 생성이 중단되게 함
+# → 각 시도는 별도 태스크에서 실행되어 이벤트를 큐로 전달 (기준값이 준비된 요청만 이 경로를 사용)
+# → hedge도 재시도 예산을 소비하므로 vLLM 전체가 느려진 상황에서 복제 요청이 부하를 키우지 않음
+# ===============================================================
+class HedgePolicy:
+    RECOMPUTE_EVERY = 16  # 표본이 이만큼 쌓이거나
+    RECOMPUTE_INTERVAL = 1.0  # 이 시간(초)이 지나면 백분위 재계산
+
+    def __init__(self, percentile, window, max_age, min_samples, min_delay):
+        self.percentile = percentile
+        self.window = window
+        self.max_age = max_age
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.samples = {}  # model -> 최근 (관측 시각, TTFT 초)
+        self.observed = {}  # model -> 누적 표본 수
+        self.thresholds = {}  # model -> (계산 시점 누적 표본 수, 계산 시각, 백분위 값 또는 None)
+        self.stats = {"fired": 0, "won": 0, "lost": 0, "failed": 0, "budget_exhausted": 0, "no_threshold": 0}
+
+    def enabled(self):
+        return self.percentile > 0
+
+    def observe(self, model, seconds):
+        samples = self.samples.get(model)
+        if samples is None:
+            samples = self.samples[model] = deque(maxlen=self.window)
+        samples.append((time.monotonic(), seconds))
+        self.observed[model] = self.observed.get(model, 0) + 1
+
+    def compute(self, model, now):
+        # 오래된 표본은 버려서, 느린 노드 / 과부하 구간의 값이 기준을 계속 붙잡지 않게 함
+        samples = self.samples[model]
+        while samples and now - samples[0][0] > self.max_age:
+            samples.popleft()
+        if len(samples) < self.min_samples:
+            return None
+        ordered = sorted(seconds for _, seconds in samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def delay(self, model):
+        if model not in self.samples:
+            self.stats["no_threshold"] += 1
+            return None
+        now = time.monotonic()
+        cached = self.thresholds.get(model)
+        if cached is None or self.observed[model] - cached[0] >= self.RECOMPUTE_EVERY or now - cached[1] >= self.RECOMPUTE_INTERVAL:
+            cached = self.thresholds[model] = (self.observed[model], now, self.compute(model, now))
+        if cached[2] is None:
+            self.stats["no_threshold"] += 1
+            return None
+        return max(cached[2], self.min_delay)
+
+    def snapshot(self):
+        decided = self.stats["won"] + self.stats["lost"]
+        return {
+            "enabled": self.enabled(),
+            "percentile": self.percentile,
+            "min_delay_ms": round(self.min_delay * 1000, 1),
+            "window_seconds": self.max_age,
+            "thresholds_ms": {model: round(max(value, self.min_delay) * 1000, 1) for model, (_, _, value) in self.thresholds.items() if value is not None},
+            **self.stats,
+            "win_rate": round(self.stats["won"] / decided, 3) if decided else None,
+        }
+
+
+hedge_policy = HedgePolicy(HEDGE_PERCENTILE, HEDGE_WINDOW, HEDGE_WINDOW_SECONDS, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY_MS / 1000)
+
+
+class UpstreamAttempt:
+    # 노드 1곳에 대한 시도를 태스크로 실행; 이벤트 / 종료(None) / 예외를 (시도, 항목) 형태로 큐에 넣음
+    def __init__(self, node, openai_payload, results, hedge=False):
+        self.node = node
+        self.hedge = hedge
+        self.start_event = None
+        self.task = asyncio.create_task(self.run(openai_payload, results))
+
+    async def run(self, openai_payload, results):
+        try:
+            async for event in node_events(self.node, openai_payload):
+                results.put_nowait((self, event))
+            results.put_nowait((self, None))
         except Exception as exc:
-            print(f"--- VLLM 모델 목록 처리 중 오류: {exc} ---")
-            return Response(
-                content=json.dumps({"error": f"VLLM 모델 목록 처리 중 오류 발생: {exc}"}, ensure_ascii=False, separators=(",", ":")),
-                status_code=500,
-                media_type="application/json"
+            results.put_nowait((self, exc))
+
+
+async def hedged_events(node, openai_payload, tried, delay):
+    model = openai_payload["model"]
+    results = asyncio.Queue()
+    attempts = [UpstreamAttempt(node, openai_payload, results)]
+    hedge_at = asyncio.get_running_loop().time() + delay
+    hedged = False
+    try:
+        # 1) 첫 토큰(또는 종료)을 먼저 받은 시도를 고름
+        while True:
+            try:
+                async with asyncio.timeout_at(hedge_at):
+                    attempt, item = await results.get()
+            except TimeoutError:
+                hedge_at = None
+                if not retry_budget.withdraw():
+                    hedge_policy.stats["budget_exhausted"] += 1
+                    metric_hedges.inc("budget_exhausted")
+                    continue
+                busy = tried + [a.node for a in attempts]
+                hedge_node = upstream_registry.pick(model, None, busy) or node
+                attempts.append(UpstreamAttempt(hedge_node, openai_payload, results, hedge=True))
+                hedged = True
+                hedge_policy.stats["fired"] += 1
+                metric_hedges.inc("fired")
+                log.info("hedge 요청 전송", extra={"fields": {"upstream": hedge_node.base_url, "primary": node.base_url, "delay_ms": round(delay * 1000, 1)}})
+                continue
+            if isinstance(item, Exception):
+                attempts.remove(attempt)
+                if attempt.hedge:
+                    hedge_policy.stats["failed"] += 1
+                    metric_hedges.inc("failed")
+                if not attempts:
+                    raise item
+                continue
+            if item is not None and item[0] == "start":
+                attempt.start_event = item
+                continue
+            winner = attempt
+            break
+
+        # 2) 나머지 시도 취소 (커넥션이 닫히면 vLLM도 해당 생성을 중단)
+        #    취소는 한 번만 보내고 끝날 때까지 기다림: 응답을 닫는 도중 다시 취소되면
+        #    커넥션이 풀에 사용 중으로 남고 vLLM도 계속 생성함
+        losers = [other.task for other in attempts if other is not winner]
+        for task in losers:
+            task.cancel()
+        if losers:
+            await asyncio.wait(losers)
+        if hedged and len(attempts) > 1:
+            result = "won" if winner.hedge else "lost"
+            hedge_policy.stats[result] += 1
+            metric_hedges.inc(result)
+        elif hedged and winner.hedge:
+            # 원래 요청이 실패한 뒤 hedge가 응답한 경우도 hedge 덕분에 받은 응답
+            hedge_policy.stats["won"] += 1
+            metric_hedges.inc("won")
+
+        # 3) 선택된 시도의 이벤트만 전달
+        if winner.start_event is not None:
+            yield winner.start_event
+        while True:
+            if attempt is winner:
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            attempt, item = await results.get()
+    finally:
+        # asyncio.wait는 자신이 취소되어도 기다리던 태스크를 다시 취소하지 않음
+        pending = [other.task for other in attempts if not other.task.done()]
+        for task in pending:
+            if not task.cancelling():
+                task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+
+# ===============================================================
+# 업스트림 노드 선택 + 첫 토큰 전까지의 fail-over / 재시도
+# → 아직 시도하지 않은 노드가 있으면 바로 fail-over, 모두 시도했으면 jitter backoff 후 재시도
+#   (모델 없음(404)은 같은 노드에 다시 보내지 않음)
+# → 추가 시도는 최대 BRIDGE_UPSTREAM_RETRIES회, 재시도 예산이 남아 있을 때만
+# → 첫 토큰을 보낸 뒤의 실패는 클라이언트가 이미 일부를 받았으므로 그대로 전달
+# ===============================================================
+async def upstream_events(openai_payload, affinity_key=None):
+    model = openai_payload["model"]
+    tried = []
+    retries = 0
+    retry_budget.deposit()
+    while True:
+        node = upstream_registry.pick(model, affinity_key, tried) or (upstream_registry.pick(model, affinity_key) if tried else None)
+        if node is None:
+            raise httpx.ConnectError(f"'{model}' 모델을 처리할 수 있는 vLLM 업스트림이 없음")
+        tried.append(node)
+        delay = hedge_policy.delay(model) if hedge_policy.enabled() else None
+        source = hedged_events(node, openai_payload, tried, delay) if delay is not None else node_events(node, openai_payload)
+        started = False
+        try:
+            async with aclosing(source) as events:
+                async for event in events:
+                    if event[0] != "start":
+                        started = True
+                    yield event
+            return
+        except (httpx.RequestError, httpx.HTTPStatusError) as exc:
+            untried = upstream_registry.pick(model, None, tried) is not None
+            if started or not is_failover_error(exc) or retries >= UPSTREAM_RETRIES or not (untried or is_node_failure(exc)):
+                raise
+            if not retry_budget.withdraw():
+                metric_upstream_retries.inc("budget_exhausted")
+                log.warning("재시도 예산 소진", extra={"fields": {"upstream": node.base_url, "error": exc}})
+                raise
+            retries += 1
+            metric_upstream_retries.inc("failover" if untried else "retry")
+            log.warning("업스트림 fail-over" if untried else "업스트림 재시도", extra={"fields": {"upstream": node.base_url, "retry": retries, "error": exc}})
+            if not untried:
+                await asyncio.sleep(retry_backoff(retries))
+
+
+
+
+
+# ===============================================================
+# 결정적(deterministic) 응답 캐시
+# → temperature 0 또는 seed 고정 요청만 캐시 (같은 입력 → 같은 출력)
+# → 정규화된 openai_payload 해시를 키로 사용, 바이트 예산 기반 LRU + TTL
+# ===============================================================
+def is_deterministic_payload(openai_payload):
+    return openai_payload.get("temperature") == 0 or openai_payload.get("seed") is not None
+
+
+def payload_hash(openai_payload):
+    # stream 여부는 결과에 영향이 없으므로 키에서 제외
+    normalized = {k: v for k, v in openai_payload.items() if k != "stream"}
+    encoded = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ResponseCache:
+    ENTRY_OVERHEAD_BYTES = 256  # 키/메타데이터 대략치
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, size, events)
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        expires_at, size, events = entry
+        if expires_at < time.monotonic():
+            self.remove(key)
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return events
+
+    def put(self, key, events):
+        size = self.ENTRY_OVERHEAD_BYTES + sum(len(e[1].encode("utf-8")) for e in events if e[0] == "delta")
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, events)
+        self.bytes += size
+        self.stats["stores"] += 1
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.stats["evictions"] += 1
+
+    def remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def snapshot(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes, **self.stats}
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+
+
+def compact_events(events):
+    # 캐시에 저장할 때는 delta를 하나로 합쳐 보관 (재생 시 청크 1개 + 종료 청크)
+    deltas = [e[1] for e in events if e[0] == "delta"]
+    done = events[-1]
+    # usage가 없으면 재생 시 eval_count가 1이 되지 않도록 원래 delta 개수를 기록
+    usage = done[2] or {"completion_tokens": len(deltas)}
+    return [("delta", "".join(deltas), done[3], done[4]), ("done", done[1], usage, done[3], done[4])]
+
+
+async def load_cached_events(cache_key):
+    # 멀티 워커 모드에서는 공유 상태 서버의 캐시 사용 (다른 워커가 저장한 응답도 재사용)
+    if shared_state.enabled():
+        try:
+            events = await shared_state.call("cache_get", key=cache_key)
+            return None if events is None else [tuple(e) for e in events]
+        except SharedStateError:
+            pass
+    return response_cache.get(cache_key)
+
+
+async def store_cached_events(cache_key, events):
+    if shared_state.enabled():
+        try:
+            await shared_state.call("cache_put", key=cache_key, events=events)
+            return
+        except SharedStateError:
+            pass
+    response_cache.put(cache_key, events)
+
+
+async def replay_events(events):
+    # 측정 시각은 재생 시점 기준으로 다시 기록
+    for event in events:
+        if event[0] == "delta":
+            yield ("delta", event[1], event[2], time.perf_counter())
+        elif event[0] == "done":
+            yield ("done", event[1], event[2], event[3], time.perf_counter())
+
+
+
+
+
+# ===============================================================
+# 동시 실행 제한 및 우선순위 대기열 (admission control)
+# → 전체/모델별 동시 생성 수를 넘는 요청은 대기열에서 기다림
+# → 대기열에서는 우선순위 클래스 → 현재 실행 중인 요청이 적은 클라이언트 → 도착 순으로 선택
+# → 대기열이 가득 차면 즉시 429, 너무 오래 기다리면 503 (둘 다 Retry-After 포함)
+# ===============================================================
+class AdmissionRejectedError(Exception):
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    def __init__(self, model, client, priority, seq):
+        self.model = model
+        self.client = client
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted = asyncio.get_running_loop().create_future()
+        self.granted_at = None
+        self.released = False
+
+
+class AdmissionController:
+    def __init__(self):
+        self.active = 0
+        self.active_by_model = {}
+        self.active_by_client = {}
+        self.waiters = []
+        self.seq = 0
+        self.service_time_ewma = 1.0  # 최근 요청 처리 시간 (Retry-After 추정용)
+        self.recent_waits = deque(maxlen=1024)
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0, "cancelled_waiting": 0}
+
+    def model_limit(self, model):
+        return ADMISSION_MODEL_LIMITS.get(model, ADMISSION_MAX_CONCURRENT_PER_MODEL)
+
+    def can_run(self, model):
+        if ADMISSION_MAX_CONCURRENT > 0 and self.active >= ADMISSION_MAX_CONCURRENT:
+            return False
+        limit = self.model_limit(model)
+        return limit <= 0 or self.active_by_model.get(model, 0) < limit
+
+    def retry_after(self):
+        slots = ADMISSION_MAX_CONCURRENT if ADMISSION_MAX_CONCURRENT > 0 else max(1, self.active)
+        return max(1, math.ceil(self.service_time_ewma * (len(self.waiters) + 1) / slots))
+
+    async def acquire(self, model, client, priority):
+        if len(self.waiters) >= ADMISSION_QUEUE_MAX and not self.can_run(model):
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejectedError(429, "대기열이 가득 참", self.retry_after())
+
+        self.seq += 1
+        ticket = AdmissionTicket(model, client, priority, self.seq)
+        self.waiters.append(ticket)
+        self.dispatch()
+        if not ticket.granted.done():
+            self.stats["queued"] += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket.granted), timeout=ADMISSION_QUEUE_TIMEOUT or None)
+            except asyncio.TimeoutError:
+                self.abandon(ticket)
+                self.stats["rejected_timeout"] += 1
+                raise AdmissionRejectedError(503, "대기 시간 초과", self.retry_after())
+            except asyncio.CancelledError:
+                # 대기 중 클라이언트 연결 종료
+                self.abandon(ticket)
+                self.stats["cancelled_waiting"] += 1
+                raise
+        self.recent_waits.append(time.monotonic() - ticket.enqueued_at)
+        self.stats["admitted"] += 1
+        return ticket
+
+    def abandon(self, ticket):
+        if ticket in self.waiters:
+            self.waiters.remove(ticket)
+        elif ticket.granted.done():
+            # 배정과 취소가 엇갈린 경우 슬롯 반환
+            self.release(ticket)
+
+    def dispatch(self):
+        while self.waiters:
+            runnable = [t for t in self.waiters if self.can_run(t.model)]
+            if not runnable:
+                return
+            ticket = min(runnable, key=lambda t: (t.priority, self.active_by_client.get(t.client, 0), t.seq))
+            self.waiters.remove(ticket)
+            self.active += 1
+            self.active_by_model[ticket.model] = self.active_by_model.get(ticket.model, 0) + 1
+            self.active_by_client[ticket.client] = self.active_by_client.get(ticket.client, 0) + 1
+            ticket.granted_at = time.monotonic()
+            ticket.granted.set_result(True)
+
+    def release(self, ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        self.active -= 1
+        self.active_by_model[ticket.model] -= 1
+        if not self.active_by_model[ticket.model]:
+            del self.active_by_model[ticket.model]
+        self.active_by_client[ticket.client] -= 1
+        if not self.active_by_client[ticket.client]:
+            del self.active_by_client[ticket.client]
+        self.service_time_ewma = 0.9 * self.service_time_ewma + 0.1 * (time.monotonic() - ticket.granted_at)
+        self.dispatch()
+
+    def snapshot(self):
+        now = time.monotonic()
+        waits = sorted(self.recent_waits)
+        depth_by_priority = {name: 0 for name in PRIORITY_CLASSES}
+        for t in self.waiters:
+            depth_by_priority[PRIORITY_CLASSES[t.priority]] += 1
+        return {
+            "active": self.active,
+            "active_by_model": dict(self.active_by_model),
+            "queue_depth": len(self.waiters),
+            "queue_depth_by_priority": depth_by_priority,
+            "oldest_wait_seconds": round(max((now - t.enqueued_at for t in self.waiters), default=0.0), 3),
+            "wait_p50_seconds": round(waits[len(waits) // 2], 4) if waits else 0.0,
+            "wait_p99_seconds": round(waits[min(len(waits) - 1, int(len(waits) * 0.99))], 4) if waits else 0.0,
+            "limits": {"workers": WORKER_COUNT, "global": ADMISSION_MAX_CONCURRENT, "per_model": ADMISSION_MAX_CONCURRENT_PER_MODEL, "models": ADMISSION_MODEL_LIMITS, "queue_max": ADMISSION_QUEUE_MAX},
+            **self.stats,
+        }
+
+
+admission = AdmissionController()
+
+
+def resolve_priority(headers, model, prompt_chars):
+    # 우선순위: 클라이언트 헤더 > 모델별 설정 > 프롬프트 길이 > 기본(interactive)
+    for name in (headers.get(PRIORITY_HEADER, "").strip().lower(), PRIORITY_MODEL_CLASSES.get(model, "").strip().lower()):
+        if name in PRIORITY_CLASSES:
+            return PRIORITY_CLASSES.index(name)
+    if PRIORITY_LONG_PROMPT_CHARS > 0 and prompt_chars >= PRIORITY_LONG_PROMPT_CHARS:
+        return PRIORITY_CLASSES.index("batch")
+    return PRIORITY_CLASSES.index("interactive")
+
+
+def resolve_client_id(request):
+    return request.headers.get(CLIENT_ID_HEADER) or (request.client.host if request.client else "unknown")
+
+
+def admission_rejected_response(exc):
+    return Response(
+        content=json.dumps({"error": f"브릿지 과부하: {exc.reason}"}, ensure_ascii=False, separators=(",", ":")),
+        status_code=exc.status_code,
+        headers={"Retry-After": str(exc.retry_after)},
+        media_type="application/json"
+    )
+
+
+
+
+
+# ===============================================================
+# 진행 중인 동일 요청 공유 (in-flight de-duplication)
+# → 동일한 요청이 동시에 들어오면 업스트림 생성 하나에 붙여 이벤트를 모든 대기자에게 fan-out
+# → 늦게 붙은 요청도 처음부터 이벤트를 재생받음
+# → 구독자가 모두 떠나면(클라이언트 연결 종료) 업스트림 생성 취소
+# ===============================================================
+class InflightGeneration:
+    def __init__(self, openai_payload, cache_key, affinity_key=None, ticket=None):
+        self.events = []
+        self.error = None
+        self.finished = False  # 업스트림 처리 완전 종료 여부
+        self.completed = False  # done 이벤트 수신 여부 (이후는 커넥션 정리만 남음)
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.abort_reason = "cancelled"
+        self.task = asyncio.create_task(self.run(openai_payload, cache_key, affinity_key))
+        if ticket is not None:
+            # 태스크가 시작 전에 취소되어도 슬롯이 반환되도록 done 콜백에서 해제
+            self.task.add_done_callback(lambda _: admission.release(ticket))
+
+    async def run(self, openai_payload, cache_key, affinity_key):
+        generated = 0
+        try:
+            async with asyncio.timeout(MAX_GENERATION_SECONDS or None):
+                async with aclosing(upstream_events(openai_payload, affinity_key)) as source:
+                    async for event in source:
+                        self.events.append(event)
+                        if event[0] == "delta":
+                            generated += 1
+                        elif event[0] == "done":
+                            self.completed = True
+                            generation_aborts.record_completion(generated)
+                        self.notify()
+            # 태스크 종료(중복 요청 공유 해제) 전에 저장하여 같은 요청이 캐시와 공유 모두 놓치는 틈이 없게 함
+            if cache_key is not None and self.completed and self.events[-1][1] is not None:
+                await store_cached_events(cache_key, compact_events(self.events))
+        except TimeoutError:
+            # 최대 생성 시간 초과: 업스트림은 aclosing으로 이미 닫힘, 구독자에게는 잘린 응답으로 종료 통지
+            if not self.completed:
+                self.completed = True
+                generation_aborts.record_abort("max_generation_time", generated, openai_payload)
+                self.events.append(("done", "length", None, get_current_ollama_created_at_format(), time.perf_counter()))
+                metric_errors.inc("max_generation_time")
+        except asyncio.CancelledError:
+            if not self.completed:
+                generation_aborts.record_abort(self.abort_reason, generated, openai_payload)
+                metric_errors.inc(self.abort_reason)
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.finished = True
+            self.notify()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                if index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                    continue
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self.changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.completed and not self.task.done():
+                # 모든 클라이언트가 떠남: 업스트림 요청을 닫아 vLLM이 시퀀스를 중단하게 함
+                self.abort_reason = "client_disconnect"
+                self.task.cancel()
+
+
+inflight_generations = {}
+inflight_stats = {"generations": 0, "attached": 0}
+
+
+# ===============================================================
+# 조기 중단 통계
+# → 중단 시점까지 생성된 delta 수와 평소 생성 길이(EWMA)로 절약된 토큰 수를 추정
+# ===============================================================
+class GenerationAbortStats:
+    def __init__(self):
+        self.expected_tokens = float(ABORT_EXPECTED_TOKENS)
+        self.stats = {"client_disconnect": 0, "max_generation_time": 0, "cancelled": 0, "tokens_generated_before_abort": 0, "estimated_tokens_saved": 0}
+
+    def record_completion(self, generated):
+        self.expected_tokens = 0.95 * self.expected_tokens + 0.05 * generated
+
+    def record_abort(self, reason, generated, openai_payload):
+        expected = self.expected_tokens
+        if openai_payload.get("max_tokens"):
+            expected = min(expected, openai_payload["max_tokens"])
+        self.stats[reason] = self.stats.get(reason, 0) + 1
+        self.stats["tokens_generated_before_abort"] += generated
+        self.stats["estimated_tokens_saved"] += max(0, int(expected) - generated)
+        log.info("생성 중단", extra={"fields": {"reason": reason, "generated": generated}})
+
+    def snapshot(self):
+        return {"expected_tokens": round(self.expected_tokens, 1), "max_generation_seconds": MAX_GENERATION_SECONDS, **self.stats}
+
+
+generation_aborts = GenerationAbortStats()
+
+
+async def acquire_generation(request, openai_payload, dedup_key, cache_key, affinity_key, prompt_chars):
+    # 진행 중인 동일 요청이 있으면 대기열을 거치지 않고 바로 합류
+    generation = inflight_generations.get(dedup_key) if dedup_key else None
+    if generation is None:
+        model = openai_payload["model"]
+        priority = resolve_priority(request.headers, model, prompt_chars)
+        ticket = await admission.acquire(model, resolve_client_id(request), priority)
+        add_request_log_fields(priority=PRIORITY_CLASSES[priority])
+        # 대기하는 동안 같은 요청이 먼저 시작했을 수 있음
+        generation = inflight_generations.get(dedup_key) if dedup_key else None
+        if generation is None:
+            generation = InflightGeneration(openai_payload, cache_key, affinity_key, ticket)
+            inflight_stats["generations"] += 1
+            if dedup_key:
+                inflight_generations[dedup_key] = generation
+                generation.task.add_done_callback(
+                    lambda _: inflight_generations.pop(dedup_key, None) if inflight_generations.get(dedup_key) is generation else None
+                )
+            return generation
+        admission.release(ticket)
+
+    inflight_stats["attached"] += 1
+    add_request_log_fields(inflight="attached")
+    return generation
+
+
+
+
+
+# ===============================================================
+# 로컬 토크나이저 기반 토큰 수 계산 (vLLM usage가 없을 때의 대체 경로)
+# → 토크나이저는 모델별로 처음 필요할 때 한 번만 로드 (동시 요청은 같은 로드를 기다림)
+# → 메시지별 토큰 수를 LRU 캐시에 보관하여 매 턴 반복되는 긴 시스템 프롬프트/파일 컨텍스트는 다시 토큰화하지 않음
+# → 토큰화는 전용 스레드 풀에서 실행하여 이벤트 루프를 막지 않음
+# ===============================================================
+class TokenCounter:
+    def __init__(self, sources, cache_entries, threads):
+        self.sources = sources  # 모델 -> 토크나이저 위치
+        self.tokenizers = {}  # 모델 -> 로드 태스크 (결과가 None이면 로드 실패)
+        self.cache = OrderedDict()  # (모델, 메시지 해시) -> 토큰 수
+        self.cache_entries = cache_entries
+        self.threads = threads
+        self.executor = None
+        self.stats = {"usage_from_upstream": 0, "tokenized": 0, "cache_hits": 0, "cache_misses": 0, "estimated": 0, "load_errors": 0}
+
+    def has_tokenizer(self, model):
+        return model in self.sources
+
+    def run(self, fn, *args):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.threads), thread_name_prefix="tokenizer")
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    @staticmethod
+    def load(source):
+        from tokenizers import Tokenizer  # 선택적 의존성
+        if os.path.exists(source):
+            return Tokenizer.from_file(source)
+        return Tokenizer.from_pretrained(source)
+
+    async def load_tokenizer(self, model):
+        source = self.sources[model]
+        if importlib.util.find_spec("tokenizers") is None:
+            log.warning("BRIDGE_TOKENIZERS 설정됨, 그러나 tokenizers 패키지가 없어 문자 수로 추정", extra={"fields": {"model": model}})
+            self.stats["load_errors"] += 1
+            return None
+        try:
+            tokenizer = await self.run(self.load, source)
+        except Exception as exc:
+            log.warning("토크나이저 로드 실패", extra={"fields": {"model": model, "source": source, "error": exc}})
+            self.stats["load_errors"] += 1
+            return None
+        log.info("토크나이저 로드 완료", extra={"fields": {"model": model, "source": source}})
+        return tokenizer
+
+    async def tokenizer(self, model):
+        if model not in self.sources:
+            return None
+        task = self.tokenizers.get(model)
+        if task is None:
+            task = self.tokenizers[model] = asyncio.ensure_future(self.load_tokenizer(model))
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def encode_lengths(tokenizer, texts):
+        return [len(encoding.ids) for encoding in tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+    async def count_messages(self, model, messages):
+        tokenizer = await self.tokenizer(model)
+        if tokenizer is None:
+            self.stats["estimated"] += 1
+            return sum(len(m.get("content") or "") for m in messages)
+
+        counts = {}  # 캐시 키 -> 토큰 수
+        missing = {}  # 캐시 키 -> 텍스트 (같은 요청 안의 중복 메시지는 한 번만 토큰화)
+        keys = []
+        for message in messages:
+            text = f"{message.get('role', '')}\n{message.get('content') or ''}"
+            key = (model, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+            keys.append(key)
+            if key in counts or key in missing:
+                continue
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                counts[key] = cached
+            else:
+                missing[key] = text
+                self.stats["cache_misses"] += 1
+
+        if missing:
+            lengths = await self.run(self.encode_lengths, tokenizer, list(missing.values()))
+            self.stats["tokenized"] += len(lengths)
+            counts.update(zip(missing, lengths))
+            if self.cache_entries > 0:
+                for key in missing:
+                    self.cache[key] = counts[key]
+                while len(self.cache) > self.cache_entries:
+                    self.cache.popitem(last=False)
+        return sum(counts[key] for key in keys)
+
+    async def count_text(self, model, text, fallback):
+        tokenizer = await self.tokenizer(model)
+        if tokenizer is None:
+            return fallback
+        lengths = await self.run(self.encode_lengths, tokenizer, [text])
+        self.stats["tokenized"] += 1
+        return lengths[0]
+
+    def snapshot(self):
+        return {
+            "upstream_usage": UPSTREAM_USAGE,
+            "tokenizer_models": sorted(self.sources),
+            "tokenizers_loaded": sorted(m for m, t in self.tokenizers.items() if t.done() and not t.cancelled() and t.result() is not None),
+            "cache_entries": len(self.cache),
+            **self.stats,
+        }
+
+
+token_counter = TokenCounter(TOKENIZER_MODELS, TOKENIZER_CACHE_ENTRIES, TOKENIZER_THREADS)
+
+
+
+
+
+# ===============================================================
+# Ollama 응답의 *_duration / *_count 필드 계산
+# → 이벤트에 기록된 실제 측정 시각으로 계산 (모든 값은 perf_counter 기준)
+#   load_duration: 요청 수신 ~ 업스트림 전송 (대기열 + 라우팅)
+#   prompt_eval_duration: 업스트림 전송 ~ 첫 토큰 (prefill)
+#   eval_duration: 첫 토큰 ~ 생성 종료
+# → 진행 중인 생성에 합류한 경우 합류 시점 이전 구간은 0으로 계산
+# → 토큰 수는 vLLM usage 값 사용, 없으면 TokenCounter로 계산
+# ===============================================================
+class ChatAccounting:
+    def __init__(self, start, model, messages):
+        self.start = start
+        self.model = model
+        self.messages = messages
+        self.sent_at = None
+        self.upstream = "cache"  # 응답한 업스트림 (캐시 재생이면 start 이벤트가 없음)
+        self.first_token_at = None
+        self.done_at = None
+        self.deltas = 0
+        # 생성 텍스트는 usage가 없을 때 로컬 토크나이저로 다시 셀 수 있는 경우에만 보관
+        self.content_parts = [] if token_counter.has_tokenizer(model) else None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+
+    def on_event(self, event):
+        kind = event[0]
+        if kind == "delta":
+            self.deltas += 1
+            if self.first_token_at is None:
+                self.first_token_at = event[3]
+            if self.content_parts is not None:
+                self.content_parts.append(event[1])
+        elif kind == "start":
+            self.sent_at = event[1]
+            self.upstream = event[2]
+        else:
+            self.done_at = event[4]
+            usage = event[2]
+            if usage:
+                self.prompt_tokens = usage.get("prompt_tokens")
+                self.completion_tokens = usage.get("completion_tokens")
+
+    async def ollama_fields(self):
+        if self.prompt_tokens is None:
+            self.prompt_tokens = await token_counter.count_messages(self.model, self.messages)
+        else:
+            token_counter.stats["usage_from_upstream"] += 1
+        if self.completion_tokens is None:
+            # vLLM은 토큰마다 delta를 하나씩 보내므로 delta 수가 기본 추정치
+            self.completion_tokens = self.deltas
+            if self.content_parts:
+                self.completion_tokens = await token_counter.count_text(self.model, "".join(self.content_parts), self.deltas)
+
+        now = time.perf_counter()
+        dispatched = max(self.start, self.sent_at) if self.sent_at is not None else self.start
+        first_token = max(dispatched, self.first_token_at or self.done_at or now)
+        done = max(first_token, self.done_at or now)
+        return {
+            "total_duration": int((now - self.start) * 1_000_000_000),
+            "load_duration": int((dispatched - self.start) * 1_000_000_000),
+            "prompt_eval_count": self.prompt_tokens,
+            "prompt_eval_duration": int((first_token - dispatched) * 1_000_000_000),
+            "eval_count": self.completion_tokens,
+            "eval_duration": int((done - first_token) * 1_000_000_000),
+        }
+
+
+
+
+
+# ===============================================================
+# 이벤트 스트림 → Ollama NDJSON 스트리밍 응답
+# ===============================================================
+async def stream_ollama_chat(request, events, requested_model, messages, start_time, coalesce_window_ms):
+    accounting = ChatAccounting(start_time, requested_model, messages)
+    first_chunk_sent = False
+    coalescer = ChunkCoalescer(coalesce_window_ms, COALESCE_MAX_BYTES)
+    encoder = NdjsonChunkEncoder(requested_model)
+    metric_active_streams.inc(requested_model)
+    # 토큰을 쓰는 시점이 아니어도 (예: 긴 prefill 중) 연결 종료를 바로 감지하도록 별도 감시
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        async for event in aiter_with_ticks(events, coalescer.timeout, stop=disconnected):
+            # 병합 시간창 만료: 버퍼에 쌓인 delta 전송
+            if event is None:
+                if coalescer.pending():
+                    yield encoder.chunk(*coalescer.flush())
+                continue
+
+            accounting.on_event(event)
+            kind = event[0]
+            if kind == "delta":
+                if coalescer.add(event[1], event[2]):
+                    chunk_line = encoder.chunk(*coalescer.flush())
+                    now = time.perf_counter()
+                    metric_overhead.observe(now - event[3], requested_model, accounting.upstream)
+                    if not first_chunk_sent:
+                        first_chunk_sent = True
+                        metric_ttft.observe(now - start_time, requested_model, accounting.upstream)
+                    yield chunk_line
+                    if should_log_token():
+                        log.debug(f"브릿지 전송 청크: {chunk_line.rstrip().decode('utf-8')}")
+                continue
+            if kind == "start":
+                continue
+
+            # 최종 응답 청크 전송 (버퍼가 남아 있으면 먼저 전송)
+            _, finish_reason, _, last_created_at, _ = event
+            if coalescer.pending():
+                yield encoder.chunk(*coalescer.flush())
+
+            final_data = {
+                "model": requested_model,
+                "created_at": last_created_at,
+                "message": {
+                    "role": "assistant",
+                    "content": "",
+                },
+                "done_reason": finish_reason or "stop",
+                "done": True,
+                **await accounting.ollama_fields(),
+            }
+            yield f"{json.dumps(final_data, ensure_ascii=False)}\n"
+            add_request_log_fields(
+                model=requested_model,
+                stream=True,
+                done_reason=final_data["done_reason"],
+                prompt_eval_count=final_data["prompt_eval_count"],
+                eval_count=final_data["eval_count"],
+                ttft_ms=round((final_data["load_duration"] + final_data["prompt_eval_duration"]) / 1_000_000, 1),
             )
+            break
+    except httpx.RequestError as exc:
+        error_msg = f"VLLM API 요청 실패: {exc}"
+        log.error(error_msg)
+        yield f"{json.dumps({
+            'model': requested_model,
+            'created_at': get_current_ollama_created_at_format(),
+            'message': {'role': 'assistant', 'content': f'⚠️ VLLM 서버에 연결할 수 없습니다: {exc}'},
+            'done': True
+        }, ensure_ascii=False)}\n"
+    except httpx.HTTPStatusError as exc:
+        error_msg = f"VLLM API HTTP 오류: {exc.response.status_code} - {exc.response.text}"
+        log.error(error_msg)
+        yield f"{json.dumps(
+            {
+                'model': requested_model,
+                'created_at': get_current_ollama_created_at_format(),
+                'message': {'role': 'assistant', 'content': f'⚠️ VLLM 서버에서 오류 응답: {error_msg}'},
+                'done': True
+            }, ensure_ascii=False)}\n"
+    except Exception as exc:
+        error_msg = f"스트리밍 처리 중 예상치 못한 오류: {exc}"
+        log.error(error_msg)
+        metric_errors.inc("stream_internal")
+        yield f"{json.dumps({
+            'model': requested_model,
+            'created_at': get_current_ollama_created_at_format(),
+            'message': {'role': 'assistant', 'content': f'⚠️ 브릿지 서버 스트리밍 오류: {exc}'},
+            'done': True
+        }, ensure_ascii=False)}\n"
+    finally:
+        metric_active_streams.dec(requested_model)
+        if disconnected.done():
+            add_request_log_fields(model=requested_model, stream=True, client_disconnected=True, eval_count=accounting.deltas)
+        else:
+            disconnected.cancel()
+        coalesce_stats["streams"] += 1
+        coalesce_stats["coalesced_streams"] += 1 if coalesce_window_ms > 0 else 0
+        coalesce_stats["deltas"] += coalescer.deltas
+        coalesce_stats["frames"] += coalescer.frames
+        if coalescer.deltas > coalescer.frames:
+            metric_coalesced_frames_saved.inc(requested_model, amount=coalescer.deltas - coalescer.frames)
+
+
+
+
+
+# ===============================================================
+# 이벤트 스트림 → Ollama 단일 응답 (비스트리밍)
+# ===============================================================
+async def collect_ollama_chat(events, requested_model, messages, start_time):
+    accounting = ChatAccounting(start_time, requested_model, messages)
+    content_parts = []
+    finish_reason = None
+    created_at_str = None
+    try:
+        async for event in events:
+            accounting.on_event(event)
+            if event[0] == "delta":
+                content_parts.append(event[1])
+                created_at_str = event[2]
+            elif event[0] == "done":
+                finish_reason = event[1]
+                created_at_str = event[3]
+    except httpx.RequestError as exc:
+        log.error("VLLM API 요청 실패 (비스트리밍)", extra={"fields": {"error": exc}})
+        return Response(
+            content=json.dumps({
+                "model": requested_model,
+                "created_at": get_current_ollama_created_at_format(),
+                "message": {
+                    "role": "assistant",
+                    "content": f"⚠️ VLLM 서버에 연결할 수 없음: {exc}"
+                },
+                "done": True
+            }, ensure_ascii=False),
+            status_code=500,
+            media_type="application/json"
+        )
+    except httpx.HTTPStatusError as exc:
+        log.error("VLLM API HTTP 오류 (비스트리밍)", extra={"fields": {"status": exc.response.status_code, "body": exc.response.text[:500]}})
+        return Response(
+            content=json.dumps({
+                "model": requested_model,
+                "created_at": get_current_ollama_created_at_format(),
+                "message": {
+                    "role": "assistant",
+                    "content": f'⚠️ VLLM 서버에서 오류 응답: {exc.response.status_code} - {exc.response.text}'
+                },
+                "done": True
+            }, ensure_ascii=False),
+            status_code=exc.response.status_code,
+            media_type="application/json"
+        )
+    except Exception:
+        # 예상치 못한 에러
+        log.exception("VLLM 응답 처리 중 예상치 못한 오류 (비스트리밍)")
+        metric_errors.inc("bridge_internal")
+        return Response(
+            content=json.dumps({
+                "model": requested_model,
+                "created_at": get_current_ollama_created_at_format(),
+                "message": {
+                    "role": "assistant",
+                    "content": "⚠️ vLLM 서버로부터 올바르지 않은 응답 접수; 서버 상태/입력값 확인 필요"
+                },
+                "done": True
+            }, ensure_ascii=False),
+            media_type="application/json"
+        )
+
+    # Ollama 형식에 맞게 최종 응답 구성
+    ollama_response = {
+        "model": requested_model,
+        "created_at": created_at_str or get_current_ollama_created_at_format(),
+        "message": {
+            "role": "assistant",
+            "content": "".join(content_parts),
+        },
+        "done_reason": finish_reason or "stop",
+        "done": finish_reason is not None,
+        **await accounting.ollama_fields(),
+    }
+    add_request_log_fields(
+        model=requested_model,
+        stream=False,
+        done_reason=ollama_response["done_reason"],
+        prompt_eval_count=ollama_response["prompt_eval_count"],
+        eval_count=ollama_response["eval_count"],
+    )
+
+    return Response(
+        content=json.dumps(ollama_response, ensure_ascii=False),
+        media_type="application/json"
+    )
+
+
+
+
+
+# ===============================================================
+# 자주 쓰이는 prompt prefix 추적 (count-min sketch + 상위 후보)
+# → prefix: 마지막 메시지를 제외한 앞쪽 메시지 1..PREFIX_DEPTH개 (시스템 프롬프트, 프로젝트 컨텍스트 등)
+# → 모든 prefix의 빈도는 고정 크기 sketch로만 세고, 메시지 내용은 상위 후보만 보관 (메모리 상한 고정)
+# → 일정 횟수마다 모든 카운터를 절반으로 줄여 오래된 prefix가 자리를 비키도록 함
+# ===============================================================
+class PrefixTracker:
+    SKETCH_ROWS = 4
+
+    def __init__(self, width, track_size, depth, min_chars, min_count):
+        self.width = width
+        self.rows = [[0] * width for _ in range(self.SKETCH_ROWS)]
+        self.track_size = track_size
+        self.depth = depth
+        self.min_chars = min_chars
+        self.min_count = min_count
+        self.entries = {}  # prefix 키 -> {"model", "messages", "chars", "count", "warm_credit"}
+        self.additions = 0
+        self.decay_after = width * 8
+        self.stats = {"observed": 0, "decays": 0, "warm_hits": 0, "prefill_saved_seconds": 0.0}
+
+    def enabled(self):
+        return PREFIX_WARM_TOP > 0 and self.track_size > 0
+
+    def increment(self, key):
+        count = None
+        for row_index, row in enumerate(self.rows):
+            slot = int.from_bytes(key[row_index * 4:row_index * 4 + 4], "little") % self.width
+            row[slot] += 1
+            count = row[slot] if count is None else min(count, row[slot])
+        self.additions += 1
+        if self.additions >= self.decay_after:
+            self.decay()
+        return count
+
+    def decay(self):
+        for row in self.rows:
+            for slot in range(self.width):
+                row[slot] >>= 1
+        for entry in self.entries.values():
+            entry["count"] >>= 1
+        self.additions = 0
+        self.stats["decays"] += 1
+
+    def observe(self, model, messages):
+        if not self.enabled():
+            return
+        self.stats["observed"] += 1
+        digest = hashlib.blake2b(model.encode("utf-8"), digest_size=16)
+        chars = 0
+        for length in range(1, min(self.depth, len(messages) - 1) + 1):
+            message = messages[length - 1]
+            content = message.get("content") or ""
+            chars += len(content)
+            digest.update(f"{message.get('role', '')}\0{content}\0".encode("utf-8"))
+            if chars < self.min_chars:
+                continue
+            key = digest.copy().digest()
+            self.offer(key, model, messages, length, chars, self.increment(key))
+
+    def offer(self, key, model, messages, length, chars, count):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry["count"] = count
+            if entry["warm_credit"]:
+                # 예열 후 처음 들어온 요청: 예열 요청이 대신 치른 prefill 시간을 절약분으로 계산
+                self.stats["warm_hits"] += 1
+                self.stats["prefill_saved_seconds"] += entry["warm_credit"]
+                metric_prefill_saved.inc(model, amount=entry["warm_credit"])
+                entry["warm_credit"] = 0.0
+            return
+        if len(self.entries) >= self.track_size:
+            victim = min(self.entries, key=lambda k: self.entries[k]["count"])
+            if self.entries[victim]["count"] >= count:
+                return
+            del self.entries[victim]
+        self.entries[key] = {"model": model, "messages": messages[:length], "chars": chars, "count": count, "warm_credit": 0.0}
+
+    def top_prefixes(self, model, limit):
+        entries = [e for e in self.entries.values() if e["model"] == model and e["count"] >= self.min_count]
+        entries.sort(key=lambda e: e["count"], reverse=True)
+        return entries[:limit]
+
+    def warm_set_size(self):
+        return sum(1 for e in self.entries.values() if e["count"] >= self.min_count)
+
+
+prefix_tracker = PrefixTracker(PREFIX_SKETCH_WIDTH, PREFIX_TRACK_SIZE, PREFIX_DEPTH, PREFIX_MIN_CHARS, PREFIX_MIN_COUNT)
+
+
+# ===============================================================
+# vLLM prefix 캐시 예열
+# → 모델이 카탈로그에 처음 나타날 때 (해당 모델을 가진 모든 노드) 또는
+#   업스트림이 장애에서 복구될 때 (재시작된 그 노드의 모든 모델) 실행
+# → 상위 prefix마다 max_tokens=1 요청을 하나씩 순서대로 보내 vLLM에 부담을 주지 않음
+# ===============================================================
+class PrefixWarmer:
+    def __init__(self, tracker, top_n):
+        self.tracker = tracker
+        self.top_n = top_n
+        self.running = set()  # (모델 또는 노드) 단위 중복 실행 방지
+        self.tasks = set()
+        self.stats = {"runs": 0, "requests": 0, "failures": 0, "warm_seconds": 0.0, "last_reason": None}
+
+    def schedule(self, reason, model=None, node=None):
+        if not self.tracker.enabled():
+            return
+        key = (model, node.base_url if node is not None else None)
+        if key in self.running:
+            return
+        self.running.add(key)
+        task = asyncio.create_task(self.run(reason, model, node))
+        self.tasks.add(task)
+        task.add_done_callback(lambda t: (self.tasks.discard(t), self.running.discard(key)))
+
+    async def run(self, reason, model, node):
+        models = [model] if model is not None else sorted(node.models)
+        targets = []
+        for name in models:
+            nodes = [node] if node is not None else [n for n in upstream_registry.candidates(name) if n.healthy]
+            targets.extend((n, entry) for entry in self.tracker.top_prefixes(name, self.top_n) for n in nodes)
+        if not targets:
+            return
+        self.stats["runs"] += 1
+        self.stats["last_reason"] = reason
+        log.info("prefix 예열 시작", extra={"fields": {"reason": reason, "model": model, "upstream": node.base_url if node else None, "requests": len(targets)}})
+        for target, entry in targets:
+            await self.prime(target, entry)
+
+    async def prime(self, node, entry):
+        payload = {"model": entry["model"], "messages": entry["messages"], "max_tokens": 1, "temperature": 0, "stream": False}
+        start = time.perf_counter()
+        try:
+            resp = await get_upstream_client().post(node.url(VLLM_API_PATH), json=payload)
+            resp.raise_for_status()
+        except Exception as exc:
+            self.stats["failures"] += 1
+            metric_prefix_warm_requests.inc(entry["model"], "error")
+            log.warning("prefix 예열 실패", extra={"fields": {"upstream": node.base_url, "model": entry["model"], "error": exc}})
+            return
+        elapsed = time.perf_counter() - start
+        self.stats["requests"] += 1
+        self.stats["warm_seconds"] += elapsed
+        metric_prefix_warm_requests.inc(entry["model"], "ok")
+        entry["warm_credit"] = max(entry["warm_credit"], elapsed)
+
+    def snapshot(self):
+        return {
+            "enabled": self.tracker.enabled(),
+            "warm_set_size": self.tracker.warm_set_size(),
+            "tracked_prefixes": len(self.tracker.entries),
+            "top_n": self.top_n,
+            **self.tracker.stats,
+            "prefill_saved_seconds": round(self.tracker.stats["prefill_saved_seconds"], 3),
+            **self.stats,
+            "warm_seconds": round(self.stats["warm_seconds"], 3),
+        }
+
+
+prefix_warmer = PrefixWarmer(prefix_tracker, PREFIX_WARM_TOP)
 
 
 
@@ -181,8 +3121,12 @@ async def list_tags():
 # ===============================================================
 @app.post("/api/chat")
 async def ollama_chat(request: Request):
-    body = await request.json()
-    requested_model = body.get("model")
+    try:
+        chat_request = await read_chat_request(request)
+    except RequestRejectedError as exc:
+        return request_rejected_response(exc)
+    requested_model = chat_request.model
+    messages = chat_request.messages
     if not requested_model:
         # 모델 이름 누락 시 오류 반환
         return Response(
@@ -199,274 +3143,424 @@ async def ollama_chat(request: Request):
             media_type="application/json"
         )
 
-    # 모델별 로딩 시간 추정치 조회
-    current_model_load_duration = model_load_durations.get(requested_model, ESTIMATED_MODEL_LOAD_DURATION_NS)
-
-    # OpenAI API 형식으로 변환
+    # OpenAI API 형식으로 변환 (업스트림은 항상 스트리밍으로 호출, 메시지 목록은 복사하지 않고 그대로 사용)
+    client_stream = chat_request.stream
+    options = chat_request.options
     openai_payload = {
         "model": requested_model,
-        "messages": body["messages"],
-        "temperature": body.get("options", {}).get("temperature", 0.7),
-        "stream": body.get("stream", False),
+        "messages": messages,
+        "temperature": options.get("temperature", 0.7),
+        "stream": True,
     }
-
-    start_time = time.time()
-    estimated_prompt_tokens = sum(len(m.get("content", "")) for m in body["messages"])
+    if options.get("seed") is not None:
+        openai_payload["seed"] = options["seed"]
+    if UPSTREAM_USAGE:
+        openai_payload["stream_options"] = {"include_usage": True}
+
+    start_time = time.perf_counter()
+    prompt_chars = sum(len(m.get("content") or "") for m in messages)
+
+    # 응답 캐시 / 중복 요청 공유용 키 (필요할 때만 해시 계산)
+    deterministic = is_deterministic_payload(openai_payload)
+    use_cache = deterministic and response_cache.enabled()
+    use_dedup = INFLIGHT_DEDUP == "all" or (INFLIGHT_DEDUP == "deterministic" and deterministic)
+    payload_key = payload_hash(openai_payload) if use_cache or use_dedup else None
+    cache_key = payload_key if use_cache else None
+
+    cached_events = await load_cached_events(cache_key) if cache_key else None
+    if cached_events is not None:
+        add_request_log_fields(cache="hit")
+        events = replay_events(cached_events)
+    else:
+        affinity_key = conversation_affinity_key(messages) if UPSTREAM_ROUTING == "prefix_hash" else None
+        dedup_key = payload_key if use_dedup else None
+        prefix_tracker.observe(requested_model, messages)
+        try:
+            generation = await acquire_generation(request, openai_payload, dedup_key, cache_key, affinity_key, prompt_chars)
+        except AdmissionRejectedError as exc:
+            log.warning("요청 대기열 진입 거절", extra={"fields": {"status": exc.status_code, "reason": exc.reason, "retry_after": exc.retry_after}})
+            metric_errors.inc("admission_queue_full" if exc.status_code == 429 else "admission_timeout")
+            return admission_rejected_response(exc)
+        events = generation.subscribe()
 
     # 스트리밍 응답 처리
-    if openai_payload["stream"]:
-        # 비동기 제너레이터로 스트리밍 구현
-        async def stream_vllm():
-
-            # 다양한 응답 메타데이터 변수 초기화
-            accumulated_content = ""
-            get_current_ollama_created_at_format()
-            final_done_reason = None
-            final_prompt_eval_count = estimated_prompt_tokens
-            final_eval_count = 0
-            first_chunk_time = None
-
-            async with httpx.AsyncClient(timeout=None) as client:
-                try:
-                    async with client.stream("POST", VLLM_API_URL, json=openai_payload) as vllm_resp:
-                        vllm_resp.raise_for_status()
-                        async for line in vllm_resp.aiter_lines():
-                            current_log_time = datetime.now(timezone.utc).isoformat(timespec='microseconds')
-                            print(f"[{current_log_time}][vLLM Raw Line]: {line}")
-
-                            line = line.strip()
-                            if not line:
-                                continue
-                            if line.startswith("data: "):
-                                line = line[len("data: "):]
-                            if line == "[DONE]":
-                                continue
-
-                            try:
-                                chunk = json.loads(line)
-                            except Exception as e:
-                                print(f"[stream parse error] {e} / 원본: {line}")
-                                continue
-
-                            # 청크 처리
-                            if "choices" in chunk and chunk["choices"]:
-                                if first_chunk_time is None:
-                                    first_chunk_time = time.time()
-
-                                choice = chunk["choices"][0]
-                                content = choice.get("delta", {}).get("content", "")
-                                finish_reason = choice.get("finish_reason")
-                                done = bool(finish_reason is not None)
-
-                                # 응답 시간 포맷
-                                created_at_str = get_current_ollama_created_at_format()
-                                if "created" in chunk:
-                                    try:
-                                        dt_obj = datetime.fromtimestamp(chunk["created"], tz=timezone.utc)
-                                        created_at_str = dt_obj.isoformat(timespec='microseconds') + 'Z'
-                                    except Exception:
-                                        pass
-                                last_created_at = created_at_str
-
-                                # usage 정보 갱신
-                                if "usage" in chunk:
-                                    usage = chunk["usage"]
-                                    final_prompt_eval_count = usage.get("prompt_tokens", final_prompt_eval_count)
-                                    final_eval_count = usage.get("completion_tokens", final_eval_count)
-
-                                if finish_reason:
-                                    final_done_reason = finish_reason
-
-                                if not done:
-                                    if content:
-                                        accumulated_content += content
-                                        final_eval_count += len(content)
-                                        data = {
-                                            "model": requested_model,
-                                            "created_at": created_at_str,
-                                            "message": {
-                                                "role": "assistant",
-                                                "content": content,
-                                            },
-                                            "done": False,
-                                        }
-                                        yield f"{json.dumps(data, ensure_ascii=False)}\n"
-                                        print(f"[{datetime.now(timezone.utc).isoformat(timespec='microseconds')}][Bridge Sent Chunk]: {json.dumps(data, ensure_ascii=False)}")
-                                else:
-                                    # 최종 응답 청크 전송
-                                    end_time = time.time()
-                                    total_duration = int((end_time - start_time) * 1_000_000_000)
-                                    load_duration_ns = current_model_load_duration
-                                    prompt_eval_duration_ns = int((first_chunk_time - start_time) * 1_000_000_000) if first_chunk_time else 0
-                                    eval_duration_ns = total_duration - prompt_eval_duration_ns
-                                    final_data = {
-                                        "model": requested_model,
-                                        "created_at": last_created_at,
-                                        "message": {
-                                            "role": "assistant",
-                                            "content": "",
-                                        },
-                                        "done_reason": final_done_reason or "stop",
-                                        "done": True,
-                                        "total_duration": total_duration,
-                                        "load_duration": load_duration_ns,
-                                        "prompt_eval_count": final_prompt_eval_count,
-                                        "prompt_eval_duration": prompt_eval_duration_ns,
-                                        "eval_count": final_eval_count,
-                                        "eval_duration": eval_duration_ns
-                                    }
-                                    yield f"{json.dumps(final_data, ensure_ascii=False)}\n"
-                                    print(f"[{datetime.now(timezone.utc).isoformat(timespec='microseconds')}][Bridge Sent DONE Chunk]: {json.dumps(final_data, ensure_ascii=False)}")
-                                    await asyncio.sleep(0.01)
-                                    break
-                            else:
-                                print(f"[stream unhandled vLLM chunk] {chunk}")
-                except httpx.RequestError as exc:
-                    error_msg = f"VLLM API 요청 실패: {exc}"
-                    print(f"--- {error_msg} ---")
-                    yield f"{json.dumps({
-                        'model': requested_model,
-                        'created_at': get_current_ollama_created_at_format(),
-                        'message': {'role': 'assistant', 'content': f'⚠️ VLLM 서버에 연결할 수 없습니다: {exc}'},
-                        'done': True
-                    }, ensure_ascii=False)}\n"
-                except httpx.HTTPStatusError as exc:
-                    error_msg = f"VLLM API HTTP 오류: {exc.response.status_code} - {exc.response.text}"
-                    print(f"--- {error_msg} ---")
-                    yield f"{json.dumps(
-                        {
-                            'model': requested_model,
-                            'created_at': get_current_ollama_created_at_format(),
-                            'message': {'role': 'assistant', 'content': f'⚠️ VLLM 서버에서 오류 응답: {error_msg}'},
-                            'done': True
-                        }, ensure_ascii=False)}\n"
-                except Exception as exc:
-                    error_msg = f"스트리밍 처리 중 예상치 못한 오류: {exc}"
-                    print(f"--- {error_msg} ---")
-                    yield f"{json.dumps({
-                        'model': requested_model,
-                        'created_at': get_current_ollama_created_at_format(),
-                        'message': {'role': 'assistant', 'content': f'⚠️ 브릿지 서버 스트리밍 오류: {exc}'},
-                        'done': True
-                    }, ensure_ascii=False)}\n"
+    if client_stream:
+        coalesce_window_ms = resolve_coalesce_window(requested_model, request.headers)
+        return StreamingResponse(
+            stream_ollama_chat(request, events, requested_model, messages, start_time, coalesce_window_ms),
+            media_type="application/x-ndjson"
+        )
 
-        return StreamingResponse(stream_vllm(), media_type="application/x-ndjson")
+    # 스트리밍이 아닌 경우 (단일 응답); 응답을 기다리는 동안 클라이언트가 떠나면 업스트림 생성 중단
+    collect_task = asyncio.ensure_future(collect_ollama_chat(events, requested_model, messages, start_time))
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+    await asyncio.wait({collect_task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    if collect_task.done():
+        disconnected.cancel()
+        return collect_task.result()
+    collect_task.cancel()
+    add_request_log_fields(model=requested_model, stream=False, client_disconnected=True)
+    return Response(status_code=499)
 
-    else:
-        # ===============================================================
-        # 스트리밍이 아닌 경우 (단일 응답)
-        # ===============================================================
-        async with httpx.AsyncClient(timeout=None) as client:
-            try:
-                # vLLM에 POST 요청
-                response = await client.post(VLLM_API_URL, json=openai_payload)
-                response.raise_for_status()
-                resp_json = response.json()
-            except httpx.RequestError as exc:
-                print(f"--- VLLM API 요청 실패 (비스트리밍): {exc} ---")
-                return Response(
-                    content=json.dumps({
-                        "model": requested_model,
-                        "created_at": get_current_ollama_created_at_format(),
-                        "message": {
-                            "role": "assistant",
-                            "content": f"⚠️ VLLM 서버에 연결할 수 없음: {exc}"
-                        },
-                        "done": True
-                    }, ensure_ascii=False),
-                    status_code=500,
-                    media_type="application/json"
-                )
-            except httpx.HTTPStatusError as exc:
-                print(f"--- VLLM API HTTP 오류 (비스트리밍): {exc.response.status_code} - {exc.response.text} ---")
-                return Response(
-                    content=json.dumps({
-                        "model": requested_model,
-                        "created_at": get_current_ollama_created_at_format(),
-                        "message": {
-                            "role": "assistant",
-                            "content": f'⚠️ VLLM 서버에서 오류 응답: {exc.response.status_code} - {exc.response.text}'
-                        },
-                        "done": True
-                    }, ensure_ascii=False),
-                    status_code=exc.response.status_code,
-                    media_type="application/json"
-                )
-            except Exception:
-                # 예상치 못한 에러
-                return Response(
-                    content=json.dumps({
-                        "model": requested_model,
-                        "created_at": get_current_ollama_created_at_format(),
-                        "message": {
-                            "role": "assistant",
-                            "content": "⚠️ vLLM 서버로부터 올바르지 않은 응답 접수; 서버 상태/입력값 확인 필요"
-                        },
-                        "done": True
-                    }, ensure_ascii=False),
-                    media_type="application/json"
-                )
 
-        # vLLM 응답에 choice가 없는 경우
-        if "choices" not in resp_json or not resp_json["choices"]:
-            return Response(
-                content=json.dumps({
-                    "model": requested_model,
-                    "created_at": get_current_ollama_created_at_format(),
-                    "message": {
-                        "role": "assistant",
-                        "content": f"⚠️ vLLM에서 결과가 반환되지 않음.\n응답: {resp_json}"
-                    },
-                    "done": True
-                }, ensure_ascii=False),
-                media_type="application/json"
-            )
 
-        # 응답에서 실제 content 추출
-        content = resp_json["choices"][0]["message"]["content"]
-        finish_reason = resp_json["choices"][0].get("finish_reason")
 
-        done_status = bool(finish_reason is not None)
-        created_at_str = get_current_ollama_created_at_format()
-        if "created" in resp_json:
-            try:
-                dt_obj = datetime.fromtimestamp(resp_json["created"], tz=timezone.utc)
-                created_at_str = dt_obj.isoformat(timespec='microseconds') + 'Z'
-            except (ValueError, TypeError):
-                pass
-
-        # 전체 응답 시간 계산
-        end_time = time.time()
-        total_duration_ns = int((end_time - start_time) * 1_000_000_000)
-
-        # usage 기반으로 토큰 수 계산 (없을 경우 fallback)
-        usage = resp_json.get("usage", {})
-        prompt_eval_count_final = usage.get("prompt_tokens") if usage.get("prompt_tokens") is not None else estimated_prompt_tokens
-        eval_count_final = usage.get("completion_tokens") if usage.get("completion_tokens") is not None else len(content)
-
-        # 시간 분할 (모델 로딩시간 제외, 전체를 prompt 처리시간으로 가정)
-        prompt_eval_duration_ns = total_duration_ns
-        eval_duration_ns = 0
-
-        # Ollama 형식에 맞게 최종 응답 구성
-        ollama_response = {
-            "model": requested_model,
-            "created_at": created_at_str,
-            "message": {
-                "role": "assistant",
-                "content": content,
-            },
-            "done_reason": finish_reason or "stop",
-            "done": done_status,
-            "total_duration": total_duration_ns,
-            "load_duration": current_model_load_duration,
-            "prompt_eval_count": prompt_eval_count_final,
-            "prompt_eval_duration": prompt_eval_duration_ns,
-            "eval_count": eval_count_final,
-            "eval_duration": eval_duration_ns
+
+# ===============================================================
+# 임베딩 캐시 (내용 해시 → 벡터)
+# → 같은 모델/옵션/텍스트의 임베딩은 항상 같으므로 TTL 없이 바이트 예산 LRU로만 관리
+# → 변경되지 않은 파일을 다시 인덱싱할 때 vLLM 호출 없이 응답
+# ===============================================================
+class EmbeddingCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (vector, tokens, size)
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(batch_key, text):
+        model, truncate_tokens, dimensions = batch_key
+        return hashlib.blake2b(f"{model}\0{truncate_tokens}\0{dimensions}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[0].tolist(), entry[1]
+
+    def put(self, key, vector, tokens):
+        stored = array.array("d", vector)
+        size = stored.itemsize * len(stored) + len(key) + 64
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        self.entries[key] = (stored, tokens, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.stats["evictions"] += 1
+
+    def snapshot(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes, **self.stats}
+
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_MAX_BYTES)
+
+
+# ===============================================================
+# vLLM /v1/embeddings 호출 (연결 실패 시 다른 업스트림으로 fail-over)
+# ===============================================================
+async def request_upstream_embeddings(batch_key, texts):
+    model, truncate_tokens, dimensions = batch_key
+    payload = {"model": model, "input": texts, "encoding_format": "float"}
+    if truncate_tokens:
+        payload["truncate_prompt_tokens"] = truncate_tokens
+    if dimensions:
+        payload["dimensions"] = dimensions
+
+    tried = []
+    while True:
+        node = upstream_registry.pick(model, None, tried)
+        if node is None:
+            raise httpx.ConnectError(f"'{model}' 모델을 처리할 수 있는 vLLM 업스트림이 없음")
+        tried.append(node)
+        node.outstanding += 1
+        node.stats["requests"] += 1
+        try:
+            vllm_resp = await get_upstream_client().post(node.url(VLLM_EMBEDDINGS_PATH), json=payload)
+            vllm_resp.raise_for_status()
+            upstream_registry.record_success(node)
+            data = json_loads(vllm_resp.content)
+            break
+        except (httpx.RequestError, httpx.HTTPStatusError) as exc:
+            metric_errors.inc(classify_error(exc))
+            if is_node_failure(exc):
+                upstream_registry.record_failure(node, exc)
+            if not is_failover_error(exc) or upstream_registry.pick(model, None, tried) is None:
+                raise
+            log.warning("업스트림 fail-over", extra={"fields": {"upstream": node.base_url, "error": exc}})
+        finally:
+            node.outstanding -= 1
+
+    vectors = [item["embedding"] for item in sorted(data["data"], key=lambda item: item["index"])]
+    prompt_tokens = (data.get("usage") or {}).get("prompt_tokens") or 0
+    return vectors, prompt_tokens
+
+
+# ===============================================================
+# 임베딩 micro-batching
+# → 같은 (모델, 옵션)의 입력을 시간창(BRIDGE_EMBED_BATCH_WINDOW_MS) 또는 최대 입력 수까지 모아 한 번에 요청
+# → 배치 안의 동일 텍스트는 한 번만 보내고 결과를 공유
+# → 배치 usage의 prompt_tokens는 입력 길이 비율로 나누어 각 입력에 배분
+# → vLLM이 배치를 4xx로 거절하면(한 요청의 잘못된 입력 등) 요청별로 나누어 다시 보내
+#   문제 입력을 보낸 요청만 오류를 받게 함 (연결 실패 / 5xx는 배치 전체에 전달)
+# ===============================================================
+class EmbeddingBatch:
+    def __init__(self, key):
+        self.key = key  # (model, truncate_tokens, dimensions)
+        self.futures = {}  # text -> future((vector, tokens))
+        self.groups = []  # 요청별 입력 목록 (4xx 시 요청 단위로 나누어 재시도)
+        self.timer = None
+
+
+class EmbeddingBatcher:
+    def __init__(self, window_ms, max_inputs):
+        self.window = max(0.0, window_ms) / 1000
+        self.max_inputs = max(1, max_inputs)
+        self.batches = {}  # key -> 입력을 받는 중인 배치
+        self.tasks = set()
+        self.stats = {"requests": 0, "inputs": 0, "cache_hits": 0, "deduplicated": 0, "batches": 0, "upstream_inputs": 0, "failed_batches": 0, "split_batches": 0}
+
+    def submit(self, key, text):
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = EmbeddingBatch(key)
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self.flush, batch)
+        future = batch.futures.get(text)
+        if future is not None:
+            self.stats["deduplicated"] += 1
+            return batch, future
+        future = batch.futures[text] = asyncio.get_running_loop().create_future()
+        if len(batch.futures) >= self.max_inputs:
+            self.flush(batch)
+        return batch, future
+
+    def flush(self, batch):
+        if self.batches.get(batch.key) is not batch:
+            return
+        del self.batches[batch.key]
+        batch.timer.cancel()
+        task = asyncio.create_task(self.send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def request(self, batch, texts):
+        self.stats["upstream_inputs"] += len(texts)
+        vectors, prompt_tokens = await request_upstream_embeddings(batch.key, texts)
+        if len(vectors) != len(texts):
+            raise ValueError(f"vLLM 임베딩 결과 개수 불일치: 입력 {len(texts)}개, 결과 {len(vectors)}개")
+        total_chars = sum(len(text) for text in texts) or 1
+        for text, vector in zip(texts, vectors):
+            tokens = round(prompt_tokens * len(text) / total_chars)
+            if embedding_cache.enabled():
+                embedding_cache.put(EmbeddingCache.key(batch.key, text), vector, tokens)
+            future = batch.futures[text]
+            if not future.done():
+                future.set_result((vector, tokens))
+
+    def fail(self, batch, texts, exc):
+        for text in texts:
+            future = batch.futures[text]
+            if not future.done():
+                future.set_exception(exc)
+                future.exception()  # 대기자가 모두 떠난 경우의 미확인 예외 경고 방지
+
+    async def send(self, batch):
+        self.stats["batches"] += 1
+        try:
+            await self.request(batch, list(batch.futures))
+            return
+        except httpx.HTTPStatusError as exc:
+            if not 400 <= exc.response.status_code < 500 or len(batch.groups) < 2:
+                self.stats["failed_batches"] += 1
+                self.fail(batch, batch.futures, exc)
+                return
+        except Exception as exc:
+            self.stats["failed_batches"] += 1
+            self.fail(batch, batch.futures, exc)
+            return
+
+        # 요청별로 다시 보내고, 성공한 요청의 결과를 먼저 채운 뒤 남은 입력에만 오류 전달
+        # (다른 요청과 공유하는 입력은 성공한 쪽 결과를 사용)
+        self.stats["split_batches"] += 1
+        groups = [list(dict.fromkeys(texts)) for texts in batch.groups]
+        results = await asyncio.gather(*(self.request(batch, texts) for texts in groups), return_exceptions=True)
+        for texts, result in zip(groups, results):
+            if isinstance(result, BaseException):
+                self.fail(batch, texts, result)
+        self.fail(batch, batch.futures, RuntimeError("임베딩 배치 분할 후 결과 없음"))
+
+    async def embed(self, key, texts):
+        # 반환: (입력 순서대로의 벡터 목록, prompt 토큰 수 합계)
+        self.stats["requests"] += 1
+        self.stats["inputs"] += len(texts)
+        results = [None] * len(texts)
+        waiting = []
+        groups = {}  # 배치 -> 이 요청이 넣은 입력 (최대 입력 수에서 배치가 나뉘면 여러 개)
+        for index, text in enumerate(texts):
+            cached = embedding_cache.get(EmbeddingCache.key(key, text)) if embedding_cache.enabled() else None
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                results[index] = cached
+            else:
+                batch, future = self.submit(key, text)
+                groups.setdefault(batch, []).append(text)
+                waiting.append((index, future))
+        # send 태스크는 다음 await 이후에 실행되므로 여기서 등록해도 늦지 않음
+        for batch, batch_texts in groups.items():
+            batch.groups.append(batch_texts)
+        if waiting:
+            # 같은 future를 다른 요청과 공유하므로 이 요청이 취소되어도 future는 취소하지 않음
+            resolved = await asyncio.gather(*(asyncio.shield(future) for _, future in waiting))
+            for (index, _), result in zip(waiting, resolved):
+                results[index] = result
+        return [vector for vector, _ in results], sum(tokens for _, tokens in results)
+
+    def snapshot(self):
+        batches = self.stats["batches"]
+        return {
+            "window_ms": self.window * 1000,
+            "max_inputs": self.max_inputs,
+            "avg_batch_size": round(self.stats["upstream_inputs"] / batches, 2) if batches else 0.0,
+            "cache": embedding_cache.snapshot(),
+            **self.stats,
         }
 
-        return Response(
-            content=json.dumps(ollama_response, ensure_ascii=False),
-            media_type="application/json"
-        )
+
+embedding_batcher = EmbeddingBatcher(EMBED_BATCH_WINDOW_MS, EMBED_BATCH_MAX_INPUTS)
+
+
+def embed_batch_key(model, body):
+    options = body.get("options") or {}
+    truncate_tokens = EMBED_TRUNCATE_TOKENS if body.get("truncate", True) else 0
+    dimensions = body.get("dimensions") or options.get("dimensions") or 0
+    return (model, truncate_tokens, dimensions)
+
+
+def embed_error_response(exc, model):
+    if isinstance(exc, httpx.HTTPStatusError):
+        log.error("VLLM 임베딩 HTTP 오류", extra={"fields": {"model": model, "status": exc.response.status_code, "body": exc.response.text[:500]}})
+        return JSONResponse({"error": f"VLLM 서버에서 오류 응답: {exc.response.status_code} - {exc.response.text}"}, status_code=exc.response.status_code)
+    if isinstance(exc, httpx.RequestError):
+        log.error("VLLM 임베딩 요청 실패", extra={"fields": {"model": model, "error": exc}})
+        return JSONResponse({"error": f"VLLM 서버에 연결할 수 없음: {exc}"}, status_code=502)
+    log.exception("임베딩 처리 중 예상치 못한 오류")
+    metric_errors.inc("bridge_internal")
+    return JSONResponse({"error": f"브릿지 서버 임베딩 오류: {exc}"}, status_code=500)
+
+
+
+
+
+# ===============================================================
+# 임베딩 API (/api/embed: 여러 입력, /api/embeddings: 단일 prompt 구버전 API)
+# ===============================================================
+@app.post("/api/embed")
+async def ollama_embed(request: Request):
+    start_time = time.perf_counter()
+    try:
+        body = await read_json_body(request)
+    except RequestRejectedError as exc:
+        return request_rejected_response(exc)
+    model = body.get("model")
+    if not model:
+        return JSONResponse({"error": "모델 이름 누락: 요청에 model 이름이 없음"}, status_code=400)
+    inputs = body.get("input") or []
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if not isinstance(inputs, list) or not all(isinstance(text, str) for text in inputs):
+        return JSONResponse({"error": "input은 문자열 또는 문자열 목록이어야 함"}, status_code=400)
+
+    try:
+        vectors, prompt_tokens = await embedding_batcher.embed(embed_batch_key(model, body), inputs) if inputs else ([], 0)
+    except Exception as exc:
+        return embed_error_response(exc, model)
+
+    add_request_log_fields(model=model, inputs=len(inputs), prompt_eval_count=prompt_tokens)
+    return Response(
+        content=json_dumps_bytes({
+            "model": model,
+            "embeddings": vectors,
+            "total_duration": int((time.perf_counter() - start_time) * 1_000_000_000),
+            "load_duration": 0,
+            "prompt_eval_count": prompt_tokens,
+        }),
+        media_type="application/json"
+    )
+
+
+@app.post("/api/embeddings")
+async def ollama_embeddings(request: Request):
+    try:
+        body = await read_json_body(request)
+    except RequestRejectedError as exc:
+        return request_rejected_response(exc)
+    model = body.get("model")
+    if not model:
+        return JSONResponse({"error": "모델 이름 누락: 요청에 model 이름이 없음"}, status_code=400)
+    prompt = body.get("prompt") or ""
+    if not prompt:
+        return JSONResponse({"embedding": []})
+
+    try:
+        vectors, prompt_tokens = await embedding_batcher.embed(embed_batch_key(model, body), [prompt])
+    except Exception as exc:
+        return embed_error_response(exc, model)
+
+    add_request_log_fields(model=model, inputs=1, prompt_eval_count=prompt_tokens)
+    return Response(content=json_dumps_bytes({"embedding": vectors[0]}), media_type="application/json")
+
+
+
+
+
+# ===============================================================
+# 멀티 워커 런처 (python vllm_ollama_bridge_server.py)
+# → 워커 수: BRIDGE_WORKERS (auto = CPU affinity와 cgroup CPU 제한 중 작은 값, 최대 BRIDGE_WORKERS_MAX)
+# → uvloop / httptools가 설치되어 있으면 이벤트 루프 / HTTP 파서로 사용
+# → 워커가 2개 이상이면 공유 상태 서버를 먼저 띄우고 socket 경로를 환경변수로 워커에 전달
+# ===============================================================
+def detect_worker_count():
+    if WORKERS != "auto":
+        try:
+            return max(1, int(WORKERS))
+        except ValueError:
+            log.warning("BRIDGE_WORKERS 값이 잘못되어 auto로 동작", extra={"fields": {"value": WORKERS}})
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    # 컨테이너 CPU 제한 (cgroup v2: "quota period" 또는 "max period")
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, min(cpus, WORKERS_MAX))
+
+
+def main():
+    workers = detect_worker_count()
+    loop_impl = "uvloop" if importlib.util.find_spec("uvloop") is not None else "asyncio"
+    http_impl = "httptools" if importlib.util.find_spec("httptools") is not None else "h11"
+    if workers > 1:
+        socket_path = SHARED_STATE_SOCKET or os.path.join(tempfile.gettempdir(), f"vllm_ollama_bridge_{os.getpid()}.sock")
+        SharedStateServer(socket_path).start()
+        os.environ["BRIDGE_STATE_SOCKET"] = socket_path
+        os.environ["BRIDGE_WORKER_COUNT"] = str(workers)
+    log.info("브릿지 시작", extra={"fields": {"workers": workers, "loop": loop_impl, "http": http_impl, "host": BRIDGE_HOST, "port": BRIDGE_PORT}})
+    uvicorn.run(
+        "vllm_ollama_bridge_server:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host=BRIDGE_HOST,
+        port=BRIDGE_PORT,
+        workers=workers,
+        loop=loop_impl,
+        http=http_impl,
+        # 요청 로그는 log_requests 미들웨어의 요약 1줄로 충분하므로 uvicorn 접근 로그는 끔
+        access_log=False,
+        log_level=LOG_LEVEL.lower() if LOG_LEVEL.lower() in ("critical", "error", "warning", "info", "debug") else "info",
+    )
+
+
+if __name__ == "__main__":
+    main()